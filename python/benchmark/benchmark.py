@@ -0,0 +1,215 @@
+'''
+End-to-end latency benchmark on synthetic data, no NPU, camera or network needed.
+
+    python benchmark/benchmark.py --sizes 10000 100000 --features_dim 4096 --output bench.json
+
+Every stage of the online path is timed separately (pre_process, inference backend,
+post_process with and without a position prior or a track, _calculate_best_position,
+utm_to_latlon for one fix and a batch of candidates), then the whole pipeline from main.py. Results are written as JSON so
+runs can be compared across commits.
+'''
+import os
+import sys
+import json
+import shutil
+import argparse
+import platform
+import resource
+import subprocess
+import tempfile
+import threading
+import numpy as np
+from time import perf_counter, monotonic, sleep, strftime
+
+PYTHON_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PYTHON_ROOT)
+
+from py_utils.logger_config import logger
+from py_utils.utils import load_config
+from py_utils.coordinates import CoordinateConverter
+from py_utils.process_manager import ProcessManager
+from py_utils.tracker import Tracker
+from py_utils.pre_process import PreProcessor
+from py_utils.pipeline import FramePacket
+from main import build_parser, build_pipeline
+from synthetic import synthetic_database, synthetic_frames, synthetic_attitudes
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def summarize(samples):
+    """p50/p95/p99 latency in milliseconds and throughput of a list of durations in seconds"""
+    samples = np.asarray(samples) * 1000
+    return {
+        "count": int(len(samples)),
+        "mean_ms": float(np.mean(samples)),
+        "p50_ms": float(np.percentile(samples, 50)),
+        "p95_ms": float(np.percentile(samples, 95)),
+        "p99_ms": float(np.percentile(samples, 99)),
+        "throughput_fps": float(1000. / np.mean(samples)) if np.mean(samples) > 0 else None,
+    }
+
+
+def time_calls(func, items, warmup=3):
+    for item in items[:warmup]:
+        func(item)
+    durations = []
+    for item in items:
+        t_start = perf_counter()
+        func(item)
+        durations.append(perf_counter() - t_start)
+    return durations
+
+
+def bench_pipeline(pm, args, frames, attitudes, rate):
+    """feed frames at `rate` fps (0 = as fast as the first stage accepts them)"""
+    latencies = []
+    done = threading.Event()
+    last_seq = len(frames) - 1
+
+    def sink(packet):
+        latencies.append(monotonic() - packet.t_capture)
+        if packet.seq == last_seq:
+            done.set()
+
+    pipeline = build_pipeline(pm, args, sink)
+    pipeline.start()
+    t_start = monotonic()
+    for seq, (frame, at) in enumerate(zip(frames, attitudes)):
+        pipeline.submit(FramePacket(seq, frame, list(at[:3]) + [0., 0., 0.]))
+        if rate > 0:
+            sleep(max(0., t_start + (seq + 1) / rate - monotonic()))
+        else:
+            # as fast as possible, but without dropping frames at the entry
+            while len(pipeline.stages[0].queue) >= args.pipeline_queue_size:
+                sleep(0.0005)
+    done.wait(timeout=30)
+    elapsed = monotonic() - t_start
+    pipeline.stop()
+    result = summarize(latencies) if latencies else {"count": 0}
+    result["throughput_fps"] = len(latencies) / elapsed
+    result["dropped"] = int(sum(stage.dropped for stage in pipeline.stages))
+    return result
+
+
+def bench_database(bench_args, config, num_vectors, workdir):
+    path = os.path.join(workdir, f"database_{num_vectors}_{bench_args.features_dim}.h5")
+    utms = synthetic_database(path, num_vectors, bench_args.features_dim, seed=bench_args.seed)
+
+    args = build_parser(config).parse_args([])
+    args.path_local_database = path
+    args.features_dim = bench_args.features_dim
+    args.inference_backend = "fake"
+    args.fake_latency = bench_args.fake_latency
+    args.index_type = bench_args.index_type
+    args.use_best_n = bench_args.use_best_n
+    args.recall_values = [max(bench_args.use_best_n, 1)]
+
+    t_start = perf_counter()
+    pm = ProcessManager(args)
+    startup = perf_counter() - t_start
+
+    frames = synthetic_frames(bench_args.frames, bench_args.frame_width, bench_args.frame_height, bench_args.seed)
+    attitudes = synthetic_attitudes(bench_args.frames, utms, bench_args.seed)
+    pre_processor = PreProcessor()
+    gray_pre_processor = PreProcessor(input_format="gray")
+    converter = CoordinateConverter(args.zone_number, args.zone_letter)
+    inputs = [np.expand_dims(pre_processor(frames[0], attitudes[0]), 0).copy()]
+    gray_inputs = [np.expand_dims(gray_pre_processor(frames[0], attitudes[0]), 0).copy()]
+    features = pm.infer(inputs[0])
+    k = max(args.recall_values)
+    distances, predictions = pm.faiss_index.search(features, k)
+    sort_idx = np.argsort(distances[0])
+
+    # tracking is off by default (track_history: 0), the tracked stage gets a tracker of its own
+    pm.tracker = Tracker(pm.database_utms, max(args.track_history, 5), args.track_window_min, args.track_window_max,
+                         args.track_window_sigma, args.track_match_radius, args.track_process_noise,
+                         args.track_measurement_noise, args.track_max_misses, args.track_gate_sigma)
+    post_process_tracked = time_calls(lambda i: pm.post_process(features, None, i * 0.1), list(range(len(frames))))
+    pm.tracker = None
+
+    stages = {
+        "pre_process": time_calls(lambda i: pre_processor(frames[i], attitudes[i]), list(range(len(frames)))),
+        "pre_process_gray": time_calls(lambda i: gray_pre_processor(frames[i], attitudes[i]), list(range(len(frames)))),
+        "inference": time_calls(lambda i: pm.infer(inputs[0]), list(range(len(frames)))),
+        "inference_gray": time_calls(lambda i: pm.infer(gray_inputs[0]), list(range(len(frames)))),
+        "post_process_global": time_calls(lambda i: pm.post_process(features), list(range(len(frames)))),
+        "post_process_prior": time_calls(lambda i: pm.post_process(features, attitudes[i, 3:5]), list(range(len(frames)))),
+        "post_process_tracked": post_process_tracked,
+        "calculate_best_position": time_calls(lambda i: pm._calculate_best_position(distances[0], predictions[0], sort_idx), list(range(len(frames)))),
+        "utm_to_latlon": time_calls(lambda i: converter.utm_to_latlon(attitudes[i, 3:5]), list(range(len(frames)))),
+        "utm_to_latlon_batch100": time_calls(lambda i: converter.utm_to_latlon(utms[:100]), list(range(len(frames)))),
+    }
+    result = {
+        "database_size": num_vectors,
+        "features_dim": bench_args.features_dim,
+        "index_type": bench_args.index_type,
+        "startup_s": startup,
+        "stages": {name: summarize(durations) for name, durations in stages.items()},
+        "pipeline": bench_pipeline(pm, args, frames, attitudes, bench_args.rate),
+        # ru_maxrss is the peak of the whole process so far, not of a single stage
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    pm.model.release()
+    os.remove(path)
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=PYTHON_ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Latency benchmark on synthetic databases, frames and attitudes.')
+    parser.add_argument('--config', type=str, default=os.path.join(os.path.dirname(PYTHON_ROOT), 'config.yaml'), help='config.yaml used for every other option')
+    parser.add_argument('--sizes', type=int, default=[10000, 100000], nargs="+", help='database sizes to benchmark, such as 10000 100000 1000000')
+    parser.add_argument('--features_dim', type=int, default=4096, help='descriptor dims of the synthetic database')
+    parser.add_argument('--index_type', type=str, default='flat', help='faiss index type')
+    parser.add_argument('--use_best_n', type=int, default=1, help='use_best_n for post_process')
+    parser.add_argument('--frames', type=int, default=200, help='frames per stage')
+    parser.add_argument('--frame_width', type=int, default=1280, help='synthetic camera frame width')
+    parser.add_argument('--frame_height', type=int, default=720, help='synthetic camera frame height')
+    parser.add_argument('--fake_latency', type=float, default=0.05, help='latency (seconds) of the fake inference backend')
+    parser.add_argument('--rate', type=float, default=0, help='pipeline input rate in fps, 0 = as fast as possible')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--workdir', type=str, default=None, help='folder for the synthetic databases, a temporary one by default')
+    parser.add_argument('--output', type=str, default='benchmark_result.json', help='JSON result file')
+    bench_args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+    config = load_config(bench_args.config)
+
+    workdir = bench_args.workdir or tempfile.mkdtemp(prefix="vtl_bench_")
+    os.makedirs(workdir, exist_ok=True)
+    results = []
+    try:
+        for num_vectors in bench_args.sizes:
+            print(f"benchmarking database of {num_vectors} x {bench_args.features_dim}...")
+            result = bench_database(bench_args, config, num_vectors, workdir)
+            for name, stage in list(result["stages"].items()) + [("pipeline", result["pipeline"])]:
+                print(f"  {name:<24} p50 {stage.get('p50_ms', 0):8.3f} ms  p99 {stage.get('p99_ms', 0):8.3f} ms  {stage['throughput_fps']:8.1f} fps")
+            results.append(result)
+    finally:
+        if bench_args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "commit": git_commit(),
+        "date": strftime("%Y-%m-%d %H:%M:%S"),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "args": vars(bench_args),
+        "peak_rss_mb": peak_rss_mb(),
+        "results": results,
+    }
+    with open(bench_args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"results saved to {bench_args.output}")
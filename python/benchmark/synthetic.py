@@ -0,0 +1,52 @@
+import h5py
+import numpy as np
+import cv2
+
+ORIGIN = (400000., 3000000.)  # utm of the south west corner, zone 50N
+
+
+def synthetic_database(path, num_vectors, features_dim=4096, spacing=30., num_clusters=256, seed=0, chunk_size=16384):
+    """Write a database_features.h5 with num_vectors tiles on a square utm grid.
+
+    Features are L2 normalized and clustered by location, like NetVLAD descriptors of
+    neighbouring tiles, so IVF/HNSW indexes behave roughly as on real data."""
+    rng = np.random.default_rng(seed)
+    side = int(np.ceil(np.sqrt(num_vectors)))
+    ids = np.arange(num_vectors)
+    utms = np.stack([ORIGIN[0] + (ids % side) * spacing, ORIGIN[1] + (ids // side) * spacing], axis=1)
+    # neighbouring tiles share one of cluster_side x cluster_side cluster centers
+    cluster_side = int(np.ceil(np.sqrt(num_clusters)))
+    centers = rng.standard_normal((cluster_side * cluster_side, features_dim)).astype(np.float32)
+    with h5py.File(path, "w") as hf:
+        features_ds = hf.create_dataset("database_features", (num_vectors, features_dim), dtype=np.float32)
+        for start in range(0, num_vectors, chunk_size):
+            end = min(start + chunk_size, num_vectors)
+            chunk_ids = ids[start:end]
+            cluster_x = (chunk_ids % side) * cluster_side // side
+            cluster_y = (chunk_ids // side) * cluster_side // side
+            chunk = centers[cluster_y * cluster_side + cluster_x] + 0.5 * rng.standard_normal((end - start, features_dim)).astype(np.float32)
+            chunk /= np.linalg.norm(chunk, axis=1, keepdims=True)
+            features_ds[start:end] = chunk
+        hf.create_dataset("database_utms", data=utms)
+    return utms
+
+
+def synthetic_frames(num_frames, width=1280, height=720, seed=0):
+    """smooth random BGR frames, a few distinct ones reused to keep memory small"""
+    rng = np.random.default_rng(seed)
+    frames = []
+    for _ in range(min(num_frames, 8)):
+        noise = rng.integers(0, 256, (height // 8, width // 8, 3), dtype=np.uint8)
+        frames.append(cv2.resize(noise, (width, height), interpolation=cv2.INTER_CUBIC))
+    return [frames[i % len(frames)] for i in range(num_frames)]
+
+
+def synthetic_attitudes(num_frames, utms, seed=0):
+    """[yaw, pitch, roll, easting, northing] per frame, small tilts and a random heading,
+    positions drawn from the database utms"""
+    rng = np.random.default_rng(seed)
+    yaw = rng.uniform(-np.pi, np.pi, num_frames)
+    pitch = rng.normal(0, 0.05, num_frames)
+    roll = rng.normal(0, 0.05, num_frames)
+    positions = utms[rng.integers(0, len(utms), num_frames)] + rng.normal(0, 20, (num_frames, 2))
+    return np.column_stack([yaw, pitch, roll, positions])
@@ -0,0 +1,33 @@
+import os
+import argparse
+from time import time
+from py_utils.database_builder import ImageSource, build_database, COMPRESSIONS
+from py_utils.inference_pool import InferencePool, create_backends, add_inference_args
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Extract the features of satellite tiles into database_features.h5.')
+    parser.add_argument('--images', type=str, required=True, help='folder of @utm_easting@utm_northing@...@.jpg tiles, or an h5 file with image_data and image_name')
+    parser.add_argument('--path_local_database', type=str, default='/home/xujg/code/UAV-VisionLoc-Deploy/data/database/database_features.h5', help='h5 file the features and utms are written to, tiles already in it are skipped')
+    parser.add_argument('--model_path', type=str, default='/home/xujg/code/UAV-VisionLoc-Deploy/model/uvl_v0807.rknn', help='model path, .rknn for the rknn backend or .onnx for the onnx backend')
+    parser.add_argument('--features_dim', type=int, default=4096, help='NetVLAD output dims.')
+    add_inference_args(parser)
+    parser.add_argument('--workers', type=int, default=4, help='Preprocessing processes, 0 to preprocess in the main process.')
+    parser.add_argument('--chunk_size', type=int, default=16, help='Tiles read, preprocessed and written per task.')
+    parser.add_argument('--prefetch', type=int, default=2, help='Chunks in flight per preprocessing process.')
+    parser.add_argument('--contrast_factor', type=float, default=3, help='Contrast stretch of the preprocessing, same as for the queries.')
+    parser.add_argument('--compression', type=str, default='none', choices=COMPRESSIONS, help='h5 compression of the features, used when the database is created.')
+    args = parser.parse_args()
+
+    source = ImageSource(args.images)
+    pool = InferencePool(create_backends(args))
+    t_start = time()
+    try:
+        num_added = build_database(source, args.path_local_database, pool, args.features_dim, args.workers,
+                                   args.chunk_size, args.prefetch, args.contrast_factor, args.compression,
+                                   args.input_format)
+    finally:
+        pool.release()
+    print(f"Added {num_added} tiles to {args.path_local_database} in {time() - t_start:.1f} s "
+          f"({os.path.getsize(args.path_local_database) / 2 ** 20:.1f} MB)")
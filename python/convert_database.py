@@ -0,0 +1,21 @@
+import os
+import argparse
+from py_utils.database import convert_database, tile_database, FEATURE_DTYPES
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Convert database_features.h5 into the compact memory-mapped database.')
+    parser.add_argument('--path_local_database', type=str, default='/home/xujg/code/UAV-VisionLoc-Deploy/data/database/database_features.h5', help='h5 file with database_features and database_utms')
+    parser.add_argument('--output', type=str, default=None, help='output folder, defaults to <database>_<dtype> next to the h5 file')
+    parser.add_argument('--dtype', type=str, default='float16', choices=FEATURE_DTYPES, help='storage type of the features')
+    parser.add_argument('--chunk_size', type=int, default=4096, help='rows converted at a time')
+    parser.add_argument('--tile_size', type=float, default=0, help='split the database into square tiles of this size (meters) on the UTM grid, 0 for a single database')
+    args = parser.parse_args()
+
+    if args.tile_size > 0:
+        output = args.output or "{}_tiles{:g}_{}".format(os.path.splitext(args.path_local_database)[0], args.tile_size, args.dtype)
+        tile_database(args.path_local_database, output, args.tile_size, args.dtype, args.chunk_size)
+    else:
+        output = args.output or "{}_{}".format(os.path.splitext(args.path_local_database)[0], args.dtype)
+        convert_database(args.path_local_database, output, args.dtype, args.chunk_size)
@@ -2,13 +2,15 @@ import os
 import cv2
 import sys
 import argparse
-import h5py
-import faiss
 import numpy as np
 from time import time
-from tqdm import tqdm
 from py_utils import datasets
-from sklearn.neighbors import NearestNeighbors
+from py_utils.faiss_index import add_index_args, load_or_build_index
+from py_utils.database import load_database
+from py_utils.projection import load_or_fit_projection, project
+from py_utils.inference_pool import InferencePool, create_backends, add_inference_args
+from py_utils.process_manager import add_retrieval_args
+from py_utils.evaluation import extract_queries_features, compute_recalls, add_evaluation_args
 
 IMG_SIZE = (512, 512)  # (width, height), such as (1280, 736)
 
@@ -27,29 +29,6 @@ def draw(img, position):
                 (0, 512 - 20), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 255), 2)
 
 
-class RKInfer:
-    def __init__(self, args):
-        self.args = args
-
-    def setup_model(self):
-        model_path = self.args.model_path
-        from py_utils.rknn_executor import RKNN_model_container 
-        self.model = RKNN_model_container(model_path)
-
-    def model_inference(self, input_data):
-
-        # t4 = time()
-        outputs = self.model.run([input_data])
-        # t5 = time()
-        # position = self.post_process(outputs[0])
-        # t6 = time()
-        # print("inference_time: {:.4f} s".format(t5-t4) )
-        # print("post_time: {:.4f} s".format(t6-t5) )
-        return outputs[0]
-
-
-
-
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='Process some integers.')
@@ -63,46 +42,62 @@ if __name__ == '__main__':
     parser.add_argument('--img_folder', type=str, default='home/xujg/code/UAV-VisionLoc/python/test_queries_imgs/', help='img folder path')
     parser.add_argument('--path_local_database', type=str, default='/home/xujg/code/UAV-VisionLoc/data/database/database_features.h5', help='load local features and utms of database')
 
-    parser.add_argument(
-        "--features_dim",
-        type=int,
-        default=4096,
-        help="NetVLAD output dims.",
-    )
+    add_evaluation_args(parser)
     # retrieval params
+    add_retrieval_args(parser)
+    # inference params
+    add_inference_args(parser)
+    parser.add_argument('--check_parity', action='store_true', default=False, help='Also extract with the float32 input and compare the features and recalls.')
+    parser.add_argument('--reference_model_path', type=str, default='', help='float32 input model the --check_parity reference is extracted with, such as the model before fold_input_normalization.py.')
+    # index params
+    add_index_args(parser)
     parser.add_argument(
-        "--recall_values",
-        type=int,
-        default=[1, 5, 10, 20],
+        "--index_types",
+        type=str,
+        default=None,
         nargs="+",
-        help="Recalls to be computed, such as R@5.",
+        help="Index types to compare, such as flat ivf_flat ivf_pq hnsw. Defaults to --index_type.",
     )
     parser.add_argument(
-        "--use_best_n",
+        "--pca_dims",
         type=int,
-        default=1,
-        help="Calculate the position from weighted averaged best n. If n = 1, then it is equivalent to top 1"
+        default=[0],
+        nargs="+",
+        help="PCA whitening dims to compare, such as 0 256 512 1024, 0 for the raw descriptors.",
     )
 
     args = parser.parse_args()
 
-    rk_engine = RKInfer(args)
-    queries_folder_h5_path = "/home/xujg/code/UAV-VisionLoc/data/queries/test_sample.h5"
-    # init model
-    rk_engine.setup_model()
+    check_parity = args.check_parity and args.input_format != "float32"
+    if check_parity and not args.reference_model_path:
+        print("--check_parity needs the float32 input model as --reference_model_path.")
+        sys.exit()
 
-    queries_dataset = datasets.QueriesDatasetOpencv(queries_folder_h5_path)
-
-    queries_features = np.empty((queries_dataset.queries_num, args.features_dim), dtype="float32")
-
-
-    for inputs, indices in tqdm(queries_dataset, ncols=100):
+    # init model
+    pool = InferencePool(create_backends(args))
 
-        # inputs = inputs.numpy()
-        inputs = np.expand_dims(inputs, 0)
-        features = rk_engine.model_inference(inputs)
-        queries_features[indices, :] = features
+    queries_dataset = datasets.QueriesDatasetOpencv(args.queries_h5)
 
+    t_start = time()
+    queries_features = extract_queries_features(
+        queries_dataset, pool, args.features_dim, args.workers, args.chunk_size, args.prefetch, args.input_format
+    )
+    print(f"Extracted {queries_dataset.queries_num} queries in {time() - t_start:.1f} s")
+
+    pool.release()
+
+    reference_features = None
+    if check_parity:
+        # the model under test only takes its own input format, the reference runs in a pool of its own
+        reference_pool = InferencePool(create_backends(argparse.Namespace(**dict(vars(args), model_path=args.reference_model_path))))
+        reference_features = extract_queries_features(
+            queries_dataset, reference_pool, args.features_dim, args.workers, args.chunk_size, args.prefetch, "float32"
+        )
+        reference_pool.release()
+        cosine = np.sum(queries_features * reference_features, axis=1) / (
+            np.linalg.norm(queries_features, axis=1) * np.linalg.norm(reference_features, axis=1) + 1e-12)
+        print(f"{args.input_format} vs float32 input: max abs difference {np.abs(queries_features - reference_features).max():.2e}, "
+              f"min cosine {cosine.min():.6f}, mean cosine {cosine.mean():.6f}")
 
     print(f"Final feature dim: {queries_features.shape[1]}")
 
@@ -110,43 +105,55 @@ if __name__ == '__main__':
     if os.path.exists(args.path_local_database):
         print("loading Database feature and utms")
         # load local features and utms of database.
-        with h5py.File(args.path_local_database, 'r') as hf:
-            database_features = hf['database_features'][:]
-            database_utms = hf['database_utms'][:]
+        database_features, database_utms = load_database(args.path_local_database)
 
     else:
-        print("please extracting database features first.")
-
+        print("please extracting database features first, see build_database.py.")
+        sys.exit()
 
-    # Find soft_positives_per_query, which are within val_positive_dist_threshold (deafult 60 meters)
-    knn = NearestNeighbors(n_jobs=-1)
-    knn.fit(database_utms)
-    positives_per_query = knn.radius_neighbors(
-        queries_dataset.queries_utms,
-        radius=60,
-        return_distance=False,
-    )
 
     print("Calculating recalls")
-    faiss_index = faiss.IndexFlatL2(args.features_dim)
-    faiss_index.add(database_features)
-    distances, predictions = faiss_index.search(
-        queries_features, max(args.recall_values)
-    )
-
-    # args.recall_values by default is [1, 5, 10, 20]
-    recalls = np.zeros(len(args.recall_values))
-    for query_index, pred in enumerate(predictions):
-        for i, n in enumerate(args.recall_values):
-            if np.any(np.in1d(pred[:n], positives_per_query[query_index])):
-                recalls[i:] += 1
-                break
-    # Divide by the number of queries*100, so the recalls are in percentages
-    recalls = recalls / queries_dataset.queries_num * 100
-    recalls_str = ", ".join(
-        [f"R@{val}: {rec:.1f}" for val,
-            rec in zip(args.recall_values, recalls)]
-    )
-    print(f"{recalls_str}")
-
-
+    index_types = args.index_types or [args.index_type]
+    for pca_dims in args.pca_dims:
+        if pca_dims > 0:
+            pca, search_features, search_path = load_or_fit_projection(args.path_local_database, pca_dims)
+            search_queries = project(pca, queries_features)
+        else:
+            pca, search_features, search_path = None, database_features, args.path_local_database
+            search_queries = queries_features
+        for index_type in index_types:
+            args.index_type = index_type
+            faiss_index = load_or_build_index(search_features, args, search_path)
+            distances, predictions = faiss_index.search(
+                search_queries, max(args.recall_values)
+            )
+            # the online path projects and searches one query at a time, so time it the same way
+            num_timed = min(100, queries_dataset.queries_num)
+            t_start = time()
+            for query_features in queries_features[:num_timed]:
+                query_features = query_features[np.newaxis]
+                if pca is not None:
+                    query_features = project(pca, query_features)
+                faiss_index.search(query_features, max(args.recall_values))
+            search_time = (time() - t_start) / num_timed
+
+            recalls = compute_recalls(
+                predictions, database_utms, queries_dataset.queries_utms, args.recall_values, args.positive_dist_threshold
+            )
+            recalls_str = ", ".join(
+                [f"R@{val}: {rec:.1f}" for val,
+                    rec in zip(args.recall_values, recalls)]
+            )
+            dims = pca_dims or queries_features.shape[1]
+            print(f"{index_type} {dims}d: {recalls_str}, search time: {search_time * 1000:.3f} ms/query, "
+                  f"index {faiss_index.ntotal * dims * 4 / 2 ** 20:.0f} MB as float32")
+
+            if reference_features is not None:
+                reference_queries = project(pca, reference_features) if pca is not None else reference_features
+                _, reference_predictions = faiss_index.search(reference_queries, max(args.recall_values))
+                reference_recalls = compute_recalls(
+                    reference_predictions, database_utms, queries_dataset.queries_utms, args.recall_values, args.positive_dist_threshold
+                )
+                same_top1 = np.mean(reference_predictions[:, 0] == predictions[:, 0]) * 100
+                print("    float32 input: " + ", ".join(f"R@{val}: {rec:.1f}" for val, rec in zip(args.recall_values, reference_recalls))
+                      + f", same top-1 for {same_top1:.1f}% of the queries")
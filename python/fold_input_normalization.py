@@ -0,0 +1,49 @@
+import argparse
+from py_utils.pre_process import INPUT_SCALE, INPUT_OFFSET
+
+
+def fold_input_normalization(model_path, out_path, channels=1):
+    """Copy of a float32 NHWC onnx model that takes the uint8 image of input_format "gray"
+    (channels 1) or "uint8" (channels 3) and does the mean/std normalization itself:
+    Cast -> Mul(INPUT_SCALE) -> Sub(INPUT_OFFSET) in front of the graph, a single channel
+    is broadcast to the 3 the model expects. Convert the result with rknn-toolkit2 as usual."""
+    import onnx
+    from onnx import helper, numpy_helper, TensorProto
+
+    model = onnx.load(model_path)
+    graph = model.graph
+    initializers = {initializer.name for initializer in graph.initializer}
+    graph_input = [value for value in graph.input if value.name not in initializers][0]
+    dims = [dim.dim_param or (dim.dim_value if dim.HasField("dim_value") else None)
+            for dim in graph_input.type.tensor_type.shape.dim]
+    if len(dims) != 4 or dims[-1] != 3:
+        raise ValueError(f"Expected a NHWC input with 3 channels, {graph_input.name} is {dims}")
+
+    name = graph_input.name
+    uint8_input = helper.make_tensor_value_info(name + "_uint8", TensorProto.UINT8, dims[:3] + [channels])
+    graph.initializer.extend([numpy_helper.from_array(INPUT_SCALE, name + "_scale"),
+                              numpy_helper.from_array(INPUT_OFFSET, name + "_offset")])
+    nodes = [
+        helper.make_node("Cast", [name + "_uint8"], [name + "_float"], to=TensorProto.FLOAT),
+        helper.make_node("Mul", [name + "_float", name + "_scale"], [name + "_scaled"]),
+        # the original input name now comes out of the normalization, the rest of the graph is untouched
+        helper.make_node("Sub", [name + "_scaled", name + "_offset"], [name]),
+    ]
+    for node in reversed(nodes):
+        graph.node.insert(0, node)
+    graph.input.remove(graph_input)
+    graph.input.insert(0, uint8_input)
+    onnx.checker.check_model(model)
+    onnx.save(model, out_path)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Fold the input mean/std normalization into an onnx model with a uint8 input.')
+    parser.add_argument('--model_path', type=str, required=True, help='float32 NHWC onnx model')
+    parser.add_argument('--output', type=str, required=True, help='onnx model with the uint8 input')
+    parser.add_argument('--input_format', type=str, default='gray', choices=('gray', 'uint8'), help='gray for a single channel input, uint8 for 3 channels')
+    args = parser.parse_args()
+
+    fold_input_normalization(args.model_path, args.output, 1 if args.input_format == 'gray' else 3)
+    print(f"Saved {args.output}")
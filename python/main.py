@@ -1,142 +1,343 @@
 from py_utils.utils import load_config
 import argparse
-from py_utils.process_manager import ProcessManager
-from py_utils.utils import utm_to_latlon, AAIR
-import os
+from py_utils.process_manager import ProcessManager, add_retrieval_args
+from py_utils.faiss_index import add_index_args
+from py_utils.coordinates import CoordinateConverter, LATLON_OUTPUT_TYPES
 import time
-from py_utils.pre_process import pre_process
+from py_utils.pre_process import PreProcessor, IMG_SIZE, yaw_offsets
+from py_utils.pipeline import FramePacket, Stage, Pipeline
+from py_utils.attitude_buffer import AttitudeBuffer
+from py_utils.inference_pool import add_inference_args
+from py_utils.metrics import metrics, MetricsExporter
+from py_utils.image_saver import ImageSaver, SAVE_FORMATS
+from py_utils.camera import FrameGrabber
+from py_utils.telemetry import TelemetryReceiver, push_packets
+from py_utils.position_output import PositionOutput, COORD_UTM, COORD_LATLON
+from py_utils.scheduler import FrameScheduler
+from py_utils.tracker import FIX_NAMES
+from py_utils.session import Session, SessionRecorder, ReplayGrabber, PacketReplayer
 import numpy as np
 from py_utils.logger_config import configure_logging, logger
 import socket
-import cv2
-from ctypes import sizeof, memmove, addressof
 import threading
-import queue
+
+T_START = time.monotonic()
 
 
 class CameraAndAttitudeCapture:
-    def __init__(self, args):
+    def __init__(self, args, grabber=None, recorder=None):
         self.jbSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.jbSocket.bind((args.ip, args.port))
-        self.cap = cv2.VideoCapture(args.camera_index)
-        self.img_save = args.img_save
-        self.save_path = args.save_path
-        if not self.cap.isOpened():
-            logger.error("Unable to open camera.")
-        self.g_air = AAIR()
-        
+        # 后台线程持续取帧, 只保留最新的一帧
+        if grabber is None:
+            grabber = FrameGrabber(args.camera_source or args.camera_index, args.camera_width, args.camera_height,
+                                   args.camera_fps, args.camera_fourcc, args.camera_buffer_size).start()
+        self.grabber = grabber
+        self.recorder = recorder
+
+    def start_receiver(self, attitude_buffer):
+        """receive, validate and publish the AAIR packets in a background thread"""
+        return TelemetryReceiver(self.jbSocket, attitude_buffer, self.recorder).start()
+
     def capture_image(self):
-        ret, frame = self.cap.read()
-        if not ret:
-            logger.error("Failed to read data from camera")
-        timestamp = time.strftime("%Y%m%d-%H%M%S", time.localtime())
-        filename = f"capture_{timestamp}.jpg"
-        logger.debug((f"img: {filename}"))
-        if self.img_save:
-            cv2.imwrite(os.path.join(self.save_path, filename), frame)
-        return frame
-
-    def receive_attitude_data(self):
-        try:
-            # 接收姿态数据
-            recv_data, _ = self.jbSocket.recvfrom(sizeof(AAIR))
-            memmove(addressof(self.g_air), recv_data, sizeof(AAIR))
-            # 校验数据包
-            if self.g_air.start0 != 0x55 or self.g_air.start1 != 0xAA or self.g_air.crc != 0xFF:
-                logger.error("Received packet error")
-        except Exception as e:
-            logger.warning("Error in data packet process.")
-        attitude_info = (
-            f"Receive data: ",
-            f"start0: {hex(self.g_air.start0)}, "
-            f"start1: {hex(self.g_air.start1)}, "
-            f"length: {self.g_air.length}, "
-            f"id: {self.g_air.id}, "
-            f"time: {self.g_air.time}, "
-            f"actime: {self.g_air.actime}, "
-            f"lat: {self.g_air.lat}, "
-            f"lng: {self.g_air.lng}, "
-            f"height: {self.g_air.height}, "
-            f"yaw: {self.g_air.yaw}, "
-            f"pitch: {self.g_air.pitch}, "
-            f"roll: {self.g_air.roll}, "
-            f"angle: {self.g_air.angle}, "
-            f"crc: {hex(self.g_air.crc)}"
-        )
-        logger.info(attitude_info)
-        return [self.g_air.yaw, self.g_air.pitch, self.g_air.roll]
-
-
-def receive_data_thread(ca, data_queue):
-    while True:
-        attitude_data = ca.receive_attitude_data()
-        if not data_queue.full():
-            data_queue.put(attitude_data)
+        """newest frame and the monotonic time it was grabbed, (None, None) if there is none"""
+        t_start = time.monotonic()
+        frame, t_capture = self.grabber.read()
+        metrics.observe("capture", time.monotonic() - t_start)
+        if frame is not None and self.recorder is not None:
+            self.recorder.add_frame(frame, t_capture)
+        return frame, t_capture
+
+
+def attitude_prior(attitude_data, converter):
+    """utm position prior from the AAIR lat/lng, None if the autopilot has no fix"""
+    lat, lng = attitude_data[3], attitude_data[4]
+    if not (np.isfinite(lat) and np.isfinite(lng)) or (lat == 0 and lng == 0):
+        return None
+    return converter.latlon_to_utm(lat, lng)
+
+
+def queued_frames(pipeline):
+    return sum(len(stage.queue) for stage in pipeline.stages)
+
+
+def capture_data_thread(ca, pipeline, attitude_buffer, args, saver=None, scheduler=None):
+    seq = 0
+    attitude_seq = 0
+    # 相机一直运行, 回放的图像放完后结束
+    while not ca.grabber.stopped:
+        # 等待新的姿态数据, 不再忙等
+        new_seq = attitude_buffer.wait_newer(attitude_seq, timeout=1.0)
+        if new_seq == attitude_seq:
+            continue
+        attitude_seq = new_seq
+
+        # 捕获图像, 用图像时间戳插值得到对应的姿态, 交给流水线处理
+        frame, t_capture = ca.capture_image()
+        if frame is None:
+            continue
+        attitude_buffer.wait_until(t_capture, args.max_attitude_wait)
+        attitude_data = attitude_buffer.interpolate(t_capture)
+        # 画面和姿态变化不大时不重复定位, 过载时按调度策略丢帧
+        if scheduler is not None and not scheduler.admit(frame, attitude_data, t_capture, queued_frames(pipeline)):
+            continue
+        if saver is not None and args.img_save_content == "frame":
+            saver.submit(frame, seq)
+        pipeline.submit(FramePacket(seq, frame, attitude_data, t_capture))
+        seq += 1
+
+
+def replay_session(session, pipeline, attitude_buffer, args, saver=None, scheduler=None):
+    """feed a recorded session as fast as the first stage takes it, into a lossless pipeline
+    (see build_pipeline). Attitudes are interpolated on the recorded clock, so the result
+    does not depend on the replay speed or on how fast the backend is"""
+    packets, packet_times = session.attitude_packets()
+    next_packet = 0
+    for seq in range(len(session)):
+        t_frame = session.frame_times[seq]
+        end = np.searchsorted(packet_times, t_frame + args.max_attitude_wait, side='right')
+        push_packets(attitude_buffer, packets[next_packet:end], packet_times[next_packet:end])
+        next_packet = max(next_packet, end)
+        frame = session.frame(seq)
+        attitude_data = attitude_buffer.interpolate(t_frame)
+        # 按录制的时间调度, 不会因为积压丢帧
+        if scheduler is not None and not scheduler.admit(frame, attitude_data, t_frame):
+            continue
+        if saver is not None and args.img_save_content == "frame":
+            saver.submit(frame, seq)
+        # 不丢帧, 流水线满时submit会等第一级有空位
+        pipeline.submit(FramePacket(seq, frame, attitude_data, t_frame=t_frame))
+
+
+def build_pipeline(pm, args, sink=None, saver=None, position_output=None, scheduler=None, lossless=False):
+    """pre_process -> NPU inference -> faiss search and conversion, each stage runs in its own threads,
+    the positions are sent to the autopilot by position_output as soon as they come out.
+    A lossless pipeline (fast replay) blocks instead of dropping frames and ignores max_frame_latency"""
+    local = threading.local()
+    first_position = threading.Event()
+    converter = CoordinateConverter(args.zone_number, args.zone_letter)
+    offsets = yaw_offsets(args.yaw_hypotheses, np.radians(args.yaw_spread))
+    batch_size = len(offsets) if args.yaw_batch_size <= 0 else min(args.yaw_batch_size, len(offsets))
+    # a preprocessed buffer stays in use until the infer stage is done with it,
+    # or the search stage when it infers the remaining yaw hypotheses itself
+    num_buffers = args.pipeline_queue_size + args.infer_workers + 2
+    if batch_size < len(offsets):
+        num_buffers += args.pipeline_queue_size + args.search_workers
+
+    def preprocess_stage(packet):
+        if not hasattr(local, "pre_processor"):
+            local.pre_processor = PreProcessor(num_buffers=num_buffers, input_format=args.input_format, batch_size=len(offsets))
+        # the crop is saved from the warp the model input is made of, the frame is warped once
+        save_crop = saver is not None and args.img_save_content == "crop"
+        if len(offsets) > 1:
+            crop = np.empty(IMG_SIZE[::-1] + (3,), dtype=np.uint8) if save_crop else None
+            packet.input_data = local.pre_processor.normalize_hypotheses(packet.frame, packet.attitude, offsets, crop)
         else:
-            # 如果队列已满，丢弃最早的数据，只保留最新的数据
-            data_queue.get()
-            data_queue.put(attitude_data)
-
-
-def process_data_thread(ca, pm, args, data_queue):
-    while True:
-        if not data_queue.empty():
-            # 只处理最新的数据
-            while not data_queue.empty():
-                attitude_data = data_queue.get()
-            
-            # 捕获图像
-            frame = ca.capture_image()
-            input_data = pre_process(frame, attitude_data)
-            # input_data = cv2.resize(input_data, (512, 512))
-            input_data = np.expand_dims(input_data, 0)
-            position = pm.model_inference(input_data)
-            if args.output_type == "lonlat":
-                position = utm_to_latlon(position, zone_number=args.zone_number, zone_letter=args.zone_letter)
-
-            logger.info("Position: {}".format(position))
-        
+            warped = local.pre_processor.warp(packet.frame, packet.attitude)
+            crop = warped.copy() if save_crop else None
+            packet.input_data = np.expand_dims(local.pre_processor.normalize(warped), 0)
+        if save_crop:
+            saver.submit(crop, packet.seq)
+        packet.frame = None
+        return packet
 
+    def infer_stage(packet):
+        if len(offsets) > 1:
+            packet.features = pm.infer_batch(packet.input_data[:batch_size])
+        else:
+            packet.features = pm.infer(packet.input_data)
+        return packet
 
-def main():
-    config_path = '/home/xujg/code/UAV-VisionLoc-Deploy/config.yaml'
-    config = load_config(config_path)
-    configure_logging(config)
+    def search_stage(packet):
+        prior = attitude_prior(packet.attitude, converter)
+        if len(offsets) > 1:
+            position, packet.distance, packet.status, _ = pm.locate_hypotheses(packet.features, packet.input_data, prior, packet.t_frame,
+                                                                batch_size, args.yaw_early_exit)
+        else:
+            position, packet.distance, packet.status = pm.locate(packet.features, prior, packet.t_frame)
+        if position is None:
+            # the index returned no candidate at all, nothing to send
+            logger.warning("No fix for frame {}".format(packet.seq))
+            return None
+        if args.output_type in LATLON_OUTPUT_TYPES:
+            t_start = time.monotonic()
+            position = converter.utm_to_latlon(position)
+            metrics.observe("convert", time.monotonic() - t_start)
+        packet.position = position
+        return packet
 
+    def output(packet):
+        if position_output is not None:
+            position_output.send(packet.seq, packet.position, packet.distance, packet.attitude, packet.t_capture, packet.status)
+        if scheduler is not None:
+            scheduler.on_result(packet.distance, packet.t_frame)
+        if not first_position.is_set():
+            first_position.set()
+            metrics.observe("first_position", time.monotonic() - T_START)
+            logger.info("First position {:.2f} s after start".format(time.monotonic() - T_START))
+        logger.info("Position: {} ({}, distance {:.4f})".format(packet.position, FIX_NAMES[packet.status], packet.distance))
+
+    stages = [
+        Stage("preprocess", preprocess_stage, args.preprocess_workers, args.pipeline_queue_size),
+        Stage("infer", infer_stage, args.infer_workers, args.pipeline_queue_size),
+        Stage("search", search_stage, args.search_workers, args.pipeline_queue_size),
+    ]
+    return Pipeline(stages, sink or output, args.max_frame_latency, lossless=lossless)
+
+
+def build_parser(config):
     parser = argparse.ArgumentParser(description='Process some integers.')
     parser.add_argument('--model_path', type=str, default=config["model_path"], help='Model path, could be .pt or .rknn file')
     parser.add_argument('--img_save', action='store_true', default=config["img_save"], help='Save the result')
     parser.add_argument('--save_path', default=config["save_path"], help='Path to save the result')
+    parser.add_argument('--img_save_format', type=str, default=config['img_save_format'], choices=SAVE_FORMATS, help='Saved image format, jpg, png or raw (.npy).')
+    parser.add_argument('--img_save_quality', type=int, default=config['img_save_quality'], help='JPEG quality of saved images.')
+    parser.add_argument('--img_save_content', type=str, default=config['img_save_content'], choices=["frame", "crop"], help='Save the full camera frame or only the 512x512 attitude corrected crop.')
+    parser.add_argument('--img_save_every', type=int, default=config['img_save_every'], help='Save every Nth frame.')
+    parser.add_argument('--img_save_max_mb', type=int, default=config['img_save_max_mb'], help='Disk budget of save_path (MB), the oldest images are deleted beyond it.')
+    parser.add_argument('--img_save_queue', type=int, default=config['img_save_queue'], help='Images waiting to be written, the oldest is dropped when full.')
+    parser.add_argument('--img_save_workers', type=int, default=config['img_save_workers'], help='Image writer threads.')
     parser.add_argument('--path_local_database', type=str, default=config["path_local_database"], help='Path to load local features and utms of the database')
-    parser.add_argument('--features_dim', type=int, default=4096, help='NetVLAD output dims.')
+    add_retrieval_args(parser, config)
+    parser.add_argument('--pca_dims', type=int, default=config['pca_dims'], help='Project descriptors to this many dims with PCA whitening before the search, 0 to search the raw descriptors.')
     parser.add_argument('--zone_number', type=int, default=config['utm_zone_number'], help='zone number of utm.')
     parser.add_argument('--zone_letter', type=str, default=config['utm_zone_letter'], help='zone letter of utm.')
-    parser.add_argument('--output_type', type=str, default=config['output_type'], help='output type.')
+    parser.add_argument('--output_type', type=str, default=config['output_type'], choices=("utm",) + LATLON_OUTPUT_TYPES, help='output type, utm or latlon.')
     parser.add_argument('--ip', type=str, default=config['ip'], help='ip')
     parser.add_argument('--port', type=int, default=config['port'], help='port')
     parser.add_argument('--camera_index', type=int, default=config['camera_index'], help='camera index')
-    # parser.add_argument('--recall_values', type=int, default=[1, 5, 10, 20], nargs="+", help='Recalls to be computed, such as R@5.')
-    parser.add_argument('--recall_values', type=int, default=[1], nargs="+", help='Recalls to be computed, such as R@5.')
-    parser.add_argument('--use_best_n', type=int, default=1, help='Calculate the position from weighted averaged best n. If n = 1, then it is equivalent to top 1')
+    parser.add_argument('--camera_source', type=str, default=config['camera_source'], help='Video file or image folder played back instead of the camera, empty to use camera_index.')
+    parser.add_argument('--camera_width', type=int, default=config['camera_width'], help='Capture width, 0 for the driver default.')
+    parser.add_argument('--camera_height', type=int, default=config['camera_height'], help='Capture height, 0 for the driver default.')
+    parser.add_argument('--camera_fps', type=float, default=config['camera_fps'], help='Capture frame rate (also the playback rate of camera_source), 0 for the default.')
+    parser.add_argument('--camera_fourcc', type=str, default=config['camera_fourcc'], help='V4L2 pixel format such as MJPG or YUYV, empty for the driver default.')
+    parser.add_argument('--camera_buffer_size', type=int, default=config['camera_buffer_size'], help='Driver buffers, 1 keeps the queue as short as possible.')
+    add_index_args(parser, config)
+    parser.add_argument('--prior_radius', type=float, default=config['prior_radius'], help='Search radius (meters) around the GPS/INS prior, 0 to always search the whole map.')
+    parser.add_argument('--grid_cell_size', type=float, default=config['grid_cell_size'], help='Cell size (meters) of the spatial grid over database utms.')
+    parser.add_argument('--gate_max_distance', type=float, default=config['gate_max_distance'], help='Fall back to global search if the best distance near the prior is larger, 0 to disable.')
+    parser.add_argument('--track_history', type=int, default=config['track_history'], help='Frames whose top-k are accumulated by the sequence matching, 0 to localize every frame independently.')
+    parser.add_argument('--track_window_min', type=float, default=config['track_window_min'], help='Smallest search radius (meters) around the predicted track.')
+    parser.add_argument('--track_window_max', type=float, default=config['track_window_max'], help='Largest search radius (meters) around the predicted track.')
+    parser.add_argument('--track_window_sigma', type=float, default=config['track_window_sigma'], help='Search radius in standard deviations of the predicted position.')
+    parser.add_argument('--track_max_score', type=float, default=config['track_max_score'], help='Re-localize globally when the accumulated sequence distance is larger, 0 to never drop the track.')
+    parser.add_argument('--track_match_radius', type=float, default=config['track_match_radius'], help='Distance (meters) within which candidates of consecutive frames agree.')
+    parser.add_argument('--track_process_noise', type=float, default=config['track_process_noise'], help='Acceleration noise (m/s^2) of the constant velocity model.')
+    parser.add_argument('--track_measurement_noise', type=float, default=config['track_measurement_noise'], help='Position noise (meters) of a single fix.')
+    parser.add_argument('--track_max_misses', type=int, default=config['track_max_misses'], help='Consecutive outliers before the track restarts on them.')
+    parser.add_argument('--track_gate_sigma', type=float, default=config['track_gate_sigma'], help='Fixes farther than this many standard deviations from the prediction are outliers, at most the window radius.')
+    parser.add_argument('--tile_cache_mb', type=int, default=config['tile_cache_mb'], help='Memory budget (MB) of the tiles kept loaded when path_local_database is a tiled database.')
+    parser.add_argument('--tile_prefetch_seconds', type=float, default=config['tile_prefetch_seconds'], help='Prefetch the tiles where the track will be this many seconds ahead.')
+    parser.add_argument('--tile_global_tiles', type=int, default=config['tile_global_tiles'], help='Tiles searched by a search without a prior, picked by their k-means summary, 0 to disable it.')
+    parser.add_argument('--yaw_hypotheses', type=int, default=config['yaw_hypotheses'], help='Crops per frame warped with yaws around the reported one and searched together, 1 to trust the AAIR yaw.')
+    parser.add_argument('--yaw_spread', type=float, default=config['yaw_spread'], help='Largest yaw offset (degrees) of the hypotheses.')
+    parser.add_argument('--yaw_batch_size', type=int, default=config['yaw_batch_size'], help='Hypotheses inferred and searched per batch, 0 for all of them in one batch.')
+    parser.add_argument('--yaw_early_exit', type=float, default=config['yaw_early_exit'], help='Stop trying hypotheses once a best distance is at most this, 0 to always try them all.')
+    add_inference_args(parser, config)
+    parser.add_argument('--pipeline_queue_size', type=int, default=config['pipeline_queue_size'], help='Frames buffered in front of each pipeline stage, the oldest is dropped when full.')
+    parser.add_argument('--preprocess_workers', type=int, default=config['preprocess_workers'], help='Threads of the pre_process stage.')
+    parser.add_argument('--infer_workers', type=int, default=config['infer_workers'], help='Threads of the inference stage.')
+    parser.add_argument('--search_workers', type=int, default=config['search_workers'], help='Threads of the faiss search stage.')
+    parser.add_argument('--attitude_buffer_size', type=int, default=config['attitude_buffer_size'], help='Attitude samples kept for interpolation.')
+    parser.add_argument('--attitude_time_scale', type=float, default=config['attitude_time_scale'], help='Seconds per unit of the AAIR time field.')
+    parser.add_argument('--use_packet_time', action='store_true', default=config['use_packet_time'], help='Align attitude with the AAIR time field instead of the receive time.')
+    parser.add_argument('--max_attitude_wait', type=float, default=config['max_attitude_wait'], help='Seconds to wait for an attitude sample newer than the frame before holding the latest one.')
+    parser.add_argument('--max_frame_latency', type=float, default=config['max_frame_latency'], help='Frames older than this (seconds) are dropped, 0 to disable.')
+    parser.add_argument('--sched_enabled', action='store_true', default=config['sched_enabled'], help='Localize only the frames that differ from the last localized one, within a rate budget.')
+    parser.add_argument('--sched_max_rate', type=float, default=config['sched_max_rate'], help='Most frames localized per second, 0 for no budget.')
+    parser.add_argument('--sched_max_interval', type=float, default=config['sched_max_interval'], help='Localize a frame at least this often (seconds) while there is no confident fix.')
+    parser.add_argument('--sched_min_change', type=float, default=config['sched_min_change'], help='Mean absolute change (0..1) of the 32x32 thumbnail that makes a frame worth localizing.')
+    parser.add_argument('--sched_min_angle', type=float, default=config['sched_min_angle'], help='Attitude change (radians) that makes a frame worth localizing.')
+    parser.add_argument('--sched_min_move', type=float, default=config['sched_min_move'], help='Autopilot position change, in units of the height, that makes a frame worth localizing.')
+    parser.add_argument('--sched_confident_distance', type=float, default=config['sched_confident_distance'], help='A fix with a best distance at most this is confident.')
+    parser.add_argument('--sched_max_queued', type=int, default=config['sched_max_queued'], help='Shed new frames while this many are waiting in the pipeline.')
+    parser.add_argument('--sched_thermal_path', type=str, default=config['sched_thermal_path'], help='Temperature file (millidegrees C) that halves the rate budget above sched_thermal_limit, empty to ignore.')
+    parser.add_argument('--sched_thermal_limit', type=float, default=config['sched_thermal_limit'], help='Temperature (C) above which the rate budget is halved.')
+    parser.add_argument('--record_path', type=str, default=config['record_path'], help='Record the frames and AAIR packets used into this h5 file (or a new file in this folder), empty to disable.')
+    parser.add_argument('--record_quality', type=int, default=config['record_quality'], help='JPEG quality of recorded frames.')
+    parser.add_argument('--replay', type=str, default=config['replay'], help='Replay a recorded session instead of the camera and the autopilot.')
+    parser.add_argument('--replay_speed', type=float, default=config['replay_speed'], help='1 replays in real time, 2 twice as fast, 0 as fast as the pipeline goes.')
+    parser.add_argument('--position_udp', type=str, default=config['position_udp'], help='host:port every position is sent to as a binary VLOC packet, empty to disable.')
+    parser.add_argument('--position_shm', type=str, default=config['position_shm'], help='Name of a shared memory ring the VLOC packets are also written to, empty to disable.')
+    parser.add_argument('--position_shm_slots', type=int, default=config['position_shm_slots'], help='Packets kept in the shared memory ring.')
+    parser.add_argument('--position_max_rate', type=float, default=config['position_max_rate'], help='Most positions sent per second, 0 for no limit.')
+    parser.add_argument('--metrics_path', type=str, default=config['metrics_path'], help='Text file the metrics are written to, empty to disable.')
+    parser.add_argument('--metrics_udp', type=str, default=config['metrics_udp'], help='host:port the metrics are sent to as JSON, empty to disable.')
+    parser.add_argument('--metrics_interval', type=float, default=config['metrics_interval'], help='Seconds between metrics exports.')
+    return parser
+
+
+def main():
+    config_path = '/home/xujg/code/UAV-VisionLoc-Deploy/config.yaml'
+    config = load_config(config_path)
+    configure_logging(config)
+
+    args = build_parser(config).parse_args()
+
+    exporter = MetricsExporter(metrics, args.metrics_path, args.metrics_udp, args.metrics_interval)
+    exporter.start()
+
+    recorder = SessionRecorder(args.record_path, args.record_quality) if args.record_path else None
+    session = Session(args.replay) if args.replay else None
 
-    args = parser.parse_args()
+    # 数据库/索引和模型在后台并行加载, 同时打开socket和相机
+    pm = ProcessManager(args, wait=False)
+    attitude_buffer = AttitudeBuffer(args.attitude_buffer_size, args.attitude_time_scale, args.use_packet_time)
+    ca = None
+    if session is None:
+        ca = CameraAndAttitudeCapture(args, recorder=recorder)
+        # 启动接收数据的线程
+        ca.start_receiver(attitude_buffer)
 
-    pm = ProcessManager(args)
-    ca = CameraAndAttitudeCapture(args)
+    # 后台保存图像
+    saver = None
+    if args.img_save:
+        saver = ImageSaver(args.save_path, args.img_save_format, args.img_save_quality, args.img_save_every,
+                           args.img_save_max_mb, args.img_save_queue, args.img_save_workers)
 
-    data_queue = queue.Queue(maxsize=10)  # 设置队列的最大容量
+    # 定位结果以二进制报文发给飞控和/或写入共享内存
+    coord = COORD_LATLON if args.output_type in LATLON_OUTPUT_TYPES else COORD_UTM
+    position_output = PositionOutput(args.position_udp, args.position_shm, args.position_shm_slots, args.position_max_rate, coord)
+    if not position_output.enabled:
+        position_output = None
 
-    # 启动接收数据的线程
-    receive_thread = threading.Thread(target=receive_data_thread, args=(ca, data_queue))
-    receive_thread.start()
+    scheduler = None
+    if args.sched_enabled:
+        scheduler = FrameScheduler(args.sched_max_rate, args.sched_max_interval, args.sched_min_change, args.sched_min_angle,
+                                   args.sched_min_move, args.sched_confident_distance, args.sched_max_queued,
+                                   args.sched_thermal_path, args.sched_thermal_limit)
 
-    # 启动处理数据的线程
-    process_thread = threading.Thread(target=process_data_thread, args=(ca, pm, args, data_queue))
-    process_thread.start()
+    # 启动处理流水线和采集图像的线程, 尽快回放时每一级都等待而不丢帧
+    fast_replay = session is not None and args.replay_speed <= 0
+    pipeline = build_pipeline(pm, args, saver=saver, position_output=position_output, scheduler=scheduler,
+                              lossless=fast_replay)
+    pm.wait_ready()
+    pipeline.start()
+    t_start = time.monotonic()
 
-    receive_thread.join()
-    process_thread.join()
+    if fast_replay:
+        # 尽快回放录制的数据, 不需要相机和socket
+        replay_session(session, pipeline, attitude_buffer, args, saver, scheduler)
+    else:
+        if session is not None:
+            # 按录制时的节奏回放: 录制的图像代替相机, 姿态报文由本地UDP发送到ip:port
+            t_start = time.monotonic() + 0.5
+            ca = CameraAndAttitudeCapture(args, ReplayGrabber(session, args.replay_speed, t_start).start())
+            ca.start_receiver(attitude_buffer)
+            PacketReplayer(session, (args.ip, args.port), args.replay_speed, t_start).start()
+        process_thread = threading.Thread(target=capture_data_thread, args=(ca, pipeline, attitude_buffer, args, saver, scheduler))
+        process_thread.start()
+        process_thread.join()
 
+    # 只有回放会走到这里
+    pipeline.stop()
+    elapsed = time.monotonic() - t_start
+    for closable in (saver, recorder, position_output):
+        if closable is not None:
+            closable.close()
+    frames_done = metrics.snapshot()["counters"].get("frames_done", 0)
+    logger.info("Replayed {} of {} frames in {:.1f} s, {:.1f} fps".format(frames_done, len(session), elapsed, frames_done / elapsed))
+    print(metrics.to_text())
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,97 @@
+import threading
+import numpy as np
+from collections import namedtuple
+from time import monotonic
+
+# the first fields keep the [yaw, pitch, roll, lat, lng, height] order used by pre_process and the prior
+AttitudeSample = namedtuple("AttitudeSample", ["yaw", "pitch", "roll", "lat", "lng", "height", "t", "t_recv", "time", "actime", "angle"])
+
+
+def _lerp_angle(a0, a1, w):
+    """interpolate radians along the shortest arc"""
+    delta = (a1 - a0 + np.pi) % (2 * np.pi) - np.pi
+    return a0 + w * delta
+
+
+class AttitudeBuffer:
+    """Ring buffer of timestamped attitude samples shared by the receive and process threads.
+
+    There is a single writer; samples are immutable tuples and a slot is replaced in
+    one step, so readers never take the lock to read, only to wait for a new sample.
+    Sample times are mapped onto the host monotonic clock: with use_packet_time the
+    autopilot `time` field (scaled by time_scale to seconds) is shifted by the smallest
+    recent receive delay, otherwise the receive time is used. The default is the receive
+    time: the AAIR `time` seen so far is a Unix time in whole seconds shared by about
+    10 packets, too coarse to align frames with.
+    """
+
+    def __init__(self, capacity=64, time_scale=1., use_packet_time=False):
+        self.capacity = capacity
+        self.time_scale = time_scale
+        self.use_packet_time = use_packet_time
+        self.ring = [None] * capacity
+        self.seq = 0
+        self.cond = threading.Condition()
+
+    def _clock_offset(self, sample_time, t_recv):
+        offset = t_recv - sample_time
+        for sample in self.ring:
+            if sample is not None and sample.time:
+                offset = min(offset, sample.t_recv - sample.time * self.time_scale)
+        return offset
+
+    def push(self, yaw, pitch, roll, lat=0., lng=0., height=0., time=0, actime=0, angle=0., t_recv=None):
+        t_recv = monotonic() if t_recv is None else t_recv
+        t = t_recv
+        if self.use_packet_time and time:
+            sample_time = time * self.time_scale
+            t = sample_time + self._clock_offset(sample_time, t_recv)
+        sample = AttitudeSample(yaw, pitch, roll, lat, lng, height, t, t_recv, time, actime, angle)
+        self.ring[self.seq % self.capacity] = sample
+        with self.cond:
+            self.seq += 1
+            self.cond.notify_all()
+        return sample
+
+    def latest(self):
+        if self.seq == 0:
+            return None
+        return self.ring[(self.seq - 1) % self.capacity]
+
+    def wait_newer(self, seq, timeout=None):
+        """block until more than seq samples were pushed, returns the current count"""
+        with self.cond:
+            if self.seq <= seq:
+                self.cond.wait_for(lambda: self.seq > seq, timeout)
+            return self.seq
+
+    def wait_until(self, t, timeout):
+        """block until a sample at or after host time t arrived, or timeout"""
+        latest = self.latest()
+        if latest is not None and latest.t >= t:
+            return True
+        with self.cond:
+            return self.cond.wait_for(lambda: self.latest() is not None and self.latest().t >= t, timeout)
+
+    def interpolate(self, t):
+        """attitude at host time t, held at the ends of the buffered range"""
+        samples = sorted((s for s in list(self.ring) if s is not None), key=lambda s: s.t)
+        if not samples:
+            return None
+        if t <= samples[0].t:
+            return samples[0]
+        if t >= samples[-1].t:
+            return samples[-1]
+        times = [s.t for s in samples]
+        i = int(np.searchsorted(times, t))
+        s0, s1 = samples[i - 1], samples[i]
+        w = (t - s0.t) / (s1.t - s0.t) if s1.t > s0.t else 1.
+        return AttitudeSample(
+            _lerp_angle(s0.yaw, s1.yaw, w),
+            s0.pitch + w * (s1.pitch - s0.pitch),
+            s0.roll + w * (s1.roll - s0.roll),
+            s0.lat + w * (s1.lat - s0.lat),
+            s0.lng + w * (s1.lng - s0.lng),
+            s0.height + w * (s1.height - s0.height),
+            t, s1.t_recv, s1.time, s1.actime, s1.angle,
+        )
@@ -0,0 +1,138 @@
+import os
+import threading
+import cv2
+from time import monotonic, sleep
+from .logger_config import logger
+from .metrics import metrics
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+class FrameGrabber:
+    """Grabs frames continuously in its own thread and keeps only the newest one.
+
+    The device is drained as fast as it delivers, so read() never returns a frame that
+    sat in the driver queue, and decoding happens off the capture thread. source is a
+    camera index (opened with V4L2 and the requested size/fps/FOURCC/buffer count, 0 or
+    "" leaves the driver default), a video file, or a folder of images; files are played
+    back at `fps` (a video's own rate if 0) and looped, as a drop-in for flight tests.
+    """
+
+    def __init__(self, source, width=0, height=0, fps=0, fourcc="", buffer_size=1):
+        self.source = source
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.fourcc = fourcc
+        self.buffer_size = buffer_size
+        self.cap = None
+        self.images = None
+        self.frame = None
+        self.t_capture = None
+        self.seq = 0
+        self.read_seq = 0
+        self.cond = threading.Condition()
+        self.stopped = False
+        self._open()
+        self.thread = threading.Thread(target=self._run, name="frame-grabber", daemon=True)
+
+    def _open(self):
+        if isinstance(self.source, int) or str(self.source).isdigit():
+            self.cap = cv2.VideoCapture(int(self.source), cv2.CAP_V4L2)
+            if self.fourcc:
+                self.cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*self.fourcc))
+            if self.width and self.height:
+                self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, self.width)
+                self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self.height)
+            if self.fps:
+                self.cap.set(cv2.CAP_PROP_FPS, self.fps)
+            if self.buffer_size:
+                self.cap.set(cv2.CAP_PROP_BUFFERSIZE, self.buffer_size)
+            self.interval = 0.
+        elif os.path.isdir(self.source):
+            self.images = sorted(os.path.join(self.source, name) for name in os.listdir(self.source)
+                                 if name.lower().endswith(IMAGE_EXTENSIONS))
+            if not self.images:
+                logger.error("No images in {}".format(self.source))
+            self.interval = 1. / (self.fps or 10.)
+            return
+        else:
+            self.cap = cv2.VideoCapture(self.source)
+            self.interval = 1. / (self.fps or self.cap.get(cv2.CAP_PROP_FPS) or 30.)
+        if not self.cap.isOpened():
+            logger.error("Unable to open camera.")
+            return
+        logger.info("Capture {}: {:.0f}x{:.0f} @ {:.1f} fps".format(
+            self.source, self.cap.get(cv2.CAP_PROP_FRAME_WIDTH), self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT),
+            self.cap.get(cv2.CAP_PROP_FPS)))
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _grab(self, index):
+        """next frame and its capture time, frame None on failure, both None at the end of the stream"""
+        if self.images is not None:
+            if not self.images:
+                return None, monotonic()
+            return cv2.imread(self.images[index % len(self.images)]), monotonic()
+        ok = self.cap.grab()
+        t_capture = monotonic()
+        if not ok and self.interval > 0:
+            # end of the video file, start over
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ok = self.cap.grab()
+            t_capture = monotonic()
+        if not ok:
+            return None, t_capture
+        ok, frame = self.cap.retrieve()
+        return (frame if ok else None), t_capture
+
+    def _run(self):
+        index = 0
+        t_next = monotonic()
+        while not self.stopped:
+            frame, t_capture = self._grab(index)
+            index += 1
+            if frame is None and t_capture is None:
+                # end of a replayed stream
+                with self.cond:
+                    self.stopped = True
+                    self.cond.notify_all()
+                return
+            if frame is None:
+                metrics.inc("camera_errors")
+                logger.error("Failed to read data from camera")
+                sleep(0.1)
+                continue
+            with self.cond:
+                if self.seq > self.read_seq:
+                    metrics.inc("frames_skipped")
+                self.frame, self.t_capture = frame, t_capture
+                self.seq += 1
+                self.cond.notify_all()
+            metrics.inc("frames_grabbed")
+            if self.interval > 0:
+                # files are paced like a live camera
+                t_next = max(t_next + self.interval, monotonic() - self.interval)
+                sleep(max(0., t_next - monotonic()))
+
+    def read(self, timeout=1.):
+        """newest frame not returned yet and its capture time on the monotonic clock,
+        waits up to timeout for one; (None, None) if the source delivers nothing"""
+        with self.cond:
+            if self.seq == self.read_seq:
+                self.cond.wait_for(lambda: self.seq > self.read_seq or self.stopped, timeout)
+            if self.seq == self.read_seq:
+                return None, None
+            self.read_seq = self.seq
+            return self.frame, self.t_capture
+
+    def release(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        if self.thread.is_alive():
+            self.thread.join()
+        if self.cap is not None:
+            self.cap.release()
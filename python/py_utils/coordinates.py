@@ -0,0 +1,41 @@
+import numpy as np
+import pyproj
+from functools import lru_cache
+
+LATLON_OUTPUT_TYPES = ("latlon", "lonlat")  # README documents "latlon", older configs use "lonlat"
+
+
+def utm_epsg(zone_number, zone_letter):
+    """EPSG code of the WGS84 UTM zone, letters from N upwards are the northern hemisphere"""
+    return (32600 if zone_letter.upper() >= 'N' else 32700) + int(zone_number)
+
+
+@lru_cache(maxsize=None)
+def _transformer(zone_number, zone_letter, to_utm):
+    """transformers are expensive to build, keep one per zone and direction"""
+    utm = pyproj.CRS.from_epsg(utm_epsg(zone_number, zone_letter))
+    wgs84 = pyproj.CRS.from_epsg(4326)
+    if to_utm:
+        return pyproj.Transformer.from_crs(wgs84, utm, always_xy=True)
+    return pyproj.Transformer.from_crs(utm, wgs84, always_xy=True)
+
+
+class CoordinateConverter:
+    """UTM <-> WGS84 lat/lon for one zone, for single points or whole arrays in one call"""
+
+    def __init__(self, zone_number, zone_letter):
+        self.zone_number = zone_number
+        self.zone_letter = zone_letter
+        self.to_latlon = _transformer(zone_number, zone_letter, False)
+        self.to_utm = _transformer(zone_number, zone_letter, True)
+
+    def utm_to_latlon(self, utms):
+        """(..., 2) easting, northing -> (..., 2) lat, lon"""
+        utms = np.asarray(utms, dtype=np.float64)
+        lon, lat = self.to_latlon.transform(utms[..., 0], utms[..., 1])
+        return np.stack([lat, lon], axis=-1)
+
+    def latlon_to_utm(self, lat, lon):
+        """lat, lon scalars or arrays -> (..., 2) easting, northing"""
+        easting, northing = self.to_utm.transform(np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64))
+        return np.stack([easting, northing], axis=-1)
@@ -0,0 +1,176 @@
+import os
+import json
+import h5py
+import numpy as np
+from .logger_config import logger
+
+FEATURE_DTYPES = ("float16", "int8")
+TILES_META = "tiles.json"
+
+
+class CompactFeatures:
+    """read only view over memory-mapped float16/int8 database features, rows are returned as float32"""
+
+    def __init__(self, codes, scales=None):
+        self.codes = codes
+        self.scales = scales
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + (0 if self.scales is None else self.scales.nbytes)
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    def __getitem__(self, key):
+        rows = self.codes[key].astype(np.float32)
+        if self.scales is not None:
+            rows *= self.scales[key][..., np.newaxis]
+        return rows
+
+
+def is_compact_database(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, "meta.json"))
+
+
+def is_tiled_database(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, TILES_META))
+
+
+def load_database(path):
+    """return (database_features, database_utms), compact databases are memory-mapped instead of read"""
+    if is_compact_database(path):
+        with open(os.path.join(path, "meta.json"), 'r') as f:
+            meta = json.load(f)
+        codes = np.load(os.path.join(path, "features.npy"), mmap_mode='r')
+        scales = None
+        if meta["dtype"] == "int8":
+            scales = np.load(os.path.join(path, "scales.npy"), mmap_mode='r')
+        utms = np.load(os.path.join(path, "utms.npy"), mmap_mode='r')
+        return CompactFeatures(codes, scales), utms
+    with h5py.File(path, 'r') as hf:
+        return hf['database_features'][:], hf['database_utms'][:]
+
+
+def load_database_utms(path):
+    """database_utms only, without reading the features"""
+    if is_compact_database(path):
+        return np.load(os.path.join(path, "utms.npy"), mmap_mode='r')
+    with h5py.File(path, 'r') as hf:
+        return hf['database_utms'][:]
+
+
+def database_signature(path):
+    """size and modification time of the files a database is read from, changes whenever it is rewritten"""
+    if os.path.isdir(path):
+        files = [os.path.join(path, name) for name in ("features.npy", "scales.npy", "utms.npy")]
+    else:
+        files = [path]
+    signature = {}
+    for file in files:
+        if os.path.exists(file):
+            stat = os.stat(file)
+            signature[os.path.basename(file)] = [stat.st_size, stat.st_mtime_ns]
+    return signature
+
+
+def quantize_int8(features):
+    """symmetric per-vector int8 quantization, features ~= codes * scales[:, None]"""
+    scales = np.max(np.abs(features), axis=1) / 127.
+    scales[scales == 0] = 1.
+    codes = np.rint(features / scales[:, np.newaxis]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def convert_database(h5_path, out_path, dtype="float16", chunk_size=4096):
+    """convert database_features.h5 into the compact memory-mappable layout:
+    out_path/features.npy, (scales.npy), utms.npy and meta.json"""
+    if dtype not in FEATURE_DTYPES:
+        raise ValueError(f"Unknown feature dtype: {dtype}, expected one of {FEATURE_DTYPES}")
+    os.makedirs(out_path, exist_ok=True)
+    with h5py.File(h5_path, 'r') as hf:
+        features_ds = hf['database_features']
+        num, dim = features_ds.shape
+        codes = np.lib.format.open_memmap(os.path.join(out_path, "features.npy"), mode='w+', dtype=dtype, shape=(num, dim))
+        scales = None
+        if dtype == "int8":
+            scales = np.lib.format.open_memmap(os.path.join(out_path, "scales.npy"), mode='w+', dtype=np.float32, shape=(num,))
+        for start in range(0, num, chunk_size):
+            end = min(start + chunk_size, num)
+            chunk = features_ds[start:end].astype(np.float32)
+            if dtype == "int8":
+                codes[start:end], scales[start:end] = quantize_int8(chunk)
+            else:
+                codes[start:end] = chunk.astype(np.float16)
+        codes.flush()
+        if scales is not None:
+            scales.flush()
+        np.save(os.path.join(out_path, "utms.npy"), np.ascontiguousarray(hf['database_utms'][:]))
+    with open(os.path.join(out_path, "meta.json"), 'w') as f:
+        json.dump({"dtype": dtype, "num": int(num), "dim": int(dim), "source": os.path.abspath(h5_path)}, f, indent=2)
+    logger.info("Converted {} ({} x {}) to {} as {}".format(h5_path, num, dim, out_path, dtype))
+
+
+def tile_dirname(key):
+    return "tile_{}_{}".format(*key)
+
+
+def tile_database(h5_path, out_path, tile_size=1000., dtype="float16", chunk_size=4096):
+    """split database_features.h5 into square tiles of tile_size meters on the UTM grid:
+    out_path/tiles.json, out_path/utms.npy (every row, in tile order) and one compact
+    database (see convert_database) per tile in out_path/tile_<x>_<y>"""
+    if dtype not in FEATURE_DTYPES:
+        raise ValueError(f"Unknown feature dtype: {dtype}, expected one of {FEATURE_DTYPES}")
+    os.makedirs(out_path, exist_ok=True)
+    with h5py.File(h5_path, 'r') as hf:
+        features_ds = hf['database_features']
+        num, dim = features_ds.shape
+        utms = hf['database_utms'][:]
+        cells = np.floor(utms[:, :2] / tile_size).astype(np.int64)
+        keys, tile_of_row, counts = np.unique(cells, axis=0, return_inverse=True, return_counts=True)
+        tile_of_row = tile_of_row.reshape(-1)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        # rows keep their database order inside a tile
+        order = np.argsort(tile_of_row, kind="stable")
+        local_row = np.empty(num, dtype=np.int64)
+        local_row[order] = np.arange(num) - starts[tile_of_row[order]]
+
+        tiles = []
+        for i, key in enumerate(keys.tolist()):
+            tile_path = os.path.join(out_path, tile_dirname(key))
+            os.makedirs(tile_path, exist_ok=True)
+            np.lib.format.open_memmap(os.path.join(tile_path, "features.npy"), mode='w+', dtype=dtype, shape=(int(counts[i]), dim))
+            if dtype == "int8":
+                np.lib.format.open_memmap(os.path.join(tile_path, "scales.npy"), mode='w+', dtype=np.float32, shape=(int(counts[i]),))
+            np.save(os.path.join(tile_path, "utms.npy"), np.ascontiguousarray(utms[order[starts[i]:starts[i] + counts[i]]]))
+            with open(os.path.join(tile_path, "meta.json"), 'w') as f:
+                json.dump({"dtype": dtype, "num": int(counts[i]), "dim": int(dim), "source": os.path.abspath(h5_path)}, f, indent=2)
+            tiles.append({"key": key, "path": tile_dirname(key), "start": int(starts[i]), "num": int(counts[i])})
+
+        # stream the source once, scattering every chunk into the tiles it touches
+        for start in range(0, num, chunk_size):
+            end = min(start + chunk_size, num)
+            chunk = features_ds[start:end].astype(np.float32)
+            chunk_tiles = tile_of_row[start:end]
+            for i in np.unique(chunk_tiles):
+                rows = np.flatnonzero(chunk_tiles == i)
+                tile_path = os.path.join(out_path, tiles[i]["path"])
+                codes = np.load(os.path.join(tile_path, "features.npy"), mmap_mode='r+')
+                if dtype == "int8":
+                    scales = np.load(os.path.join(tile_path, "scales.npy"), mmap_mode='r+')
+                    codes[local_row[start + rows]], scales[local_row[start + rows]] = quantize_int8(chunk[rows])
+                    scales.flush()
+                else:
+                    codes[local_row[start + rows]] = chunk[rows].astype(np.float16)
+                codes.flush()
+                del codes
+
+    np.save(os.path.join(out_path, "utms.npy"), np.ascontiguousarray(utms[order]))
+    with open(os.path.join(out_path, TILES_META), 'w') as f:
+        json.dump({"dtype": dtype, "num": int(num), "dim": int(dim), "tile_size": float(tile_size),
+                   "source": os.path.abspath(h5_path), "tiles": tiles}, f, indent=2)
+    logger.info("Split {} ({} x {}) into {} tiles of {} m in {}".format(h5_path, num, dim, len(tiles), tile_size, out_path))
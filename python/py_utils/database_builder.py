@@ -0,0 +1,161 @@
+import os
+import cv2
+import h5py
+import numpy as np
+from tqdm import tqdm
+from .pre_process import PreProcessor, IMG_SIZE
+from .evaluation import imap_prefetched
+from .utils import img_check
+from .logger_config import logger
+
+COMPRESSIONS = ("none", "gzip", "lzf")
+NAME_DTYPE = h5py.string_dtype()
+
+_h5_files = {}
+_pre_processors = {}
+
+
+def parse_utm(name):
+    """(easting, northing) of a path/to/@utm_easting@utm_northing@...@.jpg name, None if it has none"""
+    fields = os.path.basename(name).split("@")
+    try:
+        return float(fields[1]), float(fields[2])
+    except (IndexError, ValueError):
+        return None
+
+
+class ImageSource:
+    """Database images, a folder of image files or an h5 file with image_data and image_name
+    (like the queries h5). Names are the file paths relative to the folder or the h5 image
+    names, they must follow the @utm_easting@utm_northing@ convention and identify the
+    images in the built database, so a later run knows which ones are already there."""
+
+    def __init__(self, path):
+        self.path = path
+        self.is_h5 = os.path.isfile(path)
+        if self.is_h5:
+            with h5py.File(path, "r") as hf:
+                names = [name.decode("UTF-8") for name in hf["image_name"][:]]
+        else:
+            names = sorted(os.path.relpath(os.path.join(root, name), path)
+                           for root, _, files in os.walk(path) for name in files if img_check(name))
+        self.names, self.rows, utms = [], [], []
+        seen = set()
+        for row, name in enumerate(names):
+            utm = parse_utm(name)
+            if utm is None:
+                logger.warning("No utm in image name {}, skipped".format(name))
+                continue
+            if name in seen:
+                continue
+            seen.add(name)
+            self.names.append(name)
+            self.rows.append(row)
+            utms.append(utm)
+        self.utms = np.array(utms, dtype=np.float64).reshape(-1, 2)
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def color_order(self):
+        # h5 images are RGB, files are read by OpenCV as BGR
+        return "rgb" if self.is_h5 else "bgr"
+
+    def items(self, indices):
+        """what read_images needs to find the given images: h5 rows or file names"""
+        return [self.rows[i] if self.is_h5 else self.names[i] for i in indices]
+
+
+def read_images(path, items):
+    """uint8 images of h5 rows or of files relative to the folder path, resized to the model input when needed"""
+    if isinstance(items[0], str):
+        images = [cv2.imread(os.path.join(path, name)) for name in items]
+    else:
+        if path not in _h5_files:
+            _h5_files[path] = h5py.File(path, "r")
+        # one contiguous read, the images of a chunk are next to each other in the h5
+        block = _h5_files[path]["image_data"][min(items):max(items) + 1]
+        images = [block[row - min(items)] for row in items]
+    for i, image in enumerate(images):
+        if image is None:
+            raise OSError("Failed to read {}".format(os.path.join(path, items[i])))
+        if image.shape[1::-1] != IMG_SIZE:
+            images[i] = cv2.resize(image, IMG_SIZE, interpolation=cv2.INTER_AREA)
+    return images
+
+
+def _preprocess_images(path, indices, items, color_order, contrast_factor=3, input_format="float32"):
+    """read and preprocess the images of a chunk, runs inside the worker processes"""
+    # one per setting, a pool worker may serve builds with different ones
+    key = (contrast_factor, color_order, input_format)
+    if key not in _pre_processors:
+        _pre_processors[key] = PreProcessor(contrast_factor=contrast_factor, color_order=color_order, input_format=input_format)
+    pre_processor = _pre_processors[key]
+    images = read_images(path, items)
+    processed = np.empty((len(images),) + pre_processor.buffers[0].shape, dtype=pre_processor.buffers[0].dtype)
+    for i, image in enumerate(images):
+        pre_processor.normalize(image, out=processed[i])
+    return indices, processed
+
+
+def _open_database(out_path, features_dim, compression="none"):
+    """database h5 opened for appending, with the rows of an interrupted run dropped"""
+    hf = h5py.File(out_path, "a")
+    if "database_features" not in hf:
+        # about 1 MB chunks, large enough for gzip and for reading the whole database back
+        chunk_rows = max(1, 2 ** 20 // (features_dim * 4))
+        options = {} if compression == "none" else {"compression": compression}
+        hf.create_dataset("database_features", (0, features_dim), maxshape=(None, features_dim),
+                          chunks=(chunk_rows, features_dim), dtype=np.float32, **options)
+        hf.create_dataset("database_utms", (0, 2), maxshape=(None, 2), chunks=(4096, 2), dtype=np.float64)
+        hf.create_dataset("database_names", (0,), maxshape=(None,), chunks=(4096,), dtype=NAME_DTYPE)
+        hf.attrs["num_done"] = 0
+    elif "database_names" not in hf:
+        hf.close()
+        raise ValueError("{} has no database_names, it was not built by build_database and cannot be appended to".format(out_path))
+    elif hf["database_features"].shape[1] != features_dim:
+        dim = hf["database_features"].shape[1]
+        hf.close()
+        raise ValueError("{} has {} dims features, not {}".format(out_path, dim, features_dim))
+    num_done = int(hf.attrs["num_done"])
+    for name in ("database_features", "database_utms", "database_names"):
+        if hf[name].shape[0] != num_done:
+            logger.warning("Dropping {} rows of {} written by an interrupted run".format(hf[name].shape[0] - num_done, name))
+            hf[name].resize(num_done, axis=0)
+    return hf
+
+
+def build_database(source, out_path, pool, features_dim, workers=4, chunk_size=16, prefetch=2,
+                   contrast_factor=3, compression="none", input_format="float32"):
+    """Extract the features of the source images that are not in out_path yet and append them.
+
+    Chunks of images are read and preprocessed in a process pool while the inference pool
+    works on the previous ones; every chunk is written and flushed as soon as its features
+    are back, and the num_done attribute only counts rows that made it to disk. Running it
+    again after an interruption, or with a source that has new images, extracts only the
+    missing ones. Returns the number of images added.
+    """
+    hf = _open_database(out_path, features_dim, compression)
+    try:
+        done = set(name.decode("UTF-8") for name in hf["database_names"][:])
+        todo = [i for i, name in enumerate(source.names) if name not in done]
+        logger.info("{} images in {}, {} already in {}, {} to extract".format(
+            len(source), source.path, len(source) - len(todo), out_path, len(todo)))
+        chunks = [todo[start:start + chunk_size] for start in range(0, len(todo), chunk_size)]
+        tasks = [(source.path, indices, source.items(indices), source.color_order, contrast_factor, input_format) for indices in chunks]
+        features_dataset, utms_dataset, names_dataset = hf["database_features"], hf["database_utms"], hf["database_names"]
+        num_done = features_dataset.shape[0]
+        for indices, processed in tqdm(imap_prefetched(_preprocess_images, tasks, workers, prefetch), total=len(tasks), ncols=100):
+            features = pool.run_batch(processed)
+            end = num_done + len(indices)
+            for dataset, rows in ((features_dataset, features),
+                                  (utms_dataset, source.utms[indices]),
+                                  (names_dataset, [source.names[i] for i in indices])):
+                dataset.resize(end, axis=0)
+                dataset[num_done:end] = rows
+            hf.attrs["num_done"] = num_done = end
+            hf.flush()
+        return len(todo)
+    finally:
+        hf.close()
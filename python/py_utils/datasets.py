@@ -1,7 +1,7 @@
 
-import cv2
 import numpy as np
 import h5py
+from .pre_process import PreProcessor
 
 class QueriesDatasetOpencv:
     """Dataset with images from database and queries, used for inference (testing and building cache)."""
@@ -27,6 +27,10 @@ class QueriesDatasetOpencv:
              for path in self.queries_paths]
         ).astype(np.float32)
 
+        # h5 row of every query, lets callers read image_data in contiguous chunks
+        self.queries_h5_rows = np.array([self.queries_name_dict[path] for path in self.queries_paths], dtype=np.int64)
+        self.queries_h5_num_rows = len(queries_folder_h5_df["image_name"])
+
         # Add database, queries prefix
         for i in range(len(self.queries_paths)):
             self.queries_paths[i] = "queries_" + self.queries_paths[i]
@@ -36,17 +40,29 @@ class QueriesDatasetOpencv:
         # Close h5 and initialize for h5 reading in __getitem__
         self.queries_folder_h5_df = None
         queries_folder_h5_df.close()
+        # h5 images are RGB, same engine as the online pre_process
+        self.pre_processor = PreProcessor(color_order="rgb")
 
     def __getitem__(self, index):
         # Init
         if self.queries_folder_h5_df is None:
             self.queries_folder_h5_df = h5py.File(self.queries_folder_h5_path, "r")
-        img = self.opencv_process(self._find_img_in_h5(index), contrast_factor=3)
+        # copied out of the shared PreProcessor buffer, callers such as a DataLoader keep the items
+        img = self.opencv_process(self._find_img_in_h5(index), contrast_factor=3).copy()
         return img, index
 
     def __len__(self):
         return len(self.queries_paths)
 
+    def chunk_ranges(self, chunk_size):
+        """contiguous (start, end) h5 row ranges covering every query, and the query index
+        of each h5 row (-1 for duplicated rows that are not used)"""
+        row_to_query = np.full(self.queries_h5_num_rows, -1, dtype=np.int64)
+        row_to_query[self.queries_h5_rows] = np.arange(self.queries_num)
+        first, last = self.queries_h5_rows.min(), self.queries_h5_rows.max() + 1
+        ranges = [(start, min(start + chunk_size, last)) for start in range(first, last, chunk_size)]
+        return ranges, row_to_query
+
     def _find_img_in_h5(self, index, database_queries_split=None):
         # Find inside index for h5
         if database_queries_split is None:
@@ -58,26 +74,5 @@ class QueriesDatasetOpencv:
         return img
 
     def opencv_process(self, image, contrast_factor):
-        # image = cv2.imread(img_path, cv2.IMREAD_GRAYSCALE)
-        image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
-
-        img_float = image.astype(np.float32) / 255.0
-        
-        mean = np.mean(img_float)
-        
-        image = mean + contrast_factor * (img_float - mean)
-        
-        # image = np.clip(image, 0, 255)
-        image = np.clip(image, 0, 1)
-        image = np.repeat(image[:, :, np.newaxis], 3, axis=2)
-
-        mean = np.array([0.485, 0.456, 0.406])
-        std = np.array([0.229, 0.224, 0.225])
-        image_rgb = (image - mean) / std
-        image_rgb = image_rgb.astype(np.float32)
-
-        # 转换为 (C, H, W) 
-        # return image_rgb.transpose(2, 0, 1)
-
-        return image_rgb
-
+        self.pre_processor.contrast_factor = contrast_factor
+        return self.pre_processor.normalize(image)
@@ -0,0 +1,92 @@
+import h5py
+import numpy as np
+from collections import deque
+from multiprocessing import Pool
+from tqdm import tqdm
+from .pre_process import PreProcessor
+
+_h5_files = {}
+_pre_processor = None
+
+
+def _preprocess_rows(h5_path, start, end, contrast_factor=3, input_format="float32"):
+    """read h5 rows [start, end) and preprocess them, runs inside the worker processes"""
+    global _pre_processor
+    if _pre_processor is None or _pre_processor.input_format != input_format:
+        _pre_processor = PreProcessor(contrast_factor=contrast_factor, color_order="rgb", input_format=input_format)
+    if h5_path not in _h5_files:
+        _h5_files[h5_path] = h5py.File(h5_path, "r")
+    images = _h5_files[h5_path]["image_data"][start:end]
+    processed = np.empty((len(images),) + _pre_processor.buffers[0].shape, dtype=_pre_processor.buffers[0].dtype)
+    for i, image in enumerate(images):
+        _pre_processor.normalize(image, out=processed[i])
+    return start, end, processed
+
+
+def imap_prefetched(func, tasks, workers=4, prefetch=2):
+    """func(*task) for every task in order, run in a process pool with up to prefetch * workers
+    tasks in flight (in this process if workers is 0)"""
+    if workers <= 0:
+        for task in tasks:
+            yield func(*task)
+        return
+    with Pool(workers) as process_pool:
+        pending = deque()
+        for task in tasks:
+            pending.append(process_pool.apply_async(func, task))
+            if len(pending) >= prefetch * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def extract_queries_features(queries_dataset, pool, features_dim, workers=4, chunk_size=16, prefetch=2, input_format="float32"):
+    """features of every query: chunked h5 reads and preprocessing in a process pool,
+    with up to prefetch * workers chunks in flight, then batched inference on the pool"""
+    queries_features = np.empty((queries_dataset.queries_num, features_dim), dtype=np.float32)
+    ranges, row_to_query = queries_dataset.chunk_ranges(chunk_size)
+    h5_path = queries_dataset.queries_folder_h5_path
+
+    for start, end, processed in tqdm(imap_prefetched(_preprocess_rows, [(h5_path, start, end, 3, input_format) for start, end in ranges],
+                                                      workers, prefetch), total=len(ranges), ncols=100):
+        query_indices = row_to_query[start:end]
+        used = query_indices >= 0
+        if np.any(used):
+            queries_features[query_indices[used]] = pool.run_batch(processed[used])
+    return queries_features
+
+
+def compute_recalls(predictions, database_utms, queries_utms, recall_values, positive_dist_threshold=60):
+    """recall@N in percentages, a prediction is positive if it lies within
+    positive_dist_threshold meters of the query, computed for all queries at once;
+    missing predictions (-1) are misses"""
+    k = max(recall_values)
+    predictions = predictions[:, :k]
+    predicted_utms = np.asarray(database_utms)[np.maximum(predictions, 0)]
+    dist2 = np.sum(np.square(predicted_utms - np.asarray(queries_utms)[:, np.newaxis, :2]), axis=2)
+    # hit_at[q, n] is True if any of the first n + 1 predictions of query q is positive
+    hit_at = np.logical_or.accumulate((dist2 <= positive_dist_threshold ** 2) & (predictions >= 0), axis=1)
+    return np.array([hit_at[:, n - 1].mean() * 100 for n in recall_values])
+
+
+def recalls_from_positives(predictions, positives, recall_values):
+    """recall@N in percentages against precomputed positives, (ids, offsets) with the database
+    ids of query q in ids[offsets[q]:offsets[q + 1]]; missing predictions (-1) are misses"""
+    ids, offsets = positives
+    k = max(recall_values)
+    predictions = predictions[:, :k]
+    num_queries = predictions.shape[0]
+    # one key per (query, database id) pair, so a single isin checks every prediction
+    stride = int(max(predictions.max(initial=0), ids.max(initial=0))) + 1
+    positive_keys = np.repeat(np.arange(num_queries, dtype=np.int64), np.diff(offsets)) * stride + ids
+    keys = np.arange(num_queries, dtype=np.int64)[:, np.newaxis] * stride + predictions
+    hit_at = np.logical_or.accumulate(np.isin(keys, positive_keys) & (predictions >= 0), axis=1)
+    return np.array([hit_at[:, n - 1].mean() * 100 for n in recall_values])
+
+def add_evaluation_args(parser):
+    """query set options shared by eval.py and tune.py"""
+    parser.add_argument('--queries_h5', type=str, default='/home/xujg/code/UAV-VisionLoc/data/queries/test_sample.h5', help='h5 file of the query images')
+    parser.add_argument('--positive_dist_threshold', type=float, default=60, help='A prediction within this distance (meters) of the query counts as positive.')
+    parser.add_argument('--workers', type=int, default=4, help='Preprocessing processes, 0 to preprocess in the main process.')
+    parser.add_argument('--chunk_size', type=int, default=16, help='Query images read from h5 and preprocessed per task.')
+    parser.add_argument('--prefetch', type=int, default=2, help='Chunks in flight per preprocessing process.')
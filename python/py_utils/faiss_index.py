@@ -0,0 +1,171 @@
+import os
+import json
+import faiss
+import numpy as np
+from time import time
+from .database import database_signature
+from .logger_config import logger
+
+INDEX_TYPES = ("flat", "sq_fp16", "sq8", "ivf_flat", "ivf_pq", "hnsw")
+# map flat codes and IVF lists instead of reading them, IO_FLAG_MMAP_IFC needs faiss >= 1.10
+MMAP_FLAGS = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+
+
+def _nlist(args, num_vectors):
+    """number of IVF lists, 0 means the faiss rule of thumb of about 4 * sqrt(N)"""
+    nlist = args.nlist or max(1, int(4 * np.sqrt(num_vectors)))
+    return min(nlist, num_vectors)
+
+
+def index_key(args, num_vectors):
+    """short name describing the index type and its build parameters"""
+    index_type = args.index_type
+    if index_type in ("flat", "sq_fp16", "sq8"):
+        return index_type
+    if index_type == "ivf_flat":
+        return f"ivf_flat_nlist{_nlist(args, num_vectors)}"
+    if index_type == "ivf_pq":
+        return f"ivf_pq_nlist{_nlist(args, num_vectors)}_m{args.pq_m}x{args.pq_nbits}"
+    if index_type == "hnsw":
+        return f"hnsw_m{args.hnsw_m}_efc{args.ef_construction}"
+    raise ValueError(f"Unknown index type: {index_type}, expected one of {INDEX_TYPES}")
+
+
+def index_factory_string(args, num_vectors):
+    """translate the index options into a faiss index_factory description"""
+    index_type = args.index_type
+    if index_type == "flat":
+        return "Flat"
+    if index_type == "sq_fp16":
+        return "SQfp16"
+    if index_type == "sq8":
+        return "SQ8"
+    if index_type in ("ivf_flat", "ivf_pq"):
+        nlist = _nlist(args, num_vectors)
+        if index_type == "ivf_flat":
+            return f"IVF{nlist},Flat"
+        return f"IVF{nlist},PQ{args.pq_m}x{args.pq_nbits}"
+    if index_type == "hnsw":
+        return f"HNSW{args.hnsw_m}"
+    raise ValueError(f"Unknown index type: {index_type}, expected one of {INDEX_TYPES}")
+
+
+def index_path(args, num_vectors, database_path=None):
+    """trained indexes are stored next to the database, e.g. database_features.ivf_flat_nlist1024.index"""
+    root, _ = os.path.splitext(database_path or args.path_local_database)
+    return f"{root}.{index_key(args, num_vectors)}.index"
+
+
+def set_search_params(index, args):
+    """apply the query time knobs (nprobe for IVF, efSearch for HNSW)"""
+    params = faiss.ParameterSpace()
+    if args.index_type in ("ivf_flat", "ivf_pq"):
+        params.set_index_parameter(index, "nprobe", args.nprobe)
+    elif args.index_type == "hnsw":
+        params.set_index_parameter(index, "efSearch", args.ef_search)
+
+
+def build_index(features, args, max_train=100000, chunk_size=16384):
+    """build (and train if needed) the index described by args over features,
+    features can be a numpy array or memory-mapped CompactFeatures"""
+    num_vectors, dim = features.shape
+    description = index_factory_string(args, num_vectors)
+    logger.debug("build faiss index {} over {} vectors...".format(description, num_vectors))
+    t_start = time()
+    index = faiss.index_factory(dim, description, faiss.METRIC_L2)
+    if args.index_type == "hnsw":
+        index.hnsw.efConstruction = args.ef_construction
+    if not index.is_trained:
+        if num_vectors > max_train:
+            rng = np.random.default_rng(1234)
+            train_ids = np.sort(rng.choice(num_vectors, max_train, replace=False))
+            train_features = features[train_ids]
+        else:
+            train_features = features
+        index.train(np.ascontiguousarray(train_features, dtype=np.float32))
+    # add in chunks so compact databases are never expanded to float32 as a whole
+    for start in range(0, num_vectors, chunk_size):
+        index.add(np.ascontiguousarray(features[start:start + chunk_size], dtype=np.float32))
+    logger.debug("build faiss index time: {:.4f} s".format(time() - t_start))
+    return index
+
+
+def _snapshot_meta(args, database_path, num_vectors):
+    database_path = database_path or args.path_local_database
+    return {"index": index_key(args, num_vectors), "database": os.path.abspath(database_path),
+            "signature": database_signature(database_path)}
+
+
+def load_index_snapshot(args, num_vectors, database_path=None):
+    """index saved by save_index_snapshot, None if there is none or the database changed since.
+    With args.index_mmap the vectors stay in the file and are paged in on demand."""
+    path = index_path(args, num_vectors, database_path)
+    if not os.path.exists(path) or not os.path.exists(path + ".json"):
+        return None
+    with open(path + ".json", 'r') as f:
+        meta = json.load(f)
+    if meta != _snapshot_meta(args, database_path, num_vectors):
+        logger.warning("Index {} is older than the database, rebuilding.".format(path))
+        return None
+    logger.debug("load faiss index from {}".format(path))
+    t_start = time()
+    index = None
+    if args.index_mmap:
+        try:
+            index = faiss.read_index(path, MMAP_FLAGS)
+        except RuntimeError as e:
+            logger.warning("Unable to memory-map {}, reading it: {}".format(path, e))
+    if index is None:
+        index = faiss.read_index(path)
+    if index.ntotal != num_vectors:
+        logger.warning("Index {} does not match the database, rebuilding.".format(path))
+        return None
+    logger.debug("load faiss index time: {:.4f} s".format(time() - t_start))
+    set_search_params(index, args)
+    return index
+
+
+def save_index_snapshot(index, args, database_path=None):
+    """serialize index next to the database, with the database signature it was built from"""
+    path = index_path(args, index.ntotal, database_path)
+    try:
+        faiss.write_index(index, path)
+        with open(path + ".json", 'w') as f:
+            json.dump(_snapshot_meta(args, database_path, index.ntotal), f, indent=2)
+        logger.debug("faiss index saved to {}".format(path))
+    except (RuntimeError, OSError) as e:
+        logger.warning("Unable to save faiss index to {}: {}".format(path, e))
+
+
+def flat_vectors(index):
+    """(ntotal, d) float32 view of the vectors of a flat index, None for other index types.
+    The view is only valid while index is alive."""
+    if not isinstance(index, faiss.IndexFlat):
+        return None
+    return faiss.rev_swig_ptr(index.get_xb(), index.ntotal * index.d).reshape(index.ntotal, index.d)
+
+
+def load_or_build_index(features, args, database_path=None):
+    """load the index snapshot of the database (args.path_local_database unless database_path
+    is given, such as one tile of a tiled database), otherwise build it and save a snapshot"""
+    index = load_index_snapshot(args, features.shape[0], database_path)
+    if index is None:
+        index = build_index(features, args)
+        save_index_snapshot(index, args, database_path)
+        set_search_params(index, args)
+    return index
+
+
+def add_index_args(parser, config=None):
+    """index options shared by main.py and eval.py, defaults taken from config.yaml when given"""
+    config = config or {}
+    parser.add_argument('--index_type', type=str, default=config.get('index_type', 'flat'), choices=INDEX_TYPES, help='faiss index type.')
+    parser.add_argument('--nlist', type=int, default=config.get('nlist', 0), help='Number of IVF lists, 0 means 4 * sqrt(database size).')
+    parser.add_argument('--nprobe', type=int, default=config.get('nprobe', 16), help='Number of IVF lists visited per query.')
+    parser.add_argument('--pq_m', type=int, default=config.get('pq_m', 64), help='Number of PQ sub-quantizers, must divide features_dim.')
+    parser.add_argument('--pq_nbits', type=int, default=config.get('pq_nbits', 8), help='Bits per PQ sub-quantizer code.')
+    parser.add_argument('--hnsw_m', type=int, default=config.get('hnsw_m', 32), help='HNSW graph degree.')
+    parser.add_argument('--ef_construction', type=int, default=config.get('ef_construction', 40), help='HNSW efConstruction.')
+    parser.add_argument('--ef_search', type=int, default=config.get('ef_search', 64), help='HNSW efSearch.')
+    parser.add_argument('--index_mmap', action='store_true', default=config.get('index_mmap', True), help='Memory-map the saved index instead of reading it.')
+    parser.add_argument('--no_index_mmap', dest='index_mmap', action='store_false', help='Read the saved index into memory, overrides index_mmap: true.')
@@ -0,0 +1,124 @@
+import os
+import threading
+import cv2
+import numpy as np
+from collections import deque
+from time import time, strftime, localtime
+from .pipeline import LatestQueue
+from .logger_config import logger
+from .metrics import metrics
+
+SAVE_FORMATS = ("jpg", "png", "raw")
+
+
+class ImageSaver:
+    """Background image writer, keeps encoding and disk I/O off the localization path.
+
+    Every `every_n`-th submitted frame is queued in a bounded queue that drops the oldest
+    frame when full, and `workers` threads encode (jpg with `jpeg_quality`, png, or raw
+    .npy) and write it. Once the files in save_path exceed max_disk_mb the oldest ones
+    are deleted.
+    """
+
+    def __init__(self, save_path, fmt="jpg", jpeg_quality=90, every_n=1, max_disk_mb=2048, queue_size=8, workers=1):
+        if fmt not in SAVE_FORMATS:
+            raise ValueError(f"Unknown image format: {fmt}, expected one of {SAVE_FORMATS}")
+        self.save_path = save_path
+        self.fmt = fmt
+        self.jpeg_quality = jpeg_quality
+        self.every_n = max(1, every_n)
+        self.max_disk_bytes = max_disk_mb * 1024 * 1024
+        self.queue = LatestQueue(queue_size)
+        self.submitted = 0
+        # submit is called by every preprocess worker when the crops are saved
+        self.submit_lock = threading.Lock()
+        os.makedirs(save_path, exist_ok=True)
+        self.files, self.disk_bytes = self._scan_existing()
+        self.disk_lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._run, name=f"image-saver-{i}", daemon=True) for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def _scan_existing(self):
+        """files written by earlier runs count against the disk budget, oldest first"""
+        entries = []
+        for name in os.listdir(self.save_path):
+            path = os.path.join(self.save_path, name)
+            if name.startswith("capture_") and os.path.isfile(path):
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, path, stat.st_size))
+        entries.sort()
+        return deque((path, size) for _, path, size in entries), sum(size for _, _, size in entries)
+
+    def submit(self, img, seq, t=None):
+        """queue img for saving, returns False if it was skipped by the sampling"""
+        with self.submit_lock:
+            self.submitted += 1
+            skip = (self.submitted - 1) % self.every_n
+        if skip:
+            return False
+        if self.queue.put((img, seq, time() if t is None else t)) is not None:
+            metrics.inc("images_dropped")
+        return True
+
+    def filename(self, seq, t):
+        # millisecond timestamp plus the frame sequence number, never collides within a run
+        stamp = strftime("%Y%m%d-%H%M%S", localtime(t))
+        ext = "npy" if self.fmt == "raw" else self.fmt
+        return f"capture_{stamp}-{int(t * 1000) % 1000:03d}_{seq:06d}.{ext}"
+
+    def _encode(self, img):
+        if self.fmt == "jpg":
+            ok, data = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+        elif self.fmt == "png":
+            ok, data = cv2.imencode(".png", img, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+        else:
+            return None
+        return data if ok else None
+
+    def _write(self, img, path):
+        if self.fmt == "raw":
+            np.save(path, img)
+        else:
+            data = self._encode(img)
+            if data is None:
+                raise ValueError("image encoding failed")
+            with open(path, "wb") as f:
+                f.write(data.tobytes())
+        return os.path.getsize(path)
+
+    def _enforce_budget(self, path, size):
+        with self.disk_lock:
+            self.files.append((path, size))
+            self.disk_bytes += size
+            while self.disk_bytes > self.max_disk_bytes and len(self.files) > 1:
+                old_path, old_size = self.files.popleft()
+                self.disk_bytes -= old_size
+                try:
+                    os.remove(old_path)
+                except OSError:
+                    pass
+                metrics.inc("images_deleted")
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                if self.queue.closed:
+                    return
+                continue
+            img, seq, t = item
+            path = os.path.join(self.save_path, self.filename(seq, t))
+            try:
+                size = self._write(img, path)
+            except (OSError, ValueError) as e:
+                metrics.inc("image_save_errors")
+                logger.warning("Failed to save {}: {}".format(path, e))
+                continue
+            metrics.inc("images_saved")
+            self._enforce_budget(path, size)
+
+    def close(self):
+        self.queue.close()
+        for thread in self.threads:
+            thread.join()
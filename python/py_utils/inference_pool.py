@@ -0,0 +1,190 @@
+import queue
+import threading
+import numpy as np
+from time import sleep
+from concurrent.futures import Future
+from .pre_process import normalize_input, INPUT_FORMATS
+from .logger_config import logger
+
+BACKENDS = ("rknn", "onnx", "fake")
+
+
+class InferenceBackend:
+    """one inference runtime, run(inputs) takes a list of NHWC arrays and returns a list of outputs.
+
+    The input is either the normalized float32 image or a uint8 one (see pre_process.INPUT_FORMATS)
+    whose mean/std normalization the model has to do.
+    """
+
+    name = "backend"
+    max_batch = 1  # largest batch a single run() accepts, 0 means any
+
+    def run(self, inputs):
+        raise NotImplementedError
+
+    def release(self):
+        pass
+
+
+class RKNNBackend(InferenceBackend):
+    """RKNNLite runtime pinned to one NPU core (or a combination such as 0_1_2). uint8 inputs
+    are handed over as they are: the model has to be converted with the normalization folded
+    in (mean_values/std_values, or fold_input_normalization for a single channel input)"""
+
+    def __init__(self, model_path, core="0_1_2"):
+        from rknnlite.api import RKNNLite
+        from .rknn_executor import RKNN_model_container
+
+        core_masks = {
+            "auto": RKNNLite.NPU_CORE_AUTO,
+            "0": RKNNLite.NPU_CORE_0,
+            "1": RKNNLite.NPU_CORE_1,
+            "2": RKNNLite.NPU_CORE_2,
+            "0_1": RKNNLite.NPU_CORE_0_1,
+            "0_1_2": RKNNLite.NPU_CORE_0_1_2,
+        }
+        self.name = f"rknn-core{core}"
+        self.container = RKNN_model_container(model_path, False, core_masks[str(core)])
+
+    def run(self, inputs):
+        return self.container.run(inputs)
+
+    def release(self):
+        self.container.release()
+
+
+class OnnxBackend(InferenceBackend):
+    """ONNX Runtime on the CPU, for development off the board"""
+
+    def __init__(self, model_path, threads=1):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        # models with fold_input_normalization applied take the uint8 input directly
+        self.uint8_input = self.session.get_inputs()[0].type == "tensor(uint8)"
+        self.name = "onnx"
+
+    def run(self, inputs):
+        data = np.asarray(inputs[0])
+        if not self.uint8_input:
+            data = np.asarray(normalize_input(data), dtype=np.float32)
+        return self.session.run(None, {self.input_name: data})
+
+
+class FakeBackend(InferenceBackend):
+    """Deterministic stand-in for the NPU: a fixed random projection of the pooled input,
+    L2 normalized like NetVLAD, returned after `latency` seconds."""
+
+    max_batch = 0
+
+    def __init__(self, features_dim=4096, latency=0., seed=0, name="fake"):
+        self.features_dim = features_dim
+        self.latency = latency
+        self.projection = np.random.default_rng(seed).standard_normal((64, features_dim)).astype(np.float32)
+        self.name = name
+
+    def run(self, inputs):
+        data = np.asarray(normalize_input(np.asarray(inputs[0])), dtype=np.float32)
+        batch, height, width = data.shape[:3]
+        pooled = data[:, :height // 8 * 8, :width // 8 * 8].reshape(batch, 8, height // 8, 8, width // 8, -1).mean(axis=(2, 4, 5))
+        features = pooled.reshape(batch, 64) @ self.projection
+        features /= np.linalg.norm(features, axis=1, keepdims=True) + 1e-12
+        if self.latency > 0:
+            sleep(self.latency)
+        return [features]
+
+
+def create_backends(args):
+    """one backend per entry of args.npu_cores"""
+    if args.inference_backend == "rknn":
+        return [RKNNBackend(args.model_path, core) for core in args.npu_cores]
+    if args.inference_backend == "onnx":
+        return [OnnxBackend(args.model_path) for _ in args.npu_cores]
+    if args.inference_backend == "fake":
+        return [FakeBackend(args.features_dim, args.fake_latency, name=f"fake{i}") for i in range(len(args.npu_cores))]
+    raise ValueError(f"Unknown inference backend: {args.inference_backend}, expected one of {BACKENDS}")
+
+
+def add_inference_args(parser, config=None):
+    """inference options shared by main.py, eval.py, build_database.py and tune.py, defaults taken from config.yaml when given"""
+    config = config or {}
+    parser.add_argument('--inference_backend', type=str, default=config.get('inference_backend', 'rknn'), choices=BACKENDS, help='rknn on the board, onnx or fake to run off-board.')
+    parser.add_argument('--npu_cores', type=str, default=config.get('npu_cores', ["0", "1", "2"]), nargs="+", help='One runtime per entry, such as 0 1 2 or 0_1_2.')
+    parser.add_argument('--fake_latency', type=float, default=config.get('fake_latency', 0.), help='Latency (seconds) of the fake backend.')
+    parser.add_argument('--input_format', type=str, default=config.get('input_format', 'float32'), choices=INPUT_FORMATS, help='Model input: normalized float32, or uint8 (3 channels or gray) normalized by the model.')
+
+class InferencePool:
+    """Runs a set of backends side by side, one worker thread per backend.
+
+    submit() hands the request to the backend with the fewest requests in flight
+    (round robin between equals) and returns a concurrent.futures.Future, run()
+    keeps the blocking RKNN_model_container interface.
+    """
+
+    def __init__(self, backends):
+        self.backends = backends
+        self.queues = [queue.Queue() for _ in backends]
+        self.in_flight = [0] * len(backends)
+        self.next_backend = 0
+        self.lock = threading.Lock()
+        self.threads = []
+        for i, backend in enumerate(backends):
+            thread = threading.Thread(target=self._worker, args=(i,), name=backend.name, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def __len__(self):
+        return len(self.backends)
+
+    def _worker(self, i):
+        backend = self.backends[i]
+        while True:
+            item = self.queues[i].get()
+            if item is None:
+                return
+            inputs, future = item
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(backend.run(inputs))
+                except Exception as e:
+                    logger.exception("inference failed on {}: {}".format(backend.name, e))
+                    future.set_exception(e)
+            with self.lock:
+                self.in_flight[i] -= 1
+
+    def _pick_backend(self):
+        with self.lock:
+            n = len(self.backends)
+            order = [(self.next_backend + j) % n for j in range(n)]
+            i = min(order, key=lambda j: self.in_flight[j])
+            self.in_flight[i] += 1
+            self.next_backend = (i + 1) % n
+        return i
+
+    def submit(self, inputs):
+        if not isinstance(inputs, (list, tuple)):
+            inputs = [inputs]
+        future = Future()
+        self.queues[self._pick_backend()].put((inputs, future))
+        return future
+
+    def run(self, inputs):
+        return self.submit(inputs).result()
+
+    def run_batch(self, batch):
+        """first model output for a (N, H, W, C) batch, split into the largest batches the
+        backends accept and spread over all of them"""
+        max_batch = min(backend.max_batch or len(batch) for backend in self.backends)
+        futures = [self.submit([batch[start:start + max_batch]]) for start in range(0, len(batch), max_batch)]
+        return np.concatenate([future.result()[0] for future in futures], axis=0)
+
+    def release(self):
+        for q in self.queues:
+            q.put(None)
+        for thread in self.threads:
+            thread.join()
+        for backend in self.backends:
+            backend.release()
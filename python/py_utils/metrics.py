@@ -0,0 +1,118 @@
+import os
+import json
+import socket
+import threading
+import numpy as np
+from time import monotonic, time
+from .logger_config import logger
+
+
+class RollingHistogram:
+    """last `window` samples in a ring buffer, percentiles are only computed on export"""
+
+    def __init__(self, window=1024):
+        self.values = np.zeros(window, dtype=np.float64)
+        self.count = 0
+        self.total = 0.
+
+    def observe(self, value):
+        self.values[self.count % len(self.values)] = value
+        self.count += 1
+        self.total += value
+
+    def snapshot(self):
+        recent = self.values[:min(self.count, len(self.values))]
+        if not len(recent):
+            return {"count": 0}
+        p50, p95, p99 = np.percentile(recent, [50, 95, 99])
+        return {"count": self.count, "sum": self.total, "p50": p50, "p95": p95, "p99": p99, "max": recent.max()}
+
+
+class Metrics:
+    """process wide registry of rolling latency histograms and counters.
+
+    observe() and inc() only touch a preallocated ring or an int under a short lock,
+    everything else (percentiles, formatting, I/O) happens in the exporter thread."""
+
+    def __init__(self, window=1024):
+        self.window = window
+        self.histograms = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.t_start = monotonic()
+
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = RollingHistogram(self.window)
+            histogram.observe(seconds)
+
+    def inc(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def snapshot(self):
+        with self.lock:
+            histograms = {name: histogram.snapshot() for name, histogram in self.histograms.items()}
+            counters = dict(self.counters)
+        return {"uptime": monotonic() - self.t_start, "histograms": histograms, "counters": counters}
+
+    def to_text(self, snapshot=None):
+        """Prometheus text exposition format"""
+        snapshot = snapshot or self.snapshot()
+        lines = ["vtl_uptime_seconds {:.3f}".format(snapshot["uptime"])]
+        for name, h in sorted(snapshot["histograms"].items()):
+            lines.append('vtl_latency_seconds_count{{span="{}"}} {}'.format(name, h["count"]))
+            if h["count"]:
+                lines.append('vtl_latency_seconds_sum{{span="{}"}} {:.6f}'.format(name, h["sum"]))
+                for q, quantile in (("p50", "0.5"), ("p95", "0.95"), ("p99", "0.99"), ("max", "1")):
+                    lines.append('vtl_latency_seconds{{span="{}",quantile="{}"}} {:.6f}'.format(name, quantile, h[q]))
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append("vtl_{}_total {}".format(name, value))
+        return "\n".join(lines) + "\n"
+
+
+class MetricsExporter:
+    """writes the metrics every `interval` seconds to a text file (atomically replaced)
+    and/or sends them as one JSON datagram to a local UDP address such as 127.0.0.1:16400"""
+
+    def __init__(self, metrics, path="", udp_address="", interval=5.):
+        self.metrics = metrics
+        self.path = path
+        self.udp_address = None
+        if udp_address:
+            host, port = udp_address.rsplit(":", 1)
+            self.udp_address = (host, int(port))
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="metrics", daemon=True)
+
+    def start(self):
+        if self.path or self.udp_address:
+            self.thread.start()
+
+    def export(self):
+        snapshot = self.metrics.snapshot()
+        if self.path:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                f.write(self.metrics.to_text(snapshot))
+            os.replace(tmp_path, self.path)
+        if self.udp_address:
+            snapshot["time"] = time()
+            self.sock.sendto(json.dumps(snapshot, default=float).encode(), self.udp_address)
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.export()
+            except (OSError, ValueError) as e:
+                logger.warning("metrics export failed: {}".format(e))
+
+    def stop(self):
+        self.stop_event.set()
+
+
+metrics = Metrics()
@@ -0,0 +1,196 @@
+import threading
+from collections import deque
+from time import monotonic
+from .logger_config import logger
+from .metrics import metrics
+
+
+class FramePacket:
+    """one frame travelling through the pipeline, stages attach their results as attributes"""
+
+    def __init__(self, seq, frame, attitude, t_capture=None, t_frame=None):
+        self.seq = seq
+        self.frame = frame
+        self.attitude = attitude
+        self.t_capture = monotonic() if t_capture is None else t_capture
+        # time the frame was taken, on the recorded clock when a session is replayed
+        self.t_frame = self.t_capture if t_frame is None else t_frame
+        self.input_data = None
+        self.features = None
+        self.position = None
+        self.distance = None  # best descriptor distance of the fix
+        self.status = 0  # how the tracker produced the position, FIX_* of tracker.py
+        self.spans = {}  # stage name -> (start, end) on the monotonic clock
+
+
+class LatestQueue:
+    """bounded queue with a latest-wins policy: put drops the oldest item when full,
+    unless it is asked to block until there is room"""
+
+    def __init__(self, maxsize):
+        self.items = deque(maxlen=maxsize)
+        self.cond = threading.Condition()
+        self.closed = False
+
+    def put(self, item, block=False):
+        """returns the dropped item, if any; with block it waits for room instead (or for close)"""
+        with self.cond:
+            while block and len(self.items) == self.items.maxlen and not self.closed:
+                self.cond.wait()
+            dropped = self.items[0] if len(self.items) == self.items.maxlen else None
+            self.items.append(item)
+            # getters and blocked putters wait on the same condition
+            self.cond.notify_all()
+        return dropped
+
+    def get(self, timeout=None):
+        """oldest item, None once closed or on timeout"""
+        with self.cond:
+            if not self.items and not self.closed:
+                self.cond.wait(timeout)
+            if not self.items:
+                return None
+            item = self.items.popleft()
+            self.cond.notify_all()
+            return item
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def __len__(self):
+        return len(self.items)
+
+
+class Stage:
+    """a pipeline step run by `workers` threads reading from a bounded latest-wins queue"""
+
+    def __init__(self, name, func, workers=1, queue_size=2):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue = LatestQueue(queue_size)
+        self.dropped = 0
+        self.threads = []
+
+    def start(self, pipeline, next_stage):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, args=(pipeline, next_stage), name=f"{self.name}-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _run(self, pipeline, next_stage):
+        while True:
+            packet = self.queue.get()
+            if packet is None:
+                if self.queue.closed:
+                    return
+                continue
+            t_start = monotonic()
+            if pipeline.max_latency > 0 and t_start - packet.t_capture > pipeline.max_latency:
+                self.dropped += 1
+                metrics.inc("frames_too_old_" + self.name)
+                continue
+            if pipeline.stale(packet):
+                # a newer frame already came out (e.g. the infer workers finished out of order),
+                # finish would drop this one anyway, skip the work
+                metrics.inc("frames_out_of_order")
+                continue
+            try:
+                result = self.func(packet)
+            except Exception as e:
+                metrics.inc("stage_errors_" + self.name)
+                logger.exception("stage {} failed on frame {}: {}".format(self.name, packet.seq, e))
+                pipeline.discard(packet)
+                continue
+            t_end = monotonic()
+            packet.spans[self.name] = (t_start, t_end)
+            metrics.observe(self.name, t_end - t_start)
+            if result is None:
+                pipeline.discard(packet)
+                continue
+            if next_stage is None:
+                pipeline.finish(result)
+            elif next_stage.queue.put(result, block=pipeline.lossless) is not None:
+                next_stage.dropped += 1
+                metrics.inc("frames_dropped_" + next_stage.name)
+
+
+class Pipeline:
+    """chain of stages, frame N + 1 is processed by one stage while frame N is in the next one.
+
+    Every queue is bounded and keeps the newest frames, packets older than max_latency
+    seconds are dropped, and the sink only sees frames newer than the last one it got,
+    so per-frame latency stays bounded when a stage falls behind.
+
+    A lossless pipeline (fast replay) trades that bound for reproducible results: submit
+    and every stage block until the next queue has room, max_latency is ignored, and the
+    sink gets every frame that a stage did not reject, in submission order.
+    """
+
+    def __init__(self, stages, sink, max_latency=0., lossless=False):
+        self.stages = stages
+        self.sink = sink
+        self.lossless = lossless
+        self.max_latency = 0. if lossless else max_latency
+        self.last_seq = -1
+        self.finish_lock = threading.Lock()
+        # lossless order: packets are numbered on submit and released to the sink in that order
+        self.num_submitted = 0
+        self.next_order = 0
+        self.pending = {}
+
+    def start(self):
+        for stage, next_stage in zip(self.stages, self.stages[1:] + [None]):
+            stage.start(self, next_stage)
+
+    def submit(self, packet):
+        if self.lossless:
+            packet.order = self.num_submitted
+            self.num_submitted += 1
+        if self.stages[0].queue.put(packet, block=self.lossless) is not None:
+            self.stages[0].dropped += 1
+            metrics.inc("frames_dropped_" + self.stages[0].name)
+
+    def _release(self, packet, result):
+        """lossless: hold the result (None for a rejected frame) until the earlier frames are out"""
+        with self.finish_lock:
+            self.pending[packet.order] = result
+            while self.next_order in self.pending:
+                result = self.pending.pop(self.next_order)
+                self.next_order += 1
+                if result is not None:
+                    metrics.observe("frame", monotonic() - result.t_capture)
+                    metrics.inc("frames_done")
+                    self.sink(result)
+
+    def discard(self, packet):
+        """a stage rejected the packet, only matters to the lossless order"""
+        if self.lossless:
+            self._release(packet, None)
+
+    def stale(self, packet):
+        """True if the sink already got a newer frame, only a lossy pipeline drops it for that"""
+        return not self.lossless and packet.seq <= self.last_seq
+
+    def finish(self, packet):
+        if self.lossless:
+            self._release(packet, packet)
+            return
+        with self.finish_lock:
+            # workers may finish out of order, never go back in time
+            if packet.seq <= self.last_seq:
+                metrics.inc("frames_out_of_order")
+                return
+            self.last_seq = packet.seq
+        metrics.observe("frame", monotonic() - packet.t_capture)
+        metrics.inc("frames_done")
+        self.sink(packet)
+
+    def stop(self):
+        # one stage after the other, so the frames already in flight come out at the end
+        for stage in self.stages:
+            stage.queue.close()
+            for thread in stage.threads:
+                thread.join()
@@ -0,0 +1,135 @@
+import socket
+import threading
+import numpy as np
+from ctypes import sizeof
+from multiprocessing import shared_memory
+from time import monotonic
+from .utils import VLOC
+from .logger_config import logger
+from .metrics import metrics
+
+VLOC_ID = 152
+# VLOC coord: what x/y hold
+COORD_UTM = 0  # easting, northing in meters
+COORD_LATLON = 1  # latitude, longitude in degrees
+
+
+def encode_position(seq, position, distance, attitude, latency, status=0, coord=COORD_UTM):
+    """VLOC packet of one fix, attitude (an AttitudeSample or None) gives the autopilot time fields,
+    status is the FIX_* of tracker.py and coord the COORD_* of position"""
+    packet = VLOC()
+    packet.start0, packet.start1, packet.length, packet.id = 0x55, 0xAA, sizeof(VLOC), VLOC_ID
+    packet.seq = seq & 0xFFFFFFFF
+    if attitude is not None:
+        packet.time, packet.actime = int(attitude.time) & 0xFFFFFFFF, int(attitude.actime) & 0xFFFFFFFF
+    packet.x, packet.y = float(position[0]), float(position[1])
+    packet.distance = float(distance)
+    packet.latency = latency
+    packet.status = status
+    packet.coord = coord
+    packet.crc = 0xFF
+    return bytes(packet)
+
+
+class PositionRing:
+    """Shared memory ring of the latest VLOC packets for consumers on the same board.
+
+    Layout: one uint64 count of packets written so far, then `slots` packets of
+    sizeof(VLOC) bytes; packet n is in slot n % slots. There is a single writer, which
+    fills the slot before bumping the count, so a reader whose slot was not reached
+    again by the count while it copied it got a whole packet. Readers open the ring
+    by name with the same number of slots.
+    """
+
+    def __init__(self, name, slots=64, create=False):
+        size = 8 + slots * sizeof(VLOC)
+        if create:
+            try:
+                shared_memory.SharedMemory(name).unlink()
+            except FileNotFoundError:
+                pass
+        self.shm = shared_memory.SharedMemory(name, create=create, size=size if create else 0)
+        self.owner = create
+        self.slots = slots
+        self.count = np.ndarray((1,), dtype=np.uint64, buffer=self.shm.buf)
+        self.ring = np.ndarray((slots, sizeof(VLOC)), dtype=np.uint8, buffer=self.shm.buf, offset=8)
+        if create:
+            self.count[0] = 0
+
+    def write(self, data):
+        n = int(self.count[0])
+        self.ring[n % self.slots] = np.frombuffer(data, dtype=np.uint8)
+        self.count[0] = n + 1
+
+    def read_latest(self):
+        """(count, newest packet as a VLOC), (0, None) before the first one"""
+        while True:
+            n = int(self.count[0])
+            if n == 0:
+                return 0, None
+            data = self.ring[(n - 1) % self.slots].tobytes()
+            if int(self.count[0]) - n < self.slots - 1:
+                return n, VLOC.from_buffer_copy(data)
+
+    def close(self):
+        del self.count, self.ring
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class PositionOutput:
+    """Sends every fix as a binary VLOC packet (AAIR framing) over UDP and/or into a PositionRing.
+
+    A fix arriving less than 1 / max_rate seconds after the last one sent is dropped
+    (0 sends all of them). Sending happens on the thread that produced the fix, it is a
+    single non-blocking sendto, so there is no extra queue between the search and the
+    autopilot; the time from capture to send is recorded as the "output" latency. send
+    is serialized, so several search workers can share one output. coord (COORD_*) tells
+    the receiver what the positions are.
+    """
+
+    def __init__(self, udp_address="", shm_name="", shm_slots=64, max_rate=0., coord=COORD_UTM):
+        self.address = None
+        self.sock = None
+        if udp_address:
+            host, port = udp_address.rsplit(":", 1)
+            self.address = (host, int(port))
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.setblocking(False)
+        self.ring = PositionRing(shm_name, shm_slots, create=True) if shm_name else None
+        self.min_interval = 1. / max_rate if max_rate > 0 else 0.
+        self.coord = coord
+        self.t_last = None
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.address is not None or self.ring is not None
+
+    def send(self, seq, position, distance, attitude, t_capture, status=0):
+        """publish one fix, returns False if it was dropped by the rate limit"""
+        with self.lock:
+            t_now = monotonic()
+            if self.t_last is not None and t_now - self.t_last < self.min_interval:
+                metrics.inc("positions_rate_limited")
+                return False
+            self.t_last = t_now
+            data = encode_position(seq, position, distance, attitude, t_now - t_capture, status, self.coord)
+            if self.sock is not None:
+                try:
+                    self.sock.sendto(data, self.address)
+                except OSError as e:
+                    metrics.inc("position_send_errors")
+                    logger.warning("Failed to send position: {}".format(e))
+            if self.ring is not None:
+                self.ring.write(data)
+        metrics.inc("positions_sent")
+        metrics.observe("output", monotonic() - t_capture)
+        return True
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+        if self.ring is not None:
+            self.ring.close()
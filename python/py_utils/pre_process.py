@@ -2,6 +2,30 @@ import numpy as np
 import cv2
 from .logger_config import logger
 
+IMG_SIZE = (512, 512)  # (width, height) of the model input
+MEAN = np.array([0.485, 0.456, 0.406])
+STD = np.array([0.229, 0.224, 0.225])
+# uint8 inputs are normalized by the model (or the inference runtime) as x * INPUT_SCALE - INPUT_OFFSET,
+# the same (x / 255 - MEAN) / STD, broadcast over the 3 channels when the input has a single one
+INPUT_SCALE = (1. / (255. * STD)).astype(np.float32)
+INPUT_OFFSET = (MEAN / STD).astype(np.float32)
+INPUT_FORMATS = ("float32", "uint8", "gray")
+
+
+def yaw_offsets(num, spread):
+    """num yaw offsets (radians) within +-spread, nearest to the reported yaw first: 0, +d, -d, +2d, ..."""
+    if num <= 1:
+        return np.zeros(1)
+    step = spread / (num // 2)
+    return np.array([0.] + [sign * step * (i // 2 + 1) for i, sign in zip(range(num - 1), [1, -1] * num)])
+
+
+def normalize_input(data):
+    """float32 model input of a uint8 input, for models and runtimes that do not normalize themselves"""
+    if data.dtype != np.uint8:
+        return data
+    return data.astype(np.float32) * INPUT_SCALE - INPUT_OFFSET
+
 
 def center_crop(img, target_width=512, target_height=512):
     height, width, _ = img.shape
@@ -15,41 +39,133 @@ def euler_to_rotation_matrix(yaw, pitch, roll):
     R_z = np.array([[np.cos(yaw), -np.sin(yaw), 0], [np.sin(yaw), np.cos(yaw), 0], [0, 0, 1]])
     return np.dot(R_z, np.dot(R_y, R_x))
 
-def distort(img, at):
-    height, width = img.shape[:2]
+def attitude_homography(width, height, at):
+    """perspective transform that corrects the attitude of a width x height frame"""
     R = euler_to_rotation_matrix(at[0], at[1], at[2])
     src_points = np.array([[0, 0], [width - 1, 0], [width - 1, height - 1], [0, height - 1]], dtype='float32')
     dst_points = np.dot(src_points - np.array([width / 2, height / 2]), R[:2, :2].T) + np.array([width / 2, height / 2])
-    matrix = cv2.getPerspectiveTransform(src_points, dst_points.astype('float32'))
+    return cv2.getPerspectiveTransform(src_points, dst_points.astype('float32'))
+
+def distort(img, at):
+    height, width = img.shape[:2]
+    matrix = attitude_homography(width, height, at)
     return cv2.warpPerspective(img, matrix, (width, height))
 
+
+class PreProcessor:
+    """Single pass version of distort -> center_crop -> gray -> contrast -> normalize.
+
+    The attitude homography is composed with the crop translation so only the
+    512x512 output is warped, and contrast, clipping, channel repeat and mean/std
+    normalization are folded into a 256 entry lookup table indexed by the gray
+    level. All intermediate and output buffers are allocated once; the returned
+    array is one of `num_buffers` output buffers used in turn, so it is only valid
+    until that buffer comes round again.
+
+    input_format "float32" gives the normalized 3 channel float input. "uint8" and
+    "gray" stop after the contrast stretch and give the stretched gray level as uint8,
+    repeated on 3 channels or as a single one (4x and 12x less data); mean/std is left
+    to the model, see INPUT_SCALE and normalize_input.
+    """
+
+    def __init__(self, target_size=IMG_SIZE, contrast_factor=3, color_order="bgr", num_buffers=1, input_format="float32",
+                 batch_size=1):
+        if input_format not in INPUT_FORMATS:
+            raise ValueError(f"Unknown input format: {input_format}, expected one of {INPUT_FORMATS}")
+        self.target_width, self.target_height = target_size
+        self.contrast_factor = contrast_factor
+        self.color_code = cv2.COLOR_BGR2GRAY if color_order == "bgr" else cv2.COLOR_RGB2GRAY
+        self.input_format = input_format
+        shape = (self.target_height, self.target_width)
+        channels = 1 if input_format == "gray" else 3
+        dtype = np.float32 if input_format == "float32" else np.uint8
+        # batch_size > 1 holds the yaw hypotheses of a frame, see normalize_hypotheses
+        batch_shape = (batch_size,) if batch_size > 1 else ()
+        self.buffers = [np.empty(batch_shape + shape + (channels,), dtype=dtype) for _ in range(num_buffers)]
+        self._next_buffer = 0
+        self._warped = np.empty(shape + (3,), dtype=np.uint8)
+        self._gray = np.empty(shape, dtype=np.uint8)
+        self._levels = np.arange(256, dtype=np.float32) / np.float32(255.0)
+        self._contrast = np.empty(256, dtype=np.float32)
+        self._lut = np.empty((256, 3), dtype=np.float32)
+        self._lut_u8 = np.empty((1, 256), dtype=np.uint8)
+        self._stretched = np.empty(shape, dtype=np.uint8)
+
+    def _next_output(self):
+        out = self.buffers[self._next_buffer]
+        self._next_buffer = (self._next_buffer + 1) % len(self.buffers)
+        return out
+
+    def crop_homography(self, width, height, at):
+        """attitude homography followed by the center crop, maps the frame directly onto the output"""
+        matrix = attitude_homography(width, height, at)
+        shift = np.array([[1, 0, -(width // 2 - self.target_width // 2)],
+                          [0, 1, -(height // 2 - self.target_height // 2)],
+                          [0, 0, 1]], dtype=np.float64)
+        return shift @ matrix
+
+    def warp(self, img, at=None):
+        """attitude corrected center crop of img as uint8, no full frame is ever warped"""
+        height, width = img.shape[:2]
+        if at is None or not np.any(at[:3]):
+            # identity attitude, the crop is a plain view
+            return center_crop(img, self.target_width, self.target_height)
+        matrix = self.crop_homography(width, height, at)
+        return cv2.warpPerspective(img, matrix, (self.target_width, self.target_height), dst=self._warped)
+
+    def normalize(self, img, out=None):
+        """gray, contrast stretch and (for float32) mean/std normalization of a target sized uint8 image"""
+        if img.shape[0] != self.target_height or img.shape[1] != self.target_width:
+            logger.error("input size error.")
+        if out is None:
+            out = self._next_output()
+        gray = cv2.cvtColor(img, self.color_code, dst=self._gray)
+        mean = np.float32(cv2.mean(gray)[0] / 255.0)
+        # lut[g] = (clip(mean + c * (g / 255 - mean), 0, 1) - MEAN) / STD for every channel
+        np.subtract(self._levels, mean, out=self._contrast)
+        self._contrast *= self.contrast_factor
+        self._contrast += mean
+        np.clip(self._contrast, 0, 1, out=self._contrast)
+        if self.input_format == "float32":
+            self._lut[:] = (self._contrast[:, np.newaxis] - MEAN) / STD
+            np.take(self._lut, gray, axis=0, out=out)
+            return out
+        np.rint(self._contrast * 255, out=self._lut_u8[0], casting="unsafe")
+        if self.input_format == "gray":
+            cv2.LUT(gray, self._lut_u8, dst=out[:, :, 0])
+        else:
+            cv2.cvtColor(cv2.LUT(gray, self._lut_u8, dst=self._stretched), cv2.COLOR_GRAY2RGB, dst=out)
+        return out
+
+    def normalize_hypotheses(self, img, at, yaw_offsets, crop=None):
+        """(len(yaw_offsets), H, W, C) batch of the crops of img warped with each yaw offset
+        (radians) added to the attitude yaw, needs a PreProcessor with that batch_size.
+        The uint8 crop of the first hypothesis is also copied into crop when it is given."""
+        out = self._next_output()
+        yaw, pitch, roll = at[:3] if at is not None else (0., 0., 0.)
+        for i, offset in enumerate(yaw_offsets):
+            warped = self.warp(img, [yaw + offset, pitch, roll])
+            if i == 0 and crop is not None:
+                np.copyto(crop, warped)
+            self.normalize(warped, out=out[i])
+        return out
+
+    def __call__(self, img, at=None, out=None):
+        return self.normalize(self.warp(img, at), out)
+
+
+_pre_processor = None
+
 def pre_process(data, at=[0., 0., 0.]):
 
+    global _pre_processor
+    if _pre_processor is None:
+        _pre_processor = PreProcessor()
     if isinstance(data, np.ndarray):
         img = data
     elif isinstance(data, str):
         img = cv2.imread(data)
         at = list(map(np.float32, data.split("@")[3:6]))
-    at_info = (
-        f"yaw: {at[0]}, "
-        f"pitch: {at[1]}, "
-        f"roll: {at[2]}, "
-    )
-    logger.debug(at_info)
-    img = distort(img, at)
-    img = center_crop(img)
-    if img.shape[0] != 512 or img.shape[1] != 512:
-        logger.error("input size error.")
-    img_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    img_float = img_gray.astype(np.float32) / 255.0
-    mean = np.mean(img_float)
-    img_contrast = mean + 3 * (img_float - mean)
-    img_clipped = np.clip(img_contrast, 0, 1)
-    img_rgb = np.repeat(img_clipped[:, :, np.newaxis], 3, axis=2)
-    mean = np.array([0.485, 0.456, 0.406])
-    std = np.array([0.229, 0.224, 0.225])
-    img_normalized = (img_rgb - mean) / std
-    return img_normalized.astype(np.float32)
-
-
-
+    logger.opt(lazy=True).debug("yaw: {}, pitch: {}, roll: {}", lambda: at[0], lambda: at[1], lambda: at[2])
+    # a fresh array per call, the PreProcessor buffer is overwritten by the next one
+    return _pre_processor(img, at).copy()
@@ -1,76 +1,313 @@
 import os
-import h5py
 import faiss
 import numpy as np
 import sys
-from time import time
-from py_utils.rknn_executor import RKNN_model_container 
+import threading
+from time import monotonic
+from .inference_pool import InferencePool, create_backends
+from .faiss_index import build_index, load_index_snapshot, save_index_snapshot, set_search_params, flat_vectors
+from .spatial_index import GridIndex
+from .tracker import Tracker, FIX_SINGLE
+from .database import load_database, load_database_utms, is_compact_database, is_tiled_database
+from .tiles import TiledDatabase
+from .projection import load_or_fit_projection, project
 from .logger_config import logger
+from .metrics import metrics
+
+# relative difference of best distances under which yaw hypotheses are considered equally good
+YAW_TIE_MARGIN = 0.02
+
+
+def weighted_position(distance, prediction, sort_idx, database_utms, use_best_n=1):
+    """utm of the best prediction, or the average of the best use_best_n weighted by a gaussian
+    of their distance to the best one, sigma being the ratio of the best to the worst distance.
+    Missing predictions (-1, returned by IVF/HNSW indexes that visited too few vectors) are
+    left out, None if there is no prediction at all"""
+
+    sort_idx = np.asarray(sort_idx)[np.asarray(prediction)[sort_idx] >= 0]
+    if len(sort_idx) == 0:
+        return None
+    if use_best_n == 1:
+        return database_utms[prediction[sort_idx[0]]]
+    if distance[sort_idx[0]] == 0:
+        return database_utms[prediction[sort_idx[0]]]
+
+    mean = distance[sort_idx[0]]
+    sigma = distance[sort_idx[0]] / distance[sort_idx[-1]]
+    X = np.array(distance[sort_idx[:use_best_n]]).reshape((-1,))
+    weights = np.exp(-np.square(X - mean) / (2 * sigma ** 2))
+    weights /= np.sum(weights)
+    return np.average(database_utms[prediction[sort_idx[:use_best_n]]], axis=0, weights=weights)
+
+
+def add_retrieval_args(parser, config=None):
+    """retrieval options shared by main.py, eval.py and tune.py, defaults taken from config.yaml when given"""
+    config = config or {}
+    parser.add_argument('--features_dim', type=int, default=config.get('features_dim', 4096), help='NetVLAD output dims.')
+    parser.add_argument('--recall_values', type=int, default=config.get('recall_values', [1, 5, 10, 20]), nargs="+", help='Recalls to be computed, such as R@5, the largest is the number of predictions searched per query.')
+    parser.add_argument('--use_best_n', type=int, default=config.get('use_best_n', 1), help='Calculate the position from weighted averaged best n. If n = 1, then it is equivalent to top 1')
 
 class ProcessManager:
-    def __init__(self, args):
+    def __init__(self, args, wait=True):
+        """the database/index and the model are loaded concurrently, with wait=False this
+        returns at once and state goes from "starting" to "ready" or "failed", see wait_ready"""
         self.args = args
+        self.state = "starting"
+        self.errors = []
+        self.ready = threading.Event()
+        self.t_init = monotonic()
+        steps = [("database", self._init_database), ("model", self.setup_model)]
+        self.init_threads = [threading.Thread(target=self._run_init_step, args=step, name="init-" + step[0], daemon=True)
+                             for step in steps]
+        for thread in self.init_threads:
+            thread.start()
+        threading.Thread(target=self._finish_init, name="init", daemon=True).start()
+        if wait:
+            self.wait_ready()
+
+    def _init_database(self):
         self.load_local_database()
         self.faiss_init()
-        self.setup_model()
-    
+
+    def _run_init_step(self, name, step):
+        t_start = monotonic()
+        try:
+            step()
+        except BaseException as e:
+            # also catches the sys.exit() of a missing database, it is re-raised by wait_ready
+            self.errors.append(e)
+            logger.error("{} init failed: {!r}".format(name, e))
+        metrics.observe("init_" + name, monotonic() - t_start)
+
+    def _finish_init(self):
+        for thread in self.init_threads:
+            thread.join()
+        self.state = "failed" if self.errors else "ready"
+        metrics.observe("init", monotonic() - self.t_init)
+        logger.info("ProcessManager {} after {:.2f} s".format(self.state, monotonic() - self.t_init))
+        self.ready.set()
+
+    def wait_ready(self, timeout=None):
+        """block until the initialisation is over, False on timeout, raises the first init error"""
+        if not self.ready.wait(timeout):
+            return False
+        if self.errors:
+            raise self.errors[0]
+        return True
+
     def faiss_init(self):
         
         logger.debug("faiss init...")
-        self.faiss_index = faiss.IndexFlatL2(self.args.features_dim)
-        self.faiss_index.add(self.database_features)
+        if self.tiles is not None:
+            # one index per tile, loaded on demand
+            if self.args.pca_dims > 0:
+                raise ValueError("pca_dims is not supported with a tiled database")
+            self.projection = None
+            self.faiss_index = self.spatial_index = self.tiles
+        else:
+            path = self.args.path_local_database
+            self.projection = None
+            if self.args.pca_dims > 0:
+                # the index is built over the re-projected database, saved beside it
+                self.projection, self.database_features, path = load_or_fit_projection(path, self.args.pca_dims)
+            self.faiss_index = load_index_snapshot(self.args, len(self.database_utms), path)
+            if self.database_features is None:
+                vectors = flat_vectors(self.faiss_index) if self.faiss_index is not None else None
+                if vectors is not None and not is_compact_database(path):
+                    # a flat snapshot holds every vector already, the h5 features are not read at all
+                    self.database_features = vectors
+                else:
+                    self.database_features, _ = load_database(path)
+            if self.faiss_index is None:
+                self.faiss_index = build_index(self.database_features, self.args)
+                save_index_snapshot(self.faiss_index, self.args, path)
+                set_search_params(self.faiss_index, self.args)
+            self.spatial_index = GridIndex(self.database_utms, self.args.grid_cell_size)
+        self.tracker = None
+        if self.args.track_history > 0:
+            if max(self.args.recall_values) < 2:
+                logger.warning("Tracking with a single candidate per frame, the sequence re-ranking needs recall_values of 5 or more")
+            self.tracker = Tracker(self.database_utms, self.args.track_history,
+                                   self.args.track_window_min, self.args.track_window_max, self.args.track_window_sigma,
+                                   self.args.track_match_radius, self.args.track_process_noise,
+                                   self.args.track_measurement_noise, self.args.track_max_misses,
+                                   self.args.track_gate_sigma)
+        self.track_lock = threading.Lock()
 
     def setup_model(self):
         """load and setup model"""
 
         logger.debug("setup model...")
-        self.model = RKNN_model_container(self.args.model_path, False)
+        self.model = InferencePool(create_backends(self.args))
 
-    def model_inference(self, input_data):
-        """model inference"""
+    def infer(self, input_data):
+        """run the model only, returns the global descriptor"""
 
-        logger.debug("rknn model inference...")
-        t_start = time()
         outputs = self.model.run([input_data])
-        t_end = time()
-        position = self.post_process(outputs[0])
-        t_end2 = time()
-        logger.debug("Inference time: {:.4f} s".format(t_end - t_start))
-        logger.debug("post process time: {:.4f} s".format(t_end2 - t_end))
+        return outputs[0]
+
+    def infer_batch(self, inputs):
+        """descriptors of a (N, H, W, C) batch, spread over all the runtimes"""
+
+        return self.model.run_batch(inputs)
+
+    def submit_infer(self, input_data):
+        """asynchronous infer, returns a future of the model outputs"""
+
+        return self.model.submit([input_data])
+
+    def model_inference(self, input_data, prior=None):
+        """model inference, prior is the (easting, northing) given by the GPS/INS if available"""
+
+        t_start = monotonic()
+        features = self.infer(input_data)
+        t_end = monotonic()
+        position = self.post_process(features, prior)
+        metrics.observe("infer", t_end - t_start)
+        metrics.observe("search", monotonic() - t_end)
         return position
 
-    def post_process(self, result):
-        """"post process and get best position"""
+    def post_process(self, result, prior=None, t=None):
+        """"post process and get best position (None if the search found nothing), frames with a
+        capture time t go through the tracker"""
+
+        return self.locate(result, prior, t)[0]
+
+    def locate(self, result, prior=None, t=None):
+        """like post_process, returns (position, best descriptor distance of the frame, FIX_* status of
+        tracker.py), (None, inf, FIX_SINGLE) without a fix. The distance is the frame's own one, also
+        when the tracker replaced its fix by the prediction"""
+
+        if self.projection is not None:
+            result = project(self.projection, result)
+        if self.tracker is None or t is None:
+            distances, predictions = self.search(result, prior)
+            sort_idx = np.argsort(distances[0])
+            position = self._calculate_best_position(distances[0], predictions[0], sort_idx)
+            distance = distances[0, sort_idx[0]] if position is not None else np.inf
+            status = FIX_SINGLE
+            velocity = None
+        else:
+            with self.track_lock:
+                position, distance, status = self._track(result, prior, t)
+                velocity = self.tracker.x[2:] if self.tracker.tracking else None
+        if position is None:
+            metrics.inc("no_fix")
+        elif self.tiles is not None:
+            self.tiles.prefetch(position, velocity)
+        return position, float(distance), status
+
+    def locate_hypotheses(self, features, inputs, prior=None, t=None, batch_size=0, early_exit=0.):
+        """Best of the yaw hypotheses of one frame, returns (position, distance, status, hypothesis index).
 
-        logger.debug("post process...")
-        distances, predictions = self.faiss_index.search(result, max(self.args.recall_values))
+        inputs holds the preprocessed hypotheses, most likely first, and features the
+        descriptors of the first ones. The rest are inferred batch_size at a time (0 for
+        all at once) and every batch is searched in one faiss call, until a best distance
+        reaches early_exit (0 to always try them all). Hypotheses within YAW_TIE_MARGIN of
+        the best distance count as a tie, won by the one nearest the reported yaw. The
+        winner then goes through locate, so the tracker sees a single frame as usual.
+        """
+
+        batch_size = batch_size or len(inputs)
+        all_features, best_distances, results = [], [], []
+        num_done = 0
+        while True:
+            batch = features if num_done == 0 else self.infer_batch(inputs[num_done:num_done + batch_size])
+            queries = project(self.projection, batch) if self.projection is not None else batch
+            distances, predictions = self.search(queries, prior)
+            all_features.append(batch)
+            best_distances.append(distances[:, 0])
+            results += list(zip(distances, predictions))
+            num_done += len(batch)
+            if num_done >= len(inputs) or (early_exit > 0 and distances[:, 0].min() <= early_exit):
+                break
+        metrics.inc("yaw_hypotheses", num_done)
+        best_distances = np.concatenate(best_distances)
+        best = int(np.flatnonzero(best_distances <= best_distances.min() * (1 + YAW_TIE_MARGIN))[0])
+        if best != 0:
+            metrics.inc("yaw_corrected")
+        if self.tracker is not None and t is not None:
+            position, distance, status = self.locate(np.concatenate(all_features)[best:best + 1], prior, t)
+            return position, distance, status, best
+        distances, predictions = results[best]
+        sort_idx = np.argsort(distances)
+        position = self._calculate_best_position(distances, predictions, sort_idx)
+        if position is None:
+            metrics.inc("no_fix")
+            return None, np.inf, FIX_SINGLE, best
+        if self.tiles is not None:
+            self.tiles.prefetch(position)
+        return position, float(distances[sort_idx[0]]), FIX_SINGLE, best
+
+    def _track(self, result, prior, t):
+        """search the window predicted by the track, re-localize globally when the sequence score is poor,
+        returns (tracked position, best distance of the frame, FIX_* status)"""
+
+        k = max(self.args.recall_values)
+        window = self.tracker.window(t)
+        if window is not None:
+            candidate_ids = self.spatial_index.query(*window)
+            if len(candidate_ids) >= k:
+                distances, predictions = self._search_candidates(result, candidate_ids, k)
+                sort_idx, score = self.tracker.rerank(distances[0], predictions[0], t)
+                if self.args.track_max_score <= 0 or score <= self.args.track_max_score:
+                    metrics.inc("search_tracked")
+                    position = self._calculate_best_position(distances[0], predictions[0], sort_idx)
+                    position, status = self.tracker.update(position, distances[0], predictions[0], t)
+                    return position, distances[0, sort_idx[0]], status
+            metrics.inc("track_lost")
+            self.tracker.reset()
+        distances, predictions = self.search(result, prior)
         sort_idx = np.argsort(distances[0])
-        best_position = self._calculate_best_position(distances[0], predictions[0], sort_idx)
-        return best_position
+        position = self._calculate_best_position(distances[0], predictions[0], sort_idx)
+        if position is None:
+            return None, np.inf, FIX_SINGLE
+        valid = predictions[0] >= 0
+        position, status = self.tracker.update(position, distances[0][valid], predictions[0][valid], t)
+        return position, distances[0, sort_idx[0]], status
+
+    def search(self, result, prior=None):
+        """search near the prior first, widen to the whole map when the prior is missing or the match is poor"""
+
+        k = max(self.args.recall_values)
+        if prior is not None and self.args.prior_radius > 0:
+            candidate_ids = self.spatial_index.query(prior, self.args.prior_radius)
+            if len(candidate_ids) >= k:
+                distances, predictions = self._search_candidates(result, candidate_ids, k)
+                if self.args.gate_max_distance <= 0 or distances[:, 0].min() <= self.args.gate_max_distance:
+                    metrics.inc("search_gated")
+                    return distances, predictions
+                metrics.inc("search_fallback_low_confidence")
+            else:
+                metrics.inc("search_fallback_few_candidates")
+        metrics.inc("search_global")
+        return self.faiss_index.search(result, k)
+
+    def _search_candidates(self, result, candidate_ids, k):
+        """exact search restricted to the candidate subset"""
+
+        candidates = np.ascontiguousarray(self.database_features[candidate_ids], dtype=np.float32)
+        distances, order = faiss.knn(np.ascontiguousarray(result, dtype=np.float32), candidates, k)
+        return distances, candidate_ids[order]
 
     def _calculate_best_position(self, distance, prediction, sort_idx):
         """"faiss for queries and local database features"""
 
-        if self.args.use_best_n == 1:
-            return self.database_utms[prediction[sort_idx[0]]]
-        if distance[sort_idx[0]] == 0:
-            return self.database_utms[prediction[sort_idx[0]]]
-        
-        mean = distance[sort_idx[0]]
-        sigma = distance[sort_idx[0]] / distance[sort_idx[-1]]
-        X = np.array(distance[sort_idx[:self.args.use_best_n]]).reshape((-1,))
-        weights = np.exp(-np.square(X - mean) / (2 * sigma ** 2))
-        weights /= np.sum(weights)
-        return np.average(self.database_utms[prediction[sort_idx[:self.args.use_best_n]]], axis=0, weights=weights)
+        return weighted_position(distance, prediction, sort_idx, self.database_utms, self.args.use_best_n)
 
     def load_local_database(self):
         """"loading local database features and utms"""
 
         logger.debug("load local database features...")
-        if os.path.exists(self.args.path_local_database):
-            with h5py.File(self.args.path_local_database, 'r') as hf:
-                self.database_features = hf['database_features'][:]
-                self.database_utms = hf['database_utms'][:]
+        self.tiles = None
+        if is_tiled_database(self.args.path_local_database):
+            self.tiles = TiledDatabase(self.args.path_local_database, self.args, self.args.tile_cache_mb,
+                                       self.args.tile_prefetch_seconds, max(self.args.prior_radius, self.args.track_window_max),
+                                       self.args.tile_global_tiles)
+            self.database_features, self.database_utms = self.tiles, self.tiles.utms
+        elif os.path.exists(self.args.path_local_database):
+            # features are read by faiss_init, only if the index snapshot does not hold them
+            self.database_features, self.database_utms = None, load_database_utms(self.args.path_local_database)
         else:
             logger.error("Database features not found")
             print("Please extract database features first.")
@@ -0,0 +1,66 @@
+import os
+import json
+import faiss
+import numpy as np
+from time import time
+from .database import load_database, database_signature
+from .logger_config import logger
+
+
+def projection_paths(database_path, dims):
+    """the fitted transform and the re-projected database, e.g. database_features.pca256.vt / .npy"""
+    root, _ = os.path.splitext(database_path)
+    return f"{root}.pca{dims}.vt", f"{root}.pca{dims}.npy"
+
+
+def fit_pca(features, dims, max_train=100000, chunk_size=16384):
+    """PCA whitening fitted on (a sample of) the database descriptors"""
+    num_vectors, dim = features.shape
+    if dims > min(dim, num_vectors):
+        raise ValueError(f"Cannot reduce {num_vectors} x {dim} descriptors to {dims} dims")
+    if num_vectors > max_train:
+        rng = np.random.default_rng(1234)
+        train_ids = np.sort(rng.choice(num_vectors, max_train, replace=False))
+    else:
+        train_ids = np.arange(num_vectors)
+    train = np.concatenate([np.asarray(features[train_ids[start:start + chunk_size]], dtype=np.float32)
+                            for start in range(0, len(train_ids), chunk_size)])
+    pca = faiss.PCAMatrix(dim, dims, -0.5)
+    pca.train(train)
+    return pca
+
+
+def project(pca, features):
+    """whitened and L2 normalized projection of float32 descriptors"""
+    projected = pca.apply(np.ascontiguousarray(features, dtype=np.float32))
+    faiss.normalize_L2(projected)
+    return projected
+
+
+def load_or_fit_projection(database_path, dims, chunk_size=16384):
+    """(pca, projected database features, projected database path), fitted and re-projected only
+    when database_path changed since the last time; the features are memory-mapped"""
+    vt_path, npy_path = projection_paths(database_path, dims)
+    meta_path = npy_path + ".json"
+    meta = {"database": os.path.abspath(database_path), "dims": dims, "signature": database_signature(database_path)}
+    if os.path.exists(vt_path) and os.path.exists(npy_path) and os.path.exists(meta_path):
+        with open(meta_path, 'r') as f:
+            if json.load(f) == meta:
+                logger.debug("load projection from {}".format(vt_path))
+                return faiss.read_VectorTransform(vt_path), np.load(npy_path, mmap_mode='r'), npy_path
+        logger.warning("Projection {} is older than the database, fitting it again.".format(vt_path))
+
+    t_start = time()
+    features, _ = load_database(database_path)
+    num_vectors = features.shape[0]
+    pca = fit_pca(features, dims)
+    projected = np.lib.format.open_memmap(npy_path, mode='w+', dtype=np.float32, shape=(num_vectors, dims))
+    for start in range(0, num_vectors, chunk_size):
+        projected[start:start + chunk_size] = project(pca, features[start:start + chunk_size])
+    projected.flush()
+    del projected
+    faiss.write_VectorTransform(pca, vt_path)
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f, indent=2)
+    logger.info("Projected {} descriptors to {} dims in {:.1f} s".format(num_vectors, dims, time() - t_start))
+    return pca, np.load(npy_path, mmap_mode='r'), npy_path
@@ -1,15 +1,19 @@
 # from rknn.api import RKNN
-from rknnlite.api import RKNNLite
 
 
 class RKNN_model_container():
-    def __init__(self, model_path, verbose=False) -> None:
+    def __init__(self, model_path, verbose=False, core_mask=None) -> None:
+        # imported here so the rest of the code can run off-board with another backend
+        from rknnlite.api import RKNNLite
+
         rknn = RKNNLite(verbose=verbose)
         # Direct Load RKNN Model
         rknn.load_rknn(model_path)
 
         print('--> Init runtime environment')
-        ret = rknn.init_runtime(core_mask = RKNNLite.NPU_CORE_0_1_2)
+        if core_mask is None:
+            core_mask = RKNNLite.NPU_CORE_0_1_2
+        ret = rknn.init_runtime(core_mask = core_mask)
         # ret = rknn.init_runtime()
 
         if ret != 0:
@@ -27,4 +31,7 @@ class RKNN_model_container():
 
         result = self.rknn.inference(inputs=inputs)
     
-        return result
\ No newline at end of file
+        return result
+
+    def release(self):
+        self.rknn.release()
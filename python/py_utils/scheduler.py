@@ -0,0 +1,125 @@
+import cv2
+import numpy as np
+from .logger_config import logger
+from .metrics import metrics
+
+METERS_PER_DEGREE = 111320.
+THERMAL_RATE_FACTOR = 0.5
+
+
+class FrameScheduler:
+    """Decides per frame whether to run the full localization, so NPU and faiss time goes
+    to the frames that can change the answer.
+
+    A frame is wanted when it differs enough from the last localized one: the image
+    change (mean absolute difference of 32x32 gray thumbnails, 0..1) reaches min_change,
+    the attitude turned by min_angle (radians), or the autopilot position moved by
+    min_move times the height (about the ground footprint of the camera). A frame is
+    also wanted max_interval seconds after the last confident fix (best distance at most
+    confident_distance) or the last forced frame, whatever the motion.
+
+    Under overload wanted frames are shed in this order of precedence:
+    1. backlog: the pipeline already holds max_queued frames. A new frame would only
+       wait behind them and come out stale, the next one will be fresher.
+    2. budget: at most max_rate frames per second, a token bucket that allows a burst of
+       one second. The rate is halved while the temperature read from thermal_path is
+       above thermal_limit (degrees C).
+    Frames forced by max_interval bypass the budget but not the backlog.
+    """
+
+    def __init__(self, max_rate=5., max_interval=2., min_change=0.04, min_angle=0.05, min_move=0.2,
+                 confident_distance=1., max_queued=2, thermal_path="", thermal_limit=80.):
+        self.max_rate = max_rate
+        self.max_interval = max_interval
+        self.min_change = min_change
+        self.min_angle = min_angle
+        self.min_move = min_move
+        self.confident_distance = confident_distance
+        self.max_queued = max_queued
+        self.thermal_path = thermal_path
+        self.thermal_limit = thermal_limit
+        self.tokens = max(max_rate, 1.)
+        self.t_tokens = None
+        self.t_confident = None
+        self.t_forced = None
+        self.last_thumbnail = None
+        self.last_attitude = None
+        self.throttled = False
+        self.t_thermal = None
+
+    def thumbnail(self, frame):
+        """32x32 gray thumbnail of the 512x512 center crop the localization uses"""
+        height, width = frame.shape[:2]
+        top, left = max(0, height // 2 - 256), max(0, width // 2 - 256)
+        crop = frame[top:top + 512, left:left + 512]
+        small = cv2.resize(crop, (32, 32), interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY) if small.ndim == 3 else small
+
+    def motion(self, thumbnail, attitude):
+        """largest of image change / min_change, rotation / min_angle and movement / (min_move * height),
+        1 or more means the frame is wanted"""
+        if self.last_thumbnail is None:
+            return np.inf
+        scores = [cv2.norm(thumbnail, self.last_thumbnail, cv2.NORM_L1) / thumbnail.size / 255. / self.min_change]
+        if attitude is not None and self.last_attitude is not None:
+            last = self.last_attitude
+            d_yaw = abs((attitude.yaw - last.yaw + np.pi) % (2 * np.pi) - np.pi)
+            scores.append(max(d_yaw, abs(attitude.pitch - last.pitch), abs(attitude.roll - last.roll)) / self.min_angle)
+            if attitude.lat and last.lat and self.min_move > 0:
+                dx = (attitude.lng - last.lng) * METERS_PER_DEGREE * np.cos(np.radians(attitude.lat))
+                dy = (attitude.lat - last.lat) * METERS_PER_DEGREE
+                scores.append(np.hypot(dx, dy) / (self.min_move * max(attitude.height, 1.)))
+        return max(scores)
+
+    def _rate(self, t):
+        if self.thermal_path and (self.t_thermal is None or t - self.t_thermal >= 1.):
+            self.t_thermal = t
+            try:
+                with open(self.thermal_path, 'r') as f:
+                    temperature = int(f.read().strip()) / 1000.
+            except (OSError, ValueError):
+                temperature = None
+            throttled = temperature is not None and temperature > self.thermal_limit
+            if throttled != self.throttled:
+                logger.warning("Temperature {} C, localization rate {}".format(
+                    temperature, "reduced" if throttled else "restored"))
+                self.throttled = throttled
+        return self.max_rate * (THERMAL_RATE_FACTOR if self.throttled else 1.)
+
+    def _refill(self, t):
+        if self.t_tokens is not None:
+            rate = self._rate(t)
+            self.tokens = min(max(rate, 1.), self.tokens + (t - self.t_tokens) * rate)
+        self.t_tokens = t
+
+    def admit(self, frame, attitude, t, queued=0):
+        """True if the frame taken at t should be localized, queued is the number of frames
+        already waiting in the pipeline"""
+        if self.t_confident is None:
+            self.t_confident = t
+        self._refill(t)
+        thumbnail = self.thumbnail(frame)
+        # one forced frame per max_interval until a confident fix comes back
+        forced = t - max(self.t_confident, self.t_forced or self.t_confident) >= self.max_interval
+        if not forced and self.motion(thumbnail, attitude) < 1:
+            metrics.inc("sched_skipped_static")
+            return False
+        if queued >= self.max_queued:
+            metrics.inc("sched_shed_backlog")
+            return False
+        if self.max_rate > 0 and not forced:
+            if self.tokens < 1:
+                metrics.inc("sched_shed_budget")
+                return False
+            self.tokens -= 1
+        if forced:
+            self.t_forced = t
+        metrics.inc("sched_forced" if forced else "sched_admitted")
+        self.last_thumbnail = thumbnail
+        self.last_attitude = attitude
+        return True
+
+    def on_result(self, distance, t):
+        """feedback from the pipeline: best distance of the frame taken at t"""
+        if distance is not None and distance <= self.confident_distance:
+            self.t_confident = max(self.t_confident or t, t)
@@ -0,0 +1,160 @@
+import os
+import socket
+import threading
+import cv2
+import h5py
+import numpy as np
+from time import monotonic, sleep, strftime
+from .camera import FrameGrabber
+from .pipeline import LatestQueue
+from .telemetry import AAIR_DTYPE, parse_packets, validate_packets
+from .logger_config import logger
+from .metrics import metrics
+
+
+def session_filename(path):
+    """path itself, or a new session_<date>.h5 inside it when path is a folder"""
+    if os.path.isdir(path):
+        return os.path.join(path, "session_{}.h5".format(strftime("%Y%m%d-%H%M%S")))
+    return path
+
+
+class SessionRecorder:
+    """Records the frames and raw AAIR packets the localization used into one h5 file.
+
+    frames (JPEG bytes) with frame_times, and packets (raw bytes) with packet_times, all
+    times on the monotonic clock of the recording host. Encoding and writing happen in a
+    background thread; the file is flushed every `flush_interval` seconds so a power cut
+    loses at most that much.
+    """
+
+    def __init__(self, path, jpeg_quality=95, queue_size=256, flush_interval=1.):
+        self.path = session_filename(path)
+        self.jpeg_quality = jpeg_quality
+        self.flush_interval = flush_interval
+        self.queue = LatestQueue(queue_size)
+        self.hf = h5py.File(self.path, "w")
+        self.frames = self.hf.create_dataset("frames", (0,), maxshape=(None,), chunks=(64,),
+                                             dtype=h5py.vlen_dtype(np.uint8))
+        self.frame_times = self.hf.create_dataset("frame_times", (0,), maxshape=(None,), chunks=(1024,), dtype=np.float64)
+        self.packets = None
+        self.packet_times = self.hf.create_dataset("packet_times", (0,), maxshape=(None,), chunks=(1024,), dtype=np.float64)
+        self.thread = threading.Thread(target=self._run, name="session-recorder", daemon=True)
+        self.thread.start()
+        logger.info("Recording session to {}".format(self.path))
+
+    def add_frame(self, frame, t):
+        if self.queue.put(("frame", frame, t)) is not None:
+            metrics.inc("record_dropped")
+
+    def add_packet(self, data, t):
+        if self.queue.put(("packet", bytes(data), t)) is not None:
+            metrics.inc("record_dropped")
+
+    @staticmethod
+    def _append(dataset, value):
+        dataset.resize((dataset.shape[0] + 1,) + dataset.shape[1:])
+        dataset[-1] = value
+
+    def _write(self, kind, data, t):
+        if kind == "frame":
+            ok, encoded = cv2.imencode(".jpg", data, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+            if not ok:
+                metrics.inc("record_errors")
+                return
+            self._append(self.frames, encoded.reshape(-1))
+            self._append(self.frame_times, t)
+        else:
+            if self.packets is None:
+                self.packets = self.hf.create_dataset("packets", (0, len(data)), maxshape=(None, len(data)),
+                                                      chunks=(1024, len(data)), dtype=np.uint8)
+            if len(data) != self.packets.shape[1]:
+                metrics.inc("record_errors")
+                return
+            self._append(self.packets, np.frombuffer(data, dtype=np.uint8))
+            self._append(self.packet_times, t)
+
+    def _run(self):
+        t_flush = monotonic()
+        while True:
+            item = self.queue.get(timeout=self.flush_interval)
+            if item is None and self.queue.closed:
+                break
+            if item is not None:
+                self._write(*item)
+            if monotonic() - t_flush >= self.flush_interval:
+                self.hf.flush()
+                t_flush = monotonic()
+        self.hf.close()
+
+    def close(self):
+        self.queue.close()
+        self.thread.join()
+
+
+class Session:
+    """a recorded session, packets and times are read at once, frames are decoded on demand"""
+
+    def __init__(self, path):
+        self.hf = h5py.File(path, "r")
+        self.frames = self.hf["frames"]
+        self.frame_times = self.hf["frame_times"][:]
+        self.packet_times = self.hf["packet_times"][:]
+        self.packets = self.hf["packets"][:] if "packets" in self.hf else np.zeros((0, 0), dtype=np.uint8)
+        starts = [times[0] for times in (self.frame_times, self.packet_times) if len(times)]
+        self.t0 = min(starts) if starts else 0.
+
+    def __len__(self):
+        return len(self.frame_times)
+
+    def frame(self, i):
+        return cv2.imdecode(self.frames[i], cv2.IMREAD_COLOR)
+
+    def attitude_packets(self):
+        """the valid AAIR packets as an AAIR_DTYPE array, and their receive times"""
+        if self.packets.shape[1:] != (AAIR_DTYPE.itemsize,):
+            return np.zeros(0, dtype=AAIR_DTYPE), np.zeros(0)
+        packets = parse_packets(self.packets)
+        valid = validate_packets(packets)
+        return packets[valid], self.packet_times[valid]
+
+
+class ReplayGrabber(FrameGrabber):
+    """serves the frames of a session at their recorded times (scaled by 1 / speed) from t_start"""
+
+    def __init__(self, session, speed=1., t_start=None):
+        self.session = session
+        self.speed = speed
+        self.t_start = monotonic() if t_start is None else t_start
+        super().__init__(session)
+
+    def _open(self):
+        self.interval = 0.
+
+    def _grab(self, index):
+        if index >= len(self.session):
+            return None, None
+        sleep(max(0., self.t_start + (self.session.frame_times[index] - self.session.t0) / self.speed - monotonic()))
+        return self.session.frame(index), monotonic()
+
+
+class PacketReplayer:
+    """UDP stand-in for the autopilot, sends the recorded packets to address on the recorded schedule"""
+
+    def __init__(self, session, address, speed=1., t_start=None):
+        self.session = session
+        self.address = address
+        self.speed = speed
+        self.t_start = monotonic() if t_start is None else t_start
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.thread = threading.Thread(target=self._run, name="packet-replayer", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def _run(self):
+        for data, t in zip(self.session.packets, self.session.packet_times):
+            sleep(max(0., self.t_start + (t - self.session.t0) / self.speed - monotonic()))
+            self.sock.sendto(data.tobytes(), self.address)
+        logger.info("Replayed {} packets".format(len(self.session.packets)))
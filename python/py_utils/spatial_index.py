@@ -0,0 +1,39 @@
+import numpy as np
+
+
+class GridIndex:
+    """uniform grid over the database utms, used to turn a position prior into a candidate subset"""
+
+    def __init__(self, utms, cell_size=100.):
+        self.cell_size = float(cell_size)
+        self.utms = np.asarray(utms, dtype=np.float64)[:, :2]
+        cells = np.floor(self.utms / self.cell_size).astype(np.int64)
+        # group database ids by cell, ids inside a cell stay sorted
+        order = np.lexsort((cells[:, 1], cells[:, 0]))
+        sorted_cells = cells[order]
+        boundaries = np.flatnonzero(np.any(np.diff(sorted_cells, axis=0) != 0, axis=1)) + 1
+        self.cells = {}
+        for ids in np.split(order, boundaries):
+            self.cells[tuple(cells[ids[0]].tolist())] = np.sort(ids)
+
+    def __len__(self):
+        return self.utms.shape[0]
+
+    def query(self, center, radius):
+        """database ids within radius (meters) of center (easting, northing), sorted"""
+        x_min, y_min = np.floor((np.asarray(center[:2]) - radius) / self.cell_size).astype(np.int64)
+        x_max, y_max = np.floor((np.asarray(center[:2]) + radius) / self.cell_size).astype(np.int64)
+        if (x_max - x_min + 1) * (y_max - y_min + 1) > len(self.cells):
+            # the window covers more cells than exist, walk the occupied ones instead
+            candidates = [ids for (x, y), ids in self.cells.items()
+                          if x_min <= x <= x_max and y_min <= y <= y_max]
+        else:
+            candidates = [self.cells[(x, y)]
+                          for x in range(x_min, x_max + 1)
+                          for y in range(y_min, y_max + 1)
+                          if (x, y) in self.cells]
+        if not candidates:
+            return np.empty(0, dtype=np.int64)
+        ids = np.concatenate(candidates)
+        dist2 = np.sum(np.square(self.utms[ids] - np.asarray(center[:2], dtype=np.float64)), axis=1)
+        return np.sort(ids[dist2 <= radius ** 2])
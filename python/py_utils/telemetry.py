@@ -0,0 +1,114 @@
+import socket
+import selectors
+import threading
+import numpy as np
+from ctypes import sizeof
+from time import monotonic
+from .utils import AAIR
+from .logger_config import logger
+from .metrics import metrics
+
+# same layout as the packed AAIR ctypes structure, one row per packet
+AAIR_DTYPE = np.dtype([
+    ("start0", "u1"), ("start1", "u1"), ("length", "u1"), ("id", "u1"),
+    ("time", "<u4"), ("actime", "<u4"),
+    ("lat", "<f4"), ("lng", "<f4"), ("height", "<f4"),
+    ("yaw", "<f4"), ("pitch", "<f4"), ("roll", "<f4"), ("angle", "<f4"),
+    ("crc", "u1"),
+])
+assert AAIR_DTYPE.itemsize == sizeof(AAIR)
+# recv returns the real length of a longer datagram (Linux), not just the bytes copied
+RECV_FLAGS = getattr(socket, "MSG_TRUNC", 0)
+
+
+def validate_packets(packets, lengths=None):
+    """mask of the packets with the right size, header, crc and finite values"""
+    valid = (packets["start0"] == 0x55) & (packets["start1"] == 0xAA) & (packets["crc"] == 0xFF)
+    for name in ("lat", "lng", "height", "yaw", "pitch", "roll", "angle"):
+        valid &= np.isfinite(packets[name])
+    if lengths is not None:
+        valid &= lengths == AAIR_DTYPE.itemsize
+    return valid
+
+
+def parse_packets(data):
+    """structured array of the packets in a (num, itemsize) uint8 array or a bytes buffer"""
+    return np.frombuffer(np.ascontiguousarray(data), dtype=AAIR_DTYPE)
+
+
+def push_packets(attitude_buffer, packets, t_recvs):
+    """publish validated packets to the attitude buffer as immutable samples, in order"""
+    for packet, t_recv in zip(packets.tolist(), np.broadcast_to(t_recvs, len(packets)).tolist()):
+        _, _, _, _, time, actime, lat, lng, height, yaw, pitch, roll, angle, _ = packet
+        attitude_buffer.push(yaw, pitch, roll, lat, lng, height, time=time, actime=actime, angle=angle, t_recv=t_recv)
+
+
+class TelemetryReceiver:
+    """Non-blocking AAIR receiver: every wakeup drains all pending datagrams straight into a
+    preallocated array, validates them in bulk and pushes only the valid ones.
+
+    Every datagram keeps its real length (MSG_TRUNC, or one spare byte where it is not
+    supported), so shorter and longer ones are rejected as bad packets along with wrong
+    headers/crc instead of a longer one passing as its first packet-size bytes.
+    """
+
+    def __init__(self, sock, attitude_buffer, recorder=None, max_batch=256):
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.attitude_buffer = attitude_buffer
+        self.recorder = recorder
+        # one spare byte per row to tell a longer datagram from a packet without MSG_TRUNC
+        self.buffer = np.zeros((max_batch, AAIR_DTYPE.itemsize + 1), dtype=np.uint8)
+        self.lengths = np.zeros(max_batch, dtype=np.int64)
+        self.t_recvs = np.zeros(max_batch, dtype=np.float64)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="telemetry", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def drain(self):
+        """read every pending datagram (up to max_batch), returns how many"""
+        num = 0
+        while num < len(self.buffer):
+            try:
+                self.lengths[num] = self.sock.recv_into(self.buffer[num], self.buffer.shape[1], RECV_FLAGS)
+            except BlockingIOError:
+                break
+            self.t_recvs[num] = monotonic()
+            num += 1
+        return num
+
+    def process(self, num):
+        packets = parse_packets(self.buffer[:num, :AAIR_DTYPE.itemsize])
+        valid = validate_packets(packets, self.lengths[:num])
+        if self.recorder is not None:
+            # a session only holds packet-size datagrams, replay validates them again
+            for i in np.flatnonzero(self.lengths[:num] == AAIR_DTYPE.itemsize):
+                self.recorder.add_packet(self.buffer[i, :AAIR_DTYPE.itemsize].tobytes(), self.t_recvs[i])
+        metrics.inc("packets", num)
+        num_bad = num - int(np.count_nonzero(valid))
+        if num_bad:
+            metrics.inc("bad_packets", num_bad)
+            logger.error("Received {} bad packets".format(num_bad))
+        push_packets(self.attitude_buffer, packets[valid], self.t_recvs[:num][valid])
+        logger.opt(lazy=True).debug("Receive data: {}", lambda: packets[valid][-1:])
+
+    def run(self):
+        while not self.stop_event.is_set():
+            if not self.selector.select(timeout=0.5):
+                continue
+            try:
+                num = self.drain()
+            except OSError as e:
+                metrics.inc("packet_errors")
+                logger.warning("Error in data packet process: {}".format(e))
+                continue
+            if num:
+                self.process(num)
+
+    def stop(self):
+        self.stop_event.set()
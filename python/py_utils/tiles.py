@@ -0,0 +1,263 @@
+import os
+import json
+import threading
+import faiss
+import numpy as np
+from collections import OrderedDict
+from .database import CompactFeatures, TILES_META, database_signature
+from .faiss_index import load_or_build_index, index_path
+from .spatial_index import GridIndex
+from .pipeline import LatestQueue
+from .logger_config import logger
+from .metrics import metrics
+
+
+# k-means centroids per tile in the summary that picks the tiles of a global search
+SUMMARY_CENTROIDS = 16
+SUMMARY_MAX_TRAIN = 4096
+
+
+def load_or_build_summaries(path, tiles, dim):
+    """(centroids, tile of every centroid): SUMMARY_CENTROIDS k-means centroids of the features
+    of every tile, computed once by reading the tiles one after the other and saved as
+    path/summaries.npy, rebuilt when tiles.json changes"""
+    summary_path = os.path.join(path, "summaries.npy")
+    meta = {"signature": database_signature(os.path.join(path, TILES_META)), "centroids": SUMMARY_CENTROIDS}
+    if os.path.exists(summary_path) and os.path.exists(summary_path + ".json"):
+        with open(summary_path + ".json", 'r') as f:
+            if json.load(f) == meta:
+                summaries = np.load(summary_path)
+                return np.ascontiguousarray(summaries[:, 1:], dtype=np.float32), summaries[:, 0].astype(np.int64)
+    centroids, tile_ids = [], []
+    for i, tile in enumerate(tiles):
+        tile_path = os.path.join(path, tile["path"])
+        with open(os.path.join(tile_path, "meta.json"), 'r') as f:
+            tile_meta = json.load(f)
+        codes = np.load(os.path.join(tile_path, "features.npy"), mmap_mode='r')
+        scales = np.load(os.path.join(tile_path, "scales.npy"), mmap_mode='r') if tile_meta["dtype"] == "int8" else None
+        features = CompactFeatures(codes, scales)
+        rows = np.linspace(0, len(features) - 1, min(len(features), SUMMARY_MAX_TRAIN)).astype(np.int64)
+        train = np.ascontiguousarray(features[rows], dtype=np.float32)
+        num_centroids = min(SUMMARY_CENTROIDS, len(train))
+        if num_centroids < len(train):
+            kmeans = faiss.Kmeans(dim, num_centroids, niter=10, seed=1234)
+            kmeans.train(train)
+            train = kmeans.centroids
+        centroids.append(train)
+        tile_ids.append(np.full(len(train), i))
+    centroids, tile_ids = np.concatenate(centroids), np.concatenate(tile_ids)
+    np.save(summary_path, np.column_stack([tile_ids.astype(np.float32), centroids]))
+    with open(summary_path + ".json", 'w') as f:
+        json.dump(meta, f, indent=2)
+    logger.info("Summarized {} tiles with {} centroids".format(len(tiles), len(centroids)))
+    return centroids, tile_ids
+
+
+class Tile:
+    """one tile held in memory: features, utms, spatial grid and faiss index"""
+
+    def __init__(self, path, start, args):
+        with open(os.path.join(path, "meta.json"), 'r') as f:
+            meta = json.load(f)
+        codes = np.load(os.path.join(path, "features.npy"))
+        scales = np.load(os.path.join(path, "scales.npy")) if meta["dtype"] == "int8" else None
+        self.start = start
+        self.features = CompactFeatures(codes, scales)
+        self.utms = np.load(os.path.join(path, "utms.npy"))
+        self.grid = GridIndex(self.utms, args.grid_cell_size)
+        self.index = load_or_build_index(self.features, args, path)
+        self.nbytes = self.features.nbytes + self.utms.nbytes + self._index_nbytes(args, path)
+
+    def _index_nbytes(self, args, path):
+        if args.index_type == "flat":
+            return self.index.ntotal * self.index.d * 4
+        index_file = index_path(args, self.index.ntotal, path)
+        return os.path.getsize(index_file) if os.path.exists(index_file) else self.index.ntotal * self.index.d * 4
+
+    def __len__(self):
+        return self.utms.shape[0]
+
+
+class TiledDatabase:
+    """Database split into UTM grid tiles (see database.tile_database) paged through an LRU cache.
+
+    Only tiles near the current and predicted position are kept in memory, bounded by
+    `cache_mb`. prefetch() loads the tiles around a fix and the ones `prefetch_seconds`
+    ahead along its velocity in a background thread, so the search normally finds them
+    resident; a miss is loaded on the spot. Ids are global: tiles are stored one after
+    the other and utms (memory-mapped) covers all of them, so the rest of the code can
+    treat this as database_features, spatial_index and faiss_index at once.
+
+    A search without a prior (the global fallback) cannot sweep every tile of a map
+    larger than the cache, so it only searches the `global_tiles` tiles whose k-means
+    summary is nearest to the query, loading the missing ones without caching them;
+    0 disables it and the search returns no candidate.
+    """
+
+    def __init__(self, path, args, cache_mb=1024, prefetch_seconds=10., prefetch_radius=500., global_tiles=8):
+        self.path = path
+        self.args = args
+        with open(os.path.join(path, TILES_META), 'r') as f:
+            self.meta = json.load(f)
+        self.tile_size = self.meta["tile_size"]
+        self.tiles = self.meta["tiles"]
+        self.starts = np.array([tile["start"] for tile in self.tiles], dtype=np.int64)
+        self.keys = {tuple(tile["key"]): i for i, tile in enumerate(self.tiles)}
+        self.utms = np.load(os.path.join(path, "utms.npy"), mmap_mode='r')
+        self.global_tiles = global_tiles
+        self.summaries = self.summary_tiles = None
+        if global_tiles > 0:
+            self.summaries, self.summary_tiles = load_or_build_summaries(path, self.tiles, self.meta["dim"])
+        self.cache_bytes = cache_mb * 1024 * 1024
+        self.prefetch_seconds = prefetch_seconds
+        self.prefetch_radius = prefetch_radius
+        self.cache = OrderedDict()
+        self.cached_bytes = 0
+        self.loading = set()
+        self.cond = threading.Condition()
+        self.requests = LatestQueue(1)
+        self.thread = threading.Thread(target=self._prefetch_loop, name="tile-prefetch", daemon=True)
+        self.thread.start()
+
+    @property
+    def shape(self):
+        return (self.meta["num"], self.meta["dim"])
+
+    def __len__(self):
+        return self.meta["num"]
+
+    def _load(self, i):
+        tile = self.tiles[i]
+        return Tile(os.path.join(self.path, tile["path"]), tile["start"], self.args)
+
+    def _insert(self, i, tile):
+        self.cache[i] = tile
+        self.cached_bytes += tile.nbytes
+        while self.cached_bytes > self.cache_bytes and len(self.cache) > 1:
+            _, evicted = self.cache.popitem(last=False)
+            self.cached_bytes -= evicted.nbytes
+            metrics.inc("tile_evictions")
+
+    def tile(self, i, cache=True):
+        """tile i, loaded now if it is not resident (and then cached unless cache is False)"""
+        with self.cond:
+            while i in self.loading:
+                self.cond.wait()
+            tile = self.cache.get(i)
+            if tile is not None:
+                self.cache.move_to_end(i)
+                return tile
+            self.loading.add(i)
+        tile = None
+        try:
+            tile = self._load(i)
+        finally:
+            with self.cond:
+                self.loading.discard(i)
+                if tile is not None and cache:
+                    self._insert(i, tile)
+                self.cond.notify_all()
+        return tile
+
+    def tiles_near(self, center, radius):
+        """indexes of the tiles intersecting the square around center, nearest first"""
+        x_min, y_min = np.floor((np.asarray(center[:2]) - radius) / self.tile_size).astype(np.int64)
+        x_max, y_max = np.floor((np.asarray(center[:2]) + radius) / self.tile_size).astype(np.int64)
+        found = [(abs(x + 0.5 - center[0] / self.tile_size) + abs(y + 0.5 - center[1] / self.tile_size), self.keys[(x, y)])
+                 for x in range(x_min, x_max + 1)
+                 for y in range(y_min, y_max + 1)
+                 if (x, y) in self.keys]
+        return [i for _, i in sorted(found)]
+
+    def query(self, center, radius):
+        """global ids within radius (meters) of center, sorted, like GridIndex.query"""
+        ids = []
+        for i in self.tiles_near(center, radius):
+            with self.cond:
+                resident = i in self.cache
+            if not resident:
+                metrics.inc("tile_misses")
+            tile = self.tile(i)
+            ids.append(tile.grid.query(center, radius) + tile.start)
+        if not ids:
+            return np.empty(0, dtype=np.int64)
+        return np.sort(np.concatenate(ids))
+
+    def __getitem__(self, ids):
+        """float32 features of sorted global ids, such as the ones returned by query"""
+        ids = np.asarray(ids)
+        out = np.empty((len(ids), self.meta["dim"]), dtype=np.float32)
+        tile_ids = np.searchsorted(self.starts, ids, side='right') - 1
+        for i in np.unique(tile_ids):
+            rows = np.flatnonzero(tile_ids == i)
+            tile = self.tile(int(i))
+            out[rows] = tile.features[ids[rows] - tile.start]
+        return out
+
+    def nearest_tiles(self, queries, num):
+        """indexes of the num tiles whose summary is nearest to any of the queries, nearest first"""
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        distances, centroid_ids = faiss.knn(queries, self.summaries, len(self.summaries))
+        scores = np.full(len(self.tiles), np.inf)
+        np.minimum.at(scores, self.summary_tiles[centroid_ids.reshape(-1)], distances.reshape(-1))
+        return np.argsort(scores, kind="stable")[:num]
+
+    def search(self, queries, k):
+        """top-k over the global_tiles tiles nearest to the queries, faiss style (distances, ids),
+        padded with -1 ids when they hold fewer than k"""
+        all_distances, all_ids = [], []
+        if self.global_tiles <= 0:
+            metrics.inc("tile_global_disabled")
+        else:
+            metrics.inc("tile_global_searches")
+            for i in self.nearest_tiles(queries, self.global_tiles):
+                with self.cond:
+                    tile = self.cache.get(i)
+                if tile is None:
+                    metrics.inc("tile_global_loads")
+                    tile = self.tile(i, cache=False)
+                distances, ids = tile.index.search(queries, min(k, len(tile)))
+                all_distances.append(distances)
+                all_ids.append(np.where(ids >= 0, ids + tile.start, -1))
+        all_distances.append(np.full((len(queries), k), np.finfo(np.float32).max, dtype=np.float32))
+        all_ids.append(np.full((len(queries), k), -1, dtype=np.int64))
+        distances, ids = np.concatenate(all_distances, axis=1), np.concatenate(all_ids, axis=1)
+        order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+    def prefetch(self, position, velocity=None):
+        """load the tiles around position and around where the velocity leads, in the background"""
+        self.requests.put((np.asarray(position[:2], dtype=np.float64),
+                           None if velocity is None else np.asarray(velocity[:2], dtype=np.float64)))
+
+    def _prefetch_loop(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                if self.requests.closed:
+                    return
+                continue
+            position, velocity = request
+            wanted = self.tiles_near(position, self.prefetch_radius)
+            if velocity is not None and self.prefetch_seconds > 0:
+                ahead = position + velocity * self.prefetch_seconds
+                wanted += [i for i in self.tiles_near(ahead, self.prefetch_radius) if i not in wanted]
+            wanted_bytes = 0
+            for i in wanted:
+                with self.cond:
+                    tile = self.cache.get(i)
+                if tile is None:
+                    try:
+                        tile = self.tile(i)
+                    except (OSError, ValueError, RuntimeError) as e:
+                        logger.warning("Failed to prefetch tile {}: {}".format(self.tiles[i]["path"], e))
+                        continue
+                    metrics.inc("tile_prefetched")
+                wanted_bytes += tile.nbytes
+                if wanted_bytes > self.cache_bytes:
+                    # anything more would evict the tiles just loaded for the current position
+                    metrics.inc("tile_prefetch_over_budget")
+                    break
+
+    def close(self):
+        self.requests.close()
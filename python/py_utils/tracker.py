@@ -0,0 +1,129 @@
+import numpy as np
+from collections import deque
+from .metrics import metrics
+
+INITIAL_SPEED_STD = 30.  # m/s, velocity uncertainty of a freshly started track
+# how a position came out of update(), sent along with it (VLOC status)
+FIX_SINGLE = 0  # the frame's own fix, no track or the track (re)started on it
+FIX_TRACKED = 1  # the frame's fix filtered by the track
+FIX_PREDICTED = 2  # the frame's fix was an outlier, the track prediction is returned instead
+FIX_NAMES = {FIX_SINGLE: "single", FIX_TRACKED: "tracked", FIX_PREDICTED: "predicted"}
+
+
+class Tracker:
+    """Constant velocity Kalman filter over the fixes of consecutive frames, with sequence matching.
+
+    While a track is held, window() gives the area the next frame has to be searched in and
+    rerank() orders that frame's top-k by the descriptor distance accumulated over the last
+    `history` frames: each candidate is moved back along the track velocity and matched
+    against the earlier frames' top-k within `match_radius` meters. update() filters the
+    chosen position; a fix farther than `gate_sigma` standard deviations from the prediction
+    is treated as an outlier and the prediction is returned instead, until `max_misses` of
+    them in a row restart the track there. The gate is kept inside the search window (a
+    fix is an average of candidates in the window, it can never land outside of it).
+    All times are on the monotonic clock, in seconds.
+    """
+
+    def __init__(self, database_utms, history=5, window_min=100., window_max=500., window_sigma=3.,
+                 match_radius=50., process_noise=2., measurement_noise=15., max_misses=3, gate_sigma=2.):
+        self.database_utms = database_utms  # may be memory-mapped, only the top-k rows are read
+        self.history = deque(maxlen=max(history - 1, 0))
+        self.window_min = window_min
+        self.window_max = window_max
+        self.window_sigma = window_sigma
+        self.gate_sigma = gate_sigma
+        self.match_radius = match_radius
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.max_misses = max_misses
+        self.reset()
+
+    @property
+    def tracking(self):
+        return self.x is not None
+
+    def reset(self):
+        self.x = None  # easting, northing, v_easting, v_northing
+        self.P = None
+        self.t = None
+        self.misses = 0
+        self.history.clear()
+
+    def _utms(self, predictions):
+        return np.asarray(self.database_utms[predictions][..., :2], dtype=np.float64)
+
+    def _start(self, position, t):
+        self.x = np.array([position[0], position[1], 0., 0.])
+        self.P = np.diag([self.measurement_noise ** 2] * 2 + [INITIAL_SPEED_STD ** 2] * 2)
+        self.t = t
+        self.misses = 0
+
+    def _predict(self, t):
+        dt = max(t - self.t, 0.)
+        F = np.eye(4)
+        F[0, 2] = F[1, 3] = dt
+        G = np.array([[dt ** 2 / 2, 0], [0, dt ** 2 / 2], [dt, 0], [0, dt]])
+        x = F @ self.x
+        P = F @ self.P @ F.T + self.process_noise ** 2 * (G @ G.T)
+        return x, P
+
+    def _std(self, P):
+        """largest standard deviation of the next fix around the prediction"""
+        return np.sqrt(np.linalg.eigvalsh(P[:2, :2] + self.measurement_noise ** 2 * np.eye(2))[-1])
+
+    def _radius(self, P):
+        return float(np.clip(self.window_sigma * self._std(P), self.window_min, self.window_max))
+
+    def _gate(self, P):
+        return min(self.gate_sigma * self._std(P), self._radius(P))
+
+    def window(self, t):
+        """(center, radius) to search the frame taken at t in, None without a track"""
+        if not self.tracking:
+            return None
+        x, P = self._predict(t)
+        return x[:2], self._radius(P)
+
+    def rerank(self, distances, predictions, t):
+        """order of the top-k by accumulated sequence distance, and the accumulated distance of the first"""
+        utms = self._utms(predictions)
+        total = np.asarray(distances, dtype=np.float64).copy()
+        velocity = self.x[2:] if self.tracking else np.zeros(2)
+        for t_i, utms_i, distances_i in self.history:
+            expected = utms - velocity * (t - t_i)
+            dist2 = np.sum(np.square(expected[:, np.newaxis] - utms_i[np.newaxis]), axis=2)
+            matched = np.where(dist2 <= self.match_radius ** 2, distances_i[np.newaxis], np.inf).min(axis=1)
+            # a candidate that no earlier frame agrees with pays that frame's worst distance
+            total += np.where(np.isfinite(matched), matched, distances_i.max())
+        total /= 1 + len(self.history)
+        order = np.argsort(total, kind="stable")
+        return order, total[order[0]]
+
+    def update(self, position, distances, predictions, t):
+        """feed the fix and top-k of the frame taken at t, returns the tracked position and
+        its FIX_* status"""
+        if self.tracking and t <= self.t:
+            # an older frame finished late, the track has already moved on
+            return position, FIX_SINGLE
+        self.history.append((t, self._utms(predictions), np.asarray(distances, dtype=np.float64)))
+        if not self.tracking:
+            self._start(position, t)
+            return np.asarray(position[:2], dtype=np.float64), FIX_SINGLE
+        x, P = self._predict(t)
+        innovation = np.asarray(position[:2], dtype=np.float64) - x[:2]
+        if np.linalg.norm(innovation) > self._gate(P):
+            self.misses += 1
+            metrics.inc("track_outliers")
+            if self.misses >= self.max_misses:
+                metrics.inc("track_restarts")
+                self._start(position, t)
+                return np.asarray(position[:2], dtype=np.float64), FIX_SINGLE
+            self.x, self.P, self.t = x, P, t
+            return x[:2].copy(), FIX_PREDICTED
+        S = P[:2, :2] + self.measurement_noise ** 2 * np.eye(2)
+        K = P[:, :2] @ np.linalg.inv(S)
+        self.x = x + K @ innovation
+        self.P = (np.eye(4) - K @ np.eye(2, 4)) @ P
+        self.t = t
+        self.misses = 0
+        return self.x[:2].copy(), FIX_TRACKED
@@ -0,0 +1,185 @@
+import os
+import json
+import numpy as np
+from time import perf_counter
+from .database import database_signature
+from .evaluation import extract_queries_features, recalls_from_positives
+from .inference_pool import InferencePool, create_backends
+from .faiss_index import index_path, set_search_params
+from .process_manager import weighted_position
+from .projection import project
+from .spatial_index import GridIndex
+from .logger_config import logger
+
+
+def _cache_root(queries_h5):
+    root, _ = os.path.splitext(queries_h5)
+    return root
+
+
+def _load_meta(path, meta):
+    """True if path and its .json sidecar exist and the sidecar matches meta"""
+    if not os.path.exists(path) or not os.path.exists(path + ".json"):
+        return False
+    with open(path + ".json", 'r') as f:
+        if json.load(f) == meta:
+            return True
+    logger.warning("{} is older than its inputs, computing it again.".format(path))
+    return False
+
+
+def _save_meta(path, meta):
+    with open(path + ".json", 'w') as f:
+        json.dump(meta, f, indent=2)
+
+
+def load_or_extract_queries_features(queries_dataset, args):
+    """query descriptors, extracted once per queries h5, model, backend and input format and then
+    read from e.g. test_sample.features_rknn_float32_4096.npy next to the queries h5; the model
+    is only loaded when they have to be extracted"""
+    path = "{}.features_{}_{}_{}.npy".format(_cache_root(args.queries_h5), args.inference_backend,
+                                             args.input_format, args.features_dim)
+    meta = {"queries": os.path.abspath(args.queries_h5), "signature": database_signature(args.queries_h5),
+            "model": os.path.abspath(args.model_path), "model_signature": database_signature(args.model_path),
+            "inference_backend": args.inference_backend, "input_format": args.input_format,
+            "features_dim": args.features_dim}
+    if _load_meta(path, meta):
+        logger.debug("load query features from {}".format(path))
+        return np.load(path)
+    pool = InferencePool(create_backends(args))
+    try:
+        queries_features = extract_queries_features(queries_dataset, pool, args.features_dim, args.workers,
+                                                    args.chunk_size, args.prefetch, args.input_format)
+    finally:
+        pool.release()
+    np.save(path, queries_features)
+    _save_meta(path, meta)
+    return queries_features
+
+
+def load_or_compute_positives(queries_h5, queries_utms, database_path, database_utms, positive_dist_threshold):
+    """(ids, offsets) of the database entries within positive_dist_threshold meters of every query,
+    computed with a grid over the database utms and cached next to the queries h5 until the
+    queries, the database or the threshold change"""
+    path = "{}.positives{:g}.npz".format(_cache_root(queries_h5), positive_dist_threshold)
+    meta = {"queries": os.path.abspath(queries_h5), "signature": database_signature(queries_h5),
+            "database": os.path.abspath(database_path), "database_signature": database_signature(database_path),
+            "positive_dist_threshold": positive_dist_threshold}
+    if _load_meta(path, meta):
+        logger.debug("load positives from {}".format(path))
+        with np.load(path) as data:
+            return data["ids"], data["offsets"]
+    grid = GridIndex(database_utms, positive_dist_threshold)
+    positives = [grid.query(utm, positive_dist_threshold) for utm in np.asarray(queries_utms, dtype=np.float64)]
+    offsets = np.concatenate([[0], np.cumsum([len(ids) for ids in positives])]).astype(np.int64)
+    ids = np.concatenate(positives).astype(np.int64) if positives else np.empty(0, dtype=np.int64)
+    np.savez(path, ids=ids, offsets=offsets)
+    _save_meta(path, meta)
+    logger.info("{} of {} queries have a database entry within {} m".format(
+        np.count_nonzero(np.diff(offsets)), len(positives), positive_dist_threshold))
+    return ids, offsets
+
+
+def search_settings(index_type, args):
+    """query time settings swept for one index type: nprobe for IVF, efSearch for HNSW"""
+    if index_type in ("ivf_flat", "ivf_pq"):
+        return [{"nprobe": nprobe} for nprobe in args.nprobes]
+    if index_type == "hnsw":
+        return [{"ef_search": ef_search} for ef_search in args.ef_searches]
+    return [{}]
+
+
+def time_searches(index, queries_features, pca, k, num_timed):
+    """milliseconds per query, projected and searched one at a time like the online path"""
+    times = np.empty(min(num_timed, len(queries_features)))
+    index.search(project(pca, queries_features[:1]) if pca is not None else queries_features[:1], k)
+    for i in range(len(times)):
+        t_start = perf_counter()
+        query_features = queries_features[i:i + 1]
+        if pca is not None:
+            query_features = project(pca, query_features)
+        index.search(query_features, k)
+        times[i] = perf_counter() - t_start
+    return times * 1000
+
+
+def position_errors(distances, predictions, database_utms, queries_utms, use_best_n):
+    """meters between every query and the position main.py would output from its best use_best_n,
+    inf when the index returned nothing"""
+    errors = np.full(len(predictions), np.inf)
+    for q in range(len(predictions)):
+        num_valid = int(np.count_nonzero(predictions[q, :use_best_n] >= 0))
+        if num_valid == 0:
+            continue
+        position = weighted_position(distances[q, :num_valid], predictions[q, :num_valid], np.arange(num_valid),
+                                     database_utms, num_valid if use_best_n > 1 else 1)
+        errors[q] = np.hypot(*(np.asarray(position, dtype=np.float64) - queries_utms[q, :2]))
+    return errors
+
+
+def sweep_index(index, args, search_index_type, queries_features, search_queries, pca, database_utms,
+                queries_utms, positives, k_max):
+    """one result per search setting and use_best_n of a built index"""
+    results = []
+    for setting in search_settings(search_index_type, args):
+        for name, value in setting.items():
+            setattr(args, name, value)
+        set_search_params(index, args)
+        distances, predictions = index.search(search_queries, k_max)
+        recalls = recalls_from_positives(predictions, positives, args.recall_values)
+        for use_best_n in args.use_best_ns:
+            times = time_searches(index, queries_features, pca, max(use_best_n, 1), args.num_timed)
+            errors = position_errors(distances, predictions, database_utms, queries_utms, use_best_n)
+            results.append(dict(setting, **{
+                "index_type": search_index_type,
+                "use_best_n": use_best_n,
+                "recalls": {f"R@{n}": round(float(recall), 2) for n, recall in zip(args.recall_values, recalls)},
+                "localized": round(float(np.mean(errors <= args.positive_dist_threshold) * 100), 2),
+                "median_error": round(float(np.median(errors)), 2),
+                "p50_ms": round(float(np.percentile(times, 50)), 4),
+                "p95_ms": round(float(np.percentile(times, 95)), 4),
+            }))
+    return results
+
+
+def index_size_mb(args, num_vectors, database_path):
+    path = index_path(args, num_vectors, database_path)
+    return round(os.path.getsize(path) / 2 ** 20, 1) if os.path.exists(path) else None
+
+
+def pareto_front(results):
+    """results no other one beats on both p95 latency and localized queries, fastest first"""
+    front = []
+    for result in sorted(results, key=lambda r: (r["p95_ms"], -r["localized"])):
+        if not front or result["localized"] > front[-1]["localized"]:
+            front.append(result)
+    return front
+
+
+def recommend(results, target_latency):
+    """the most accurate result within target_latency ms at p95 (the faster one of equals), None if none fits"""
+    feasible = [result for result in results if result["p95_ms"] <= target_latency]
+    if not feasible:
+        return None
+    return max(feasible, key=lambda r: (r["localized"], -r["median_error"], -r["p95_ms"]))
+
+
+def config_fragment(result, args):
+    """config.yaml keys that reproduce result in main.py, the untouched index options come from args"""
+    fragment = {"index_type": result["index_type"]}
+    if result["index_type"] in ("ivf_flat", "ivf_pq"):
+        fragment["nlist"] = args.nlist
+        fragment["nprobe"] = result["nprobe"]
+    if result["index_type"] == "ivf_pq":
+        fragment["pq_m"] = args.pq_m
+        fragment["pq_nbits"] = args.pq_nbits
+    if result["index_type"] == "hnsw":
+        fragment["hnsw_m"] = args.hnsw_m
+        fragment["ef_construction"] = args.ef_construction
+        fragment["ef_search"] = result["ef_search"]
+    fragment["pca_dims"] = result["pca_dims"]
+    fragment["features_dim"] = args.features_dim
+    fragment["use_best_n"] = result["use_best_n"]
+    # main.py searches max(recall_values) predictions per frame, use_best_n of them are averaged
+    fragment["recall_values"] = [max(result["use_best_n"], 1)]
+    return fragment
@@ -1,9 +1,9 @@
 import cv2
 import os
 import yaml
-import pyproj
+from .coordinates import CoordinateConverter
 from .logger_config import logger
-from ctypes import Structure, c_ubyte, c_uint, c_float
+from ctypes import Structure, c_ubyte, c_uint, c_float, c_double
 
 
 def draw(img, position):
@@ -21,29 +21,31 @@ def load_config(config_path):
 
 def utm_to_latlon(position, zone_number, zone_letter):
     """
-    将UTM坐标转换为经纬度。
+    将UTM坐标转换为经纬度, 转换器按区号缓存, 见coordinates.CoordinateConverter。
     
     params:
-    easting:
-    northing: 
+    position: easting, northing
     zone_number: 
     zone_letter: 
     
     return:
     纬度，经度
     """
-    if zone_letter >= 'N':
-        hemisphere = 'north'
-    else:
-        hemisphere = 'south'
-    
-    proj_utm = pyproj.Proj(proj='utm', zone=zone_number, hemisphere=hemisphere)
-    proj_latlon = pyproj.Proj(proj='latlong', datum='WGS84')
-    transformer = pyproj.Transformer.from_proj(proj_utm, proj_latlon)
-    lon, lat = transformer.transform(position[0], position[1])
+    lat, lon = CoordinateConverter(zone_number, zone_letter).utm_to_latlon(position[:2])
     return [lat, lon]
 
 
+def latlon_to_utm(lat, lng, zone_number, zone_letter):
+    """
+    将经纬度转换为UTM坐标。
+
+    return:
+    easting, northing
+    """
+    easting, northing = CoordinateConverter(zone_number, zone_letter).latlon_to_utm(lat, lng)
+    return [easting, northing]
+
+
 def handle_result(img_path, img_name, position, args):
     """处理并保存结果图像"""
     if args.img_save:
@@ -76,3 +78,21 @@ class AAIR(Structure):
                 ("roll",     c_float),  #roll
                 ("angle",    c_float),  #航向角                    
                 ("crc", c_ubyte)]       #包校验值固定为0xFF   
+
+
+class VLOC(Structure):
+    _pack_ = 1                          #与AAIR相同的帧头和校验
+    _fields_ = [("start0",   c_ubyte),  #0x55
+                ("start1",   c_ubyte),  #0xAA
+                ("length",   c_ubyte),  #数据长度,43个字节
+                ("id",       c_ubyte),  #报文ID,152
+                ("seq",      c_uint),   #帧序号
+                ("time",     c_uint),   #图像对应的飞控时间(AAIR的time)
+                ("actime",   c_uint),   #图像对应的飞控相机同步时间(AAIR的actime)
+                ("x",        c_double), #coord为0时为utm东向(米), 为1时为纬度(度), latlon和lonlat都是
+                ("y",        c_double), #coord为0时为utm北向(米), 为1时为经度(度)
+                ("distance", c_float),  #最优匹配的特征距离, 越小越可信
+                ("latency",  c_float),  #从采集图像到发送的耗时(秒)
+                ("status",   c_ubyte),  #0为该帧独立定位, 1为经跟踪滤波, 2为该帧是跳变点, 输出的是跟踪预测值
+                ("coord",    c_ubyte),  #x/y的坐标类型, 0为utm, 1为纬度/经度(output_type为latlon或lonlat)
+                ("crc", c_ubyte)]       #包校验值固定为0xFF
@@ -0,0 +1,65 @@
+import os
+import sys
+import threading
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from py_utils.attitude_buffer import AttitudeBuffer
+
+
+def test_default_stamps_samples_with_the_receive_time():
+    attitude_buffer = AttitudeBuffer()
+    # whole-second Unix times like the ones in attitude.log must not move the sample
+    sample = attitude_buffer.push(0.1, 0.2, 0.3, time=1723518664, t_recv=1000.25)
+    assert sample.t == 1000.25
+    assert sample.time == 1723518664
+
+
+def test_packet_time_is_shifted_by_the_smallest_receive_delay():
+    attitude_buffer = AttitudeBuffer(time_scale=0.001, use_packet_time=True)
+    attitude_buffer.push(0., 0., 0., time=1000, t_recv=50.03)
+    sample = attitude_buffer.push(0., 0., 0., time=1100, t_recv=50.11)
+    # delays 49.03 and 49.01 s, the smaller one is the least delayed packet
+    assert sample.t == pytest.approx(1.1 + 49.01)
+
+
+def test_interpolate_between_and_beyond_the_samples():
+    attitude_buffer = AttitudeBuffer(capacity=4)
+    assert attitude_buffer.interpolate(1.) is None
+    attitude_buffer.push(0.2, 0.0, 0.1, lat=30., lng=120., height=100., t_recv=1.)
+    attitude_buffer.push(0.4, 0.2, 0.3, lat=31., lng=121., height=200., t_recv=2.)
+    sample = attitude_buffer.interpolate(1.25)
+    np.testing.assert_allclose(sample[:6], [0.25, 0.05, 0.15, 30.25, 120.25, 125.])
+    assert sample.t == 1.25
+    assert attitude_buffer.interpolate(0.5).t == 1.
+    assert attitude_buffer.interpolate(3.).t == 2.
+
+
+def test_interpolate_yaw_along_the_shortest_arc():
+    attitude_buffer = AttitudeBuffer()
+    attitude_buffer.push(np.pi - 0.1, 0., 0., t_recv=1.)
+    attitude_buffer.push(-np.pi + 0.1, 0., 0., t_recv=2.)
+    yaw = attitude_buffer.interpolate(1.5).yaw
+    assert abs(abs(yaw) - np.pi) < 1e-9
+
+
+def test_interpolate_keeps_the_newest_capacity_samples():
+    attitude_buffer = AttitudeBuffer(capacity=2)
+    for t in (1., 2., 3.):
+        attitude_buffer.push(t, 0., 0., t_recv=t)
+    assert attitude_buffer.interpolate(0.).t == 2.
+    assert attitude_buffer.latest().yaw == 3.
+
+
+def test_wait_until():
+    attitude_buffer = AttitudeBuffer()
+    assert not attitude_buffer.wait_until(1., timeout=0.01)
+    attitude_buffer.push(0., 0., 0., t_recv=1.)
+    assert attitude_buffer.wait_until(1., timeout=0)
+    assert not attitude_buffer.wait_until(2., timeout=0.01)
+    pusher = threading.Timer(0.02, lambda: attitude_buffer.push(0., 0., 0., t_recv=2.5))
+    pusher.start()
+    assert attitude_buffer.wait_until(2., timeout=5.)
+    pusher.join()
@@ -0,0 +1,91 @@
+import os
+import sys
+import threading
+import numpy as np
+import pytest
+from time import sleep
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from py_utils.inference_pool import InferencePool, FakeBackend
+
+
+class RecordingBackend(FakeBackend):
+    """FakeBackend that records the batch sizes it ran, waits for `gate` when given and
+    raises on an input whose first pixel is 255"""
+
+    def __init__(self, name, max_batch=0, gate=None):
+        super().__init__(features_dim=16, name=name)
+        self.max_batch = max_batch
+        self.gate = gate
+        self.batches = []
+        self.released = False
+
+    def run(self, inputs):
+        if self.gate is not None:
+            self.gate.wait()
+        data = np.asarray(inputs[0])
+        if data.flat[0] == 255:
+            raise ValueError("bad input")
+        self.batches.append(len(data))
+        return super().run(inputs)
+
+    def release(self):
+        self.released = True
+
+
+def images(num, seed=0):
+    images = np.random.default_rng(seed).integers(0, 255, (num, 32, 32, 3), dtype=np.uint8)
+    images[..., 0, 0, 0] = 0
+    return images
+
+
+def test_submit_picks_the_backend_with_the_fewest_requests_in_flight():
+    gate = threading.Event()
+    backends = [RecordingBackend("busy", gate=gate), RecordingBackend("a"), RecordingBackend("b")]
+    pool = InferencePool(backends)
+    try:
+        blocked = pool.submit(images(1))
+        for i in range(6):
+            pool.run(images(1, seed=i + 1))
+            # the worker counts the request as done just after handing over the result
+            while pool.in_flight[1:] != [0, 0]:
+                sleep(0.001)
+        assert backends[0].batches == []
+        # round robin between the idle ones
+        assert len(backends[1].batches) == len(backends[2].batches) == 3
+        gate.set()
+        blocked.result(timeout=5)
+        assert backends[0].batches == [1]
+    finally:
+        gate.set()
+        pool.release()
+
+
+def test_run_batch_splits_and_keeps_the_order():
+    backends = [RecordingBackend("a", max_batch=2), RecordingBackend("b", max_batch=3)]
+    pool = InferencePool(backends)
+    batch = images(5)
+    try:
+        features = pool.run_batch(batch)
+    finally:
+        pool.release()
+    # the smallest max_batch of the backends decides the split
+    assert sorted(backends[0].batches + backends[1].batches) == [1, 2, 2]
+    np.testing.assert_allclose(features, FakeBackend(features_dim=16).run([batch])[0], rtol=1e-5)
+
+
+def test_errors_reach_the_caller_and_release_shuts_down():
+    backends = [RecordingBackend("a"), RecordingBackend("b")]
+    pool = InferencePool(backends)
+    bad = images(1)
+    bad[0, 0, 0, 0] = 255
+    with pytest.raises(ValueError, match="bad input"):
+        pool.run(bad)
+    # the worker that failed keeps serving
+    for i in range(4):
+        assert pool.run(images(1, seed=i))[0].shape == (1, 16)
+    pool.release()
+    assert pool.in_flight == [0, 0]
+    assert all(not thread.is_alive() for thread in pool.threads)
+    assert all(backend.released for backend in backends)
@@ -0,0 +1,44 @@
+import os
+import sys
+from time import sleep
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from py_utils.pipeline import FramePacket, Stage, Pipeline
+
+
+def run(lossless):
+    """frame 0 is slow in one of two infer workers, frame 1 overtakes it, returns the
+    frames the search stage worked on and the ones the sink got"""
+    searched, done = [], []
+
+    def infer(packet):
+        if packet.seq == 0:
+            sleep(0.2)
+        return packet
+
+    def search(packet):
+        searched.append(packet.seq)
+        return packet
+
+    pipeline = Pipeline([Stage("infer", infer, workers=2, queue_size=4), Stage("search", search, queue_size=4)],
+                        lambda packet: done.append(packet.seq), lossless=lossless)
+    pipeline.start()
+    pipeline.submit(FramePacket(0, None, None))
+    sleep(0.02)
+    pipeline.submit(FramePacket(1, None, None))
+    sleep(0.4)
+    pipeline.stop()
+    return searched, done
+
+
+def test_frames_overtaken_are_not_searched():
+    searched, done = run(lossless=False)
+    assert searched == [1]
+    assert done == [1]
+
+
+def test_lossless_pipeline_searches_and_outputs_every_frame_in_order():
+    searched, done = run(lossless=True)
+    assert sorted(searched) == [0, 1]
+    assert done == [0, 1]
@@ -0,0 +1,67 @@
+import os
+import sys
+import cv2
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from py_utils.pre_process import PreProcessor, distort, center_crop, normalize_input, pre_process, STD
+
+# one gray level after the contrast stretch, in normalized units
+LEVEL = 3 / 255 / STD.min()
+
+
+def legacy_normalize(img, contrast_factor=3, color_code=cv2.COLOR_BGR2GRAY):
+    """the gray -> contrast -> normalize steps PreProcessor replaced, as they were written"""
+    img_float = cv2.cvtColor(img, color_code).astype(np.float32) / 255.0
+    mean = np.mean(img_float)
+    img_clipped = np.clip(mean + contrast_factor * (img_float - mean), 0, 1)
+    img_rgb = np.repeat(img_clipped[:, :, np.newaxis], 3, axis=2)
+    return ((img_rgb - np.array([0.485, 0.456, 0.406])) / np.array([0.229, 0.224, 0.225])).astype(np.float32)
+
+
+def legacy_pre_process(img, at):
+    return legacy_normalize(center_crop(distort(img, at)))
+
+
+@pytest.fixture(scope="module")
+def frame():
+    noise = np.random.default_rng(0).integers(0, 256, (90, 160, 3), dtype=np.uint8)
+    return cv2.resize(noise, (1280, 720), interpolation=cv2.INTER_CUBIC)
+
+
+def test_matches_legacy_without_attitude(frame):
+    np.testing.assert_allclose(PreProcessor()(frame, [0., 0., 0.]), legacy_pre_process(frame, [0., 0., 0.]), atol=1e-5)
+
+
+def test_matches_legacy_with_attitude(frame):
+    at = [0.3, 0.05, -0.04]
+    diff = np.abs(PreProcessor()(frame, at) - legacy_pre_process(frame, at))
+    # warping the crop directly instead of the whole frame rounds a few pixels the other way
+    assert diff.max() <= LEVEL + 1e-5
+    assert np.mean(diff > 1e-5) < 0.01
+
+
+def test_matches_legacy_dataset_normalization(frame):
+    img = cv2.cvtColor(center_crop(frame), cv2.COLOR_BGR2RGB)
+    np.testing.assert_allclose(PreProcessor(color_order="rgb").normalize(img),
+                               legacy_normalize(img, color_code=cv2.COLOR_RGB2GRAY), atol=1e-5)
+
+
+@pytest.mark.parametrize("input_format", ["uint8", "gray"])
+def test_uint8_inputs_match_float32_after_normalization(frame, input_format):
+    at = [0.1, 0.02, 0.03]
+    reference = PreProcessor()(frame, at)
+    data = PreProcessor(input_format=input_format)(frame, at)
+    assert data.dtype == np.uint8
+    restored = np.broadcast_to(normalize_input(data), reference.shape)
+    # the stretched gray level is rounded to uint8
+    assert np.abs(restored - reference).max() <= LEVEL / 3 / 2 + 1e-5
+
+
+def test_pre_process_returns_a_fresh_array(frame):
+    first = pre_process(frame, [0.1, 0., 0.])
+    second = pre_process(frame[::-1].copy(), [0.1, 0., 0.])
+    assert not np.shares_memory(first, second)
+    np.testing.assert_allclose(first, PreProcessor()(frame, [0.1, 0., 0.]))
@@ -0,0 +1,95 @@
+import os
+import sys
+import h5py
+import numpy as np
+import pytest
+
+PYTHON_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PYTHON_ROOT)
+
+from py_utils.utils import load_config
+from py_utils.attitude_buffer import AttitudeBuffer
+from py_utils.process_manager import ProcessManager
+from py_utils.session import SessionRecorder, Session
+from py_utils.telemetry import AAIR_DTYPE
+from main import build_parser, build_pipeline, replay_session
+
+NUM_FRAMES = 24
+FEATURES_DIM = 64
+
+
+@pytest.fixture(scope="module")
+def session_path(tmp_path_factory):
+    """a session of NUM_FRAMES frames at 10 fps with an AAIR packet every 20 ms"""
+    path = str(tmp_path_factory.mktemp("session") / "session.h5")
+    rng = np.random.default_rng(0)
+    recorder = SessionRecorder(path)
+    for i in range(NUM_FRAMES * 5):
+        packet = np.zeros(1, dtype=AAIR_DTYPE)
+        packet["start0"], packet["start1"], packet["length"], packet["crc"] = 0x55, 0xAA, AAIR_DTYPE.itemsize, 0xFF
+        packet["lat"], packet["lng"], packet["height"] = 27.1, 117.9, 500.
+        packet["yaw"] = 0.01 * i
+        recorder.add_packet(packet.tobytes(), i * 0.02)
+        if i % 5 == 4:
+            recorder.add_frame(rng.integers(0, 256, (360, 640, 3), dtype=np.uint8), i * 0.02)
+    recorder.close()
+    return path
+
+
+@pytest.fixture(scope="module")
+def database_path(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("database") / "database_features.h5")
+    rng = np.random.default_rng(1)
+    features = rng.standard_normal((256, FEATURES_DIM)).astype(np.float32)
+    features /= np.linalg.norm(features, axis=1, keepdims=True)
+    ids = np.arange(len(features))
+    with h5py.File(path, "w") as hf:
+        hf.create_dataset("database_features", data=features)
+        hf.create_dataset("database_utms", data=np.stack([400000. + ids % 16 * 30., 3000000. + ids // 16 * 30.], axis=1))
+    return path
+
+
+def replay(session_path, database_path, fake_latency):
+    config = load_config(os.path.join(os.path.dirname(PYTHON_ROOT), "config.yaml"))
+    args = build_parser(config).parse_args([])
+    args.path_local_database = database_path
+    args.features_dim = FEATURES_DIM
+    args.inference_backend = "fake"
+    args.fake_latency = fake_latency
+    args.index_type = "flat"
+    args.pca_dims = 0
+    args.prior_radius = 0
+    args.track_history = 0
+    args.sched_enabled = False
+    args.img_save = False
+    args.replay_speed = 0
+    # far below the backend latency, a lossy pipeline would drop most frames
+    args.max_frame_latency = 0.01
+    args.pipeline_queue_size = 1
+
+    session = Session(session_path)
+    pm = ProcessManager(args)
+    results = []
+    pipeline = build_pipeline(pm, args, sink=results.append, lossless=True)
+    pm.wait_ready()
+    pipeline.start()
+    try:
+        replay_session(session, pipeline, AttitudeBuffer(args.attitude_buffer_size, args.attitude_time_scale,
+                                                         args.use_packet_time), args)
+    finally:
+        pipeline.stop()
+        pm.model.release()
+    return results
+
+
+@pytest.mark.parametrize("fake_latency", [0., 0.05])
+def test_fast_replay_outputs_every_frame_in_order(session_path, database_path, fake_latency):
+    results = replay(session_path, database_path, fake_latency)
+    assert [packet.seq for packet in results] == list(range(NUM_FRAMES))
+    assert all(packet.position is not None for packet in results)
+
+
+def test_fast_replay_does_not_depend_on_backend_latency(session_path, database_path):
+    fast = replay(session_path, database_path, 0.)
+    slow = replay(session_path, database_path, 0.05)
+    np.testing.assert_array_equal([packet.position for packet in fast], [packet.position for packet in slow])
@@ -0,0 +1,41 @@
+import os
+import sys
+import socket
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from py_utils.attitude_buffer import AttitudeBuffer
+from py_utils.metrics import metrics
+from py_utils.telemetry import AAIR_DTYPE, TelemetryReceiver
+
+
+def aair_packet(yaw):
+    packet = np.zeros(1, dtype=AAIR_DTYPE)
+    packet["start0"], packet["start1"], packet["length"], packet["crc"] = 0x55, 0xAA, AAIR_DTYPE.itemsize, 0xFF
+    packet["lat"], packet["lng"], packet["yaw"] = 27.1, 117.9, yaw
+    return packet.tobytes()
+
+
+def test_drain_rejects_datagrams_of_the_wrong_size():
+    receiver_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver_sock.bind(("127.0.0.1", 0))
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    attitude_buffer = AttitudeBuffer()
+    receiver = TelemetryReceiver(receiver_sock, attitude_buffer)
+    bad_before = metrics.snapshot()["counters"].get("bad_packets", 0)
+    try:
+        # a valid packet followed by trailing bytes must not pass as the packet
+        for datagram in (aair_packet(0.1), aair_packet(0.2) + b"\x00" * 7, aair_packet(0.3)[:-1]):
+            sender.sendto(datagram, receiver_sock.getsockname())
+        receiver.selector.select(timeout=1.)
+        num = receiver.drain()
+        assert num == 3
+        assert list(receiver.lengths[:num]) == [AAIR_DTYPE.itemsize, AAIR_DTYPE.itemsize + 7, AAIR_DTYPE.itemsize - 1]
+        receiver.process(num)
+    finally:
+        sender.close()
+        receiver_sock.close()
+    assert metrics.snapshot()["counters"].get("bad_packets", 0) - bad_before == 2
+    assert np.isclose(attitude_buffer.latest().yaw, 0.1)
+    assert attitude_buffer.seq == 1
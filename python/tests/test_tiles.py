@@ -0,0 +1,80 @@
+import os
+import sys
+import h5py
+import numpy as np
+import pytest
+
+PYTHON_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PYTHON_ROOT)
+
+from py_utils.utils import load_config
+from py_utils.database import tile_database
+from py_utils.tiles import TiledDatabase
+from main import build_parser
+
+TILE_SIZE = 100.
+NUM_TILES = 6
+PER_TILE = 20
+DIM = 32
+
+
+@pytest.fixture(scope="module")
+def database(tmp_path_factory):
+    """(tiles folder, features, utms) of NUM_TILES tiles in a row, PER_TILE entries each"""
+    root = tmp_path_factory.mktemp("tiles")
+    rng = np.random.default_rng(0)
+    num = NUM_TILES * PER_TILE
+    features = rng.standard_normal((num, DIM)).astype(np.float32)
+    tile_of_row = np.arange(num) // PER_TILE
+    utms = np.stack([400000. + (tile_of_row + rng.uniform(0.01, 0.99, num)) * TILE_SIZE,
+                     3000000. + rng.uniform(0.01, 0.99, num) * TILE_SIZE], axis=1)
+    h5_path = str(root / "database_features.h5")
+    with h5py.File(h5_path, "w") as hf:
+        hf.create_dataset("database_features", data=features)
+        hf.create_dataset("database_utms", data=utms)
+    tile_database(h5_path, str(root / "tiles"), TILE_SIZE, "float16")
+    return str(root / "tiles"), features, utms
+
+
+def open_tiled(path, num_cached):
+    args = build_parser(load_config(os.path.join(os.path.dirname(PYTHON_ROOT), "config.yaml"))).parse_args([])
+    args.index_type = "flat"
+    tiled = TiledDatabase(path, args, cache_mb=0, global_tiles=0)
+    # room for num_cached tiles, they all have the same size
+    tiled.cache_bytes = num_cached * tiled.tile(0, cache=False).nbytes + 1
+    return tiled
+
+
+def test_lru_load_and_eviction_bound(database):
+    tiled = open_tiled(database[0], 3)
+    try:
+        for i in range(4):
+            tiled.tile(i)
+        assert list(tiled.cache) == [1, 2, 3]
+        assert tiled.cached_bytes <= tiled.cache_bytes
+        # a hit makes the tile the most recently used one
+        assert tiled.tile(1) is tiled.cache[1]
+        tiled.tile(4)
+        assert list(tiled.cache) == [3, 1, 4]
+        # tiles loaded for a global search are not cached
+        tiled.tile(5, cache=False)
+        assert list(tiled.cache) == [3, 1, 4]
+        assert tiled.cached_bytes == sum(tile.nbytes for tile in tiled.cache.values())
+    finally:
+        tiled.close()
+
+
+def test_query_and_features_match_the_source(database):
+    path, features, utms = database
+    tiled = open_tiled(path, 2)
+    try:
+        center = np.array([400000. + 2.5 * TILE_SIZE, 3000000. + 0.5 * TILE_SIZE])
+        ids = tiled.query(center, 120.)
+        np.testing.assert_allclose(np.hypot(*(tiled.utms[ids] - center).T) <= 120., True)
+        # global ids are in tile order, map them back to the rows of the source
+        source_rows = [int(np.flatnonzero(np.all(utms == utm, axis=1))[0]) for utm in tiled.utms[ids]]
+        assert len(ids) == int(np.count_nonzero(np.hypot(*(utms - center).T) <= 120.))
+        np.testing.assert_allclose(tiled[ids], features[source_rows], rtol=1e-3, atol=1e-3)
+        assert tiled.cached_bytes <= tiled.cache_bytes
+    finally:
+        tiled.close()
@@ -0,0 +1,104 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from py_utils.tracker import Tracker, FIX_SINGLE, FIX_TRACKED, FIX_PREDICTED
+
+# database entries every 10 m along the easting axis
+DATABASE_UTMS = np.stack([400000. + np.arange(200) * 10., np.full(200, 3000000.)], axis=1)
+
+
+def fix(entry):
+    return DATABASE_UTMS[entry]
+
+
+def make_tracker(**kwargs):
+    return Tracker(DATABASE_UTMS, **dict({"history": 3, "window_min": 100., "window_max": 500.}, **kwargs))
+
+
+def start(tracker, entry=50, t=0.):
+    return tracker.update(fix(entry), np.array([0.1, 0.2]), np.array([entry, entry + 1]), t)
+
+
+def test_window():
+    tracker = make_tracker()
+    assert tracker.window(0.) is None
+    start(tracker)
+    center, radius = tracker.window(1.)
+    np.testing.assert_allclose(center, fix(50))
+    assert 100. <= radius <= 500.
+    # the prediction gets less certain with time, up to window_max
+    assert tracker.window(5.)[1] > radius
+    assert tracker.window(1000.)[1] == 500.
+
+
+def test_outlier_gate_is_inside_the_window():
+    tracker = make_tracker()
+    start(tracker)
+    _, P = tracker._predict(1.)
+    assert tracker._gate(P) < tracker.window(1.)[1]
+
+
+def test_rerank_prefers_candidates_the_history_agrees_with():
+    tracker = make_tracker()
+    # the earlier frame only matched entry 50, the track stands still
+    start(tracker, 50)
+    distances = np.array([0.30, 0.32])
+    predictions = np.array([120, 50])
+    order, score = tracker.rerank(distances, predictions, 1.)
+    assert list(order) == [1, 0]
+    assert score == pytest.approx((0.32 + 0.1) / 2)
+
+
+def test_update():
+    tracker = make_tracker()
+    position, status = start(tracker)
+    assert status == FIX_SINGLE
+    np.testing.assert_allclose(position, fix(50))
+
+    # a fix close to the prediction is filtered
+    position, status = tracker.update(fix(51), np.array([0.1]), np.array([51]), 1.)
+    assert status == FIX_TRACKED
+    assert fix(50)[0] < position[0] < fix(51)[0]
+
+    # inside the search window but beyond the gate: the prediction is returned instead
+    center, radius = tracker.window(2.)
+    entry = 50 + int(0.8 * radius // 10)
+    assert np.linalg.norm(fix(entry) - center) < radius
+    position, status = tracker.update(fix(entry), np.array([0.1]), np.array([entry]), 2.)
+    assert status == FIX_PREDICTED
+    np.testing.assert_allclose(position, center)
+    assert tracker.misses == 1
+
+    # an older frame finishing late does not move the track
+    position, status = tracker.update(fix(60), np.array([0.1]), np.array([60]), 1.5)
+    assert status == FIX_SINGLE
+    np.testing.assert_allclose(position, fix(60))
+
+
+def test_update_restarts_after_max_misses():
+    tracker = make_tracker(max_misses=2)
+    start(tracker)
+    far = 50 + 8
+    _, status = tracker.update(fix(far), np.array([0.1]), np.array([far]), 0.1)
+    assert status == FIX_PREDICTED
+    position, status = tracker.update(fix(far), np.array([0.1]), np.array([far]), 0.2)
+    assert status == FIX_SINGLE
+    np.testing.assert_allclose(position, fix(far))
+    assert tracker.misses == 0
+    np.testing.assert_allclose(tracker.window(0.3)[0], fix(far))
+
+
+def test_reset():
+    tracker = make_tracker()
+    start(tracker)
+    tracker.update(fix(51), np.array([0.1]), np.array([51]), 1.)
+    tracker.reset()
+    assert not tracker.tracking
+    assert tracker.window(2.) is None
+    assert len(tracker.history) == 0
+    _, status = start(tracker, 100, 2.)
+    assert status == FIX_SINGLE
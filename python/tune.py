@@ -0,0 +1,114 @@
+import os
+import sys
+import json
+import yaml
+import argparse
+from time import time
+from py_utils import datasets
+from py_utils.faiss_index import add_index_args, load_or_build_index, INDEX_TYPES
+from py_utils.database import load_database
+from py_utils.projection import load_or_fit_projection, project
+from py_utils.inference_pool import add_inference_args
+from py_utils.process_manager import add_retrieval_args
+from py_utils.evaluation import add_evaluation_args
+from py_utils.tuning import (load_or_extract_queries_features, load_or_compute_positives, sweep_index,
+                             index_size_mb, pareto_front, recommend, config_fragment)
+
+
+def describe(result):
+    setting = "".join(f" {name}={result[name]}" for name in ("nprobe", "ef_search") if name in result)
+    return f"{result['index_type']}{setting} {result['dims']}d best_n={result['use_best_n']}"
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Sweep index types, search settings, PCA dims and use_best_n, and recommend the most accurate settings within a latency budget.')
+    parser.add_argument('--model_path', type=str, default='/home/xujg/code/UAV-VisionLoc-Deploy/model/uvl_v0807.rknn', help='model path, .rknn for the rknn backend or .onnx for the onnx backend')
+    parser.add_argument('--path_local_database', type=str, default='/home/xujg/code/UAV-VisionLoc-Deploy/data/database/database_features.h5', help='load local features and utms of database')
+    add_evaluation_args(parser)
+    add_retrieval_args(parser)
+    add_inference_args(parser)
+    # build options of the indexes (nlist, pq_m, hnsw_m, ...), the query time ones are swept below
+    add_index_args(parser)
+    parser.add_argument('--index_types', type=str, default=["flat", "ivf_flat", "ivf_pq", "hnsw"], choices=INDEX_TYPES, nargs="+", help='Index types to sweep.')
+    parser.add_argument('--nprobes', type=int, default=[1, 4, 16, 64], nargs="+", help='nprobe values swept for the IVF indexes.')
+    parser.add_argument('--ef_searches', type=int, default=[16, 32, 64, 128], nargs="+", help='efSearch values swept for HNSW.')
+    parser.add_argument('--pca_dims', type=int, default=[0], nargs="+", help='PCA whitening dims to sweep, such as 0 256 512 1024, 0 for the raw descriptors.')
+    parser.add_argument('--use_best_ns', type=int, default=[1, 3, 5], nargs="+", help='use_best_n values to sweep.')
+    parser.add_argument('--num_timed', type=int, default=200, help='Queries searched one at a time to measure the latency.')
+    parser.add_argument('--target_latency', type=float, default=5., help='Search latency budget (ms per frame, p95) of the recommendation.')
+    parser.add_argument('--output', type=str, default='', help='JSON file all the results, the Pareto front and the recommendation are written to, empty to only print them.')
+    parser.add_argument('--config_fragment', type=str, default='', help='YAML file the recommended config.yaml keys are written to, empty to only print them.')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.path_local_database):
+        print("please extracting database features first, see build_database.py.")
+        sys.exit()
+
+    queries_dataset = datasets.QueriesDatasetOpencv(args.queries_h5)
+    t_start = time()
+    queries_features = load_or_extract_queries_features(queries_dataset, args)
+    print(f"Query features of {queries_dataset.queries_num} queries ready in {time() - t_start:.1f} s")
+
+    database_features, database_utms = load_database(args.path_local_database)
+    positives = load_or_compute_positives(args.queries_h5, queries_dataset.queries_utms, args.path_local_database,
+                                          database_utms, args.positive_dist_threshold)
+    k_max = max(args.recall_values + args.use_best_ns)
+
+    results = []
+    for pca_dims in args.pca_dims:
+        if pca_dims > 0:
+            pca, search_features, search_path = load_or_fit_projection(args.path_local_database, pca_dims)
+            search_queries = project(pca, queries_features)
+        else:
+            pca, search_features, search_path = None, database_features, args.path_local_database
+            search_queries = queries_features
+        dims = search_features.shape[1]
+        for index_type in args.index_types:
+            if index_type == "ivf_pq" and dims % args.pq_m:
+                print(f"Skipping ivf_pq at {dims}d, pq_m {args.pq_m} does not divide it")
+                continue
+            args.index_type = index_type
+            try:
+                faiss_index = load_or_build_index(search_features, args, search_path)
+            except RuntimeError as e:
+                # e.g. fewer training vectors than IVF lists or PQ centroids
+                print(f"Skipping {index_type} at {dims}d, it cannot be built: {str(e).splitlines()[-1]}")
+                continue
+            size_mb = index_size_mb(args, faiss_index.ntotal, search_path)
+            for result in sweep_index(faiss_index, args, index_type, queries_features, search_queries, pca,
+                                      database_utms, queries_dataset.queries_utms, positives, k_max):
+                result.update({"pca_dims": pca_dims, "dims": dims, "index_mb": size_mb})
+                results.append(result)
+                recalls_str = ", ".join(f"{name}: {recall:.1f}" for name, recall in result["recalls"].items())
+                print(f"{describe(result)}: {recalls_str}, localized {result['localized']:.1f}%, "
+                      f"median error {result['median_error']:.1f} m, p50 {result['p50_ms']:.3f} ms, p95 {result['p95_ms']:.3f} ms")
+
+    if not results:
+        print("\nNo setting could be evaluated, every index type was skipped.")
+        sys.exit(1)
+
+    front = pareto_front(results)
+    print(f"\nPareto front (p95 latency vs queries localized within {args.positive_dist_threshold:g} m):")
+    for result in front:
+        print(f"  {result['p95_ms']:8.3f} ms  {result['localized']:5.1f}%  {describe(result)}")
+
+    best = recommend(results, args.target_latency)
+    fragment = None
+    if best is None:
+        print(f"\nNo setting searches within {args.target_latency:g} ms, the fastest is {describe(front[0])} "
+              f"at {front[0]['p95_ms']:.3f} ms")
+    else:
+        fragment = config_fragment(best, args)
+        text = (f"# tune.py: {best['localized']:.1f}% localized within {args.positive_dist_threshold:g} m, "
+                f"search p95 {best['p95_ms']:.3f} ms (target {args.target_latency:g} ms)\n"
+                + yaml.safe_dump(fragment, sort_keys=False, default_flow_style=None))
+        print(f"\nRecommended config.yaml keys:\n{text}")
+        if args.config_fragment:
+            with open(args.config_fragment, 'w') as f:
+                f.write(text)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"target_latency": args.target_latency, "results": results, "pareto_front": front,
+                       "recommended": best, "config": fragment}, f, indent=2)